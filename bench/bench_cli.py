@@ -0,0 +1,95 @@
+# Time gatecontrol --download, --upload, --logs and --sync end to end against
+# a local stand-in for gates.eldesalarms.com, see portal.py.
+#
+#   PYTHONPATH=src python bench/bench_cli.py --users 1000 --latency 0.05 --workers 8 --prefetch 4
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+import argparse
+import csv
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+import gatecontrol
+from portal import FakePortal, PortalConfig
+
+
+# Run gatecontrol with the given arguments, returning the seconds it took
+def run_cli(portal: FakePortal, arguments: [str]) -> float:
+    argv = ['gatecontrol.py', portal.config.username, portal.config.password] + arguments
+    output = io.StringIO()
+    t = time.perf_counter()
+    try:
+        with redirect_stdout(output):
+            sys.argv = argv
+            gatecontrol.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f'gatecontrol {" ".join(arguments)} failed:\n{output.getvalue()}')
+    return time.perf_counter() - t
+
+
+def write_users(file_name: str, count: int):
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'phone', 'output', 'app_access'])
+        for i in range(count):
+            writer.writerow([f'Upload{i}', f'086{i:07d}', 'Gate', 'true'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gatecontrol end to end')
+    parser.add_argument('--users', type=int, default=500, help='Users on the device.')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--upload-users', type=int, default=100, help='Users uploaded by --upload.')
+    parser.add_argument('--days', type=int, default=90, help='Days of logs downloaded by --logs.')
+    parser.add_argument('--entries-per-day', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every request.')
+    parser.add_argument('--sync-seconds', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--prefetch', type=int, default=4)
+    parser.add_argument('--chunk', default='month')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args(sys.argv[1:])
+
+    config = PortalConfig(users=args.users, page_size=args.page_size, entries_per_day=args.entries_per_day,
+                          latency=args.latency, sync_seconds=args.sync_seconds)
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    # gatecontrol writes gatecontrol.log to the working directory
+    os.chdir(directory)
+    try:
+        write_users('upload.csv', args.upload_users)
+        end = date(2023, 12, 31)
+        start = (end - timedelta(days=args.days - 1)).strftime('%Y%m%d')
+        end = end.strftime('%Y%m%d')
+        commands = [
+            ('--download', lambda run: ['1', '--download', f'users-{run}.csv']),
+            ('--download --prefetch', lambda run: ['1', '--download', f'users-prefetch-{run}.csv',
+                                                   '--prefetch', str(args.prefetch)]),
+            ('--upload', lambda run: [str(100 + run), '--upload', 'upload.csv', '--nosync',
+                                      '--workers', str(args.workers)]),
+            ('--logs', lambda run: ['1', '--logs', f'logs-{run}.csv', start, end]),
+            ('--logs --chunk', lambda run: ['1', '--logs', f'logs-chunk-{run}.csv', start, end,
+                                            '--chunk', args.chunk, '--workers', str(args.workers)]),
+            ('--sync', lambda run: ['1', '--sync']),
+        ]
+        with FakePortal(config) as portal, portal.intercept(pool_maxsize=max(args.workers, args.prefetch)):
+            for label, arguments in commands:
+                before = sum(portal.requests.values())
+                times = [run_cli(portal, arguments(run)) for run in range(args.repeat)]
+                requests = (sum(portal.requests.values()) - before) // args.repeat
+                print(f'{label:>22}: {statistics.median(times):7.2f}s  {requests:5} requests')
+                if label == '--upload':
+                    # Adds posted to a slot already taken replace a user
+                    overwrites = sum(portal.device(100 + run).overwrites for run in range(args.repeat))
+                    if overwrites:
+                        print(f'{"":>22}  {overwrites} users overwritten by adds to a taken slot')
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
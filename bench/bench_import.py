@@ -0,0 +1,82 @@
+# Record the import time of each gatecontrol subcommand with python -X
+# importtime, run against a local stand-in for gates.eldesalarms.com, see
+# portal.py. Reports the total, and the packages costing the most.
+#
+#   PYTHONPATH=src python bench/bench_import.py --top 5
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from portal import FakePortal, PortalConfig
+
+IMPORT_TIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)')
+
+
+# (total, {top level package: microseconds}) of the import time lines, by
+# summing the time each module took itself
+def import_times(stderr: str) -> tuple[int, dict[str, int]]:
+    packages = {}
+    for match in IMPORT_TIME_PATTERN.finditer(stderr):
+        package = match.group(4).split('.')[0]
+        packages[package] = packages.get(package, 0) + int(match.group(1))
+    return sum(packages.values()), packages
+
+
+# Bytecode is cached, as it is for an installed package, so compiling the
+# sources isn't counted
+def child_env() -> dict[str, str]:
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(
+        [os.path.abspath('src'), os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH', '')])}
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+# Run the subcommand in a new directory, as gatecontrol won't overwrite its output
+def run(portal: FakePortal, arguments: [str], upload_file: str) -> str:
+    directory = tempfile.mkdtemp()
+    shutil.copy(upload_file, directory)
+    env = child_env()
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(os.path.dirname(__file__), 'cli_child.py'),
+                             portal.url, portal.config.username, portal.config.password] + arguments,
+                            cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f'gatecontrol {" ".join(arguments)} failed:\n{result.stderr[-2000:]}')
+    return result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of gatecontrol subcommands')
+    parser.add_argument('--top', type=int, default=5, help='Number of packages listed for each subcommand.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each subcommand, the fastest is reported.')
+    args = parser.parse_args(sys.argv[1:])
+
+    upload_file = os.path.join(tempfile.mkdtemp(), 'upload.csv')
+    with open(upload_file, 'w') as f:
+        f.write('name,phone,output,app_access\nUpload1,0860000001,Gate,true\n')
+    commands = [
+        ('--sync', ['1', '--sync']),
+        ('--download', ['1', '--download', 'users.csv']),
+        ('--upload', ['1', '--upload', 'upload.csv', '--nosync']),
+        ('--logs', ['1', '--logs', 'logs.csv', '20230901', '20230930']),
+        ('--stats', ['1', '--stats', 'stats.json', '20230901', '20230930']),
+    ]
+    # Compile and cache everything the subcommands import
+    subprocess.run([sys.executable, '-c', 'import gatecontrol, eldesalarms.analytics, bs4, lxml.etree, progress.bar'],
+                   env=child_env(), check=True)
+    with FakePortal(PortalConfig(users=20, sync_seconds=0)) as portal:
+        baseline, _ = import_times(subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'],
+                                                  capture_output=True, text=True).stderr)
+        print(f'{"python":>12}: {baseline / 1000:6.1f}ms')
+        for label, arguments in commands:
+            total, packages = min((import_times(run(portal, arguments, upload_file)) for _ in range(args.repeat)),
+                                  key=lambda times: times[0])
+            top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+            print(f'{label:>12}: {(total - baseline) / 1000:6.1f}ms  '
+                  + ', '.join(f'{package} {time / 1000:.1f}ms' for package, time in top))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Benchmark serial vs chunked log downloads against a local stand-in for
+# gates.eldesalarms.com, see portal.py.
+#
+#   PYTHONPATH=src python bench/bench_logs.py --days 365 --chunk month --workers 8
+from datetime import date, timedelta
+import argparse
+import sys
+import time
+from eldesalarms.api import DeviceApi, LOG_CHUNKS
+from eldesalarms.session import UserSession
+from portal import FakePortal, PortalConfig
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DeviceApi.get_logs')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--chunk', choices=LOG_CHUNKS, default='month')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(sys.argv[1:])
+
+    # Seconds to render the log file, fixed plus per day of the range
+    config = PortalConfig(latency=0.05, latency_per_day=0.005, entries_per_day=50)
+    with FakePortal(config) as portal:
+        session = UserSession(config.username, config.password)
+        portal.connect(session, pool_maxsize=args.workers)
+        session.login()
+        api = DeviceApi(session, 1)
+
+        end = date(2023, 12, 31)
+        start = end - timedelta(days=args.days - 1)
+        for label, chunk in (('serial', None), (f'{args.chunk} x {args.workers}', args.chunk)):
+            t = time.perf_counter()
+            entries = api.get_logs(start, end, chunk=chunk, workers=args.workers)
+            print(f'{label:>16}: {len(entries)} entries in {time.perf_counter() - t:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Benchmark the log analytics on a synthetic LogBatch.
+#
+#   PYTHONPATH=src python bench/bench_stats.py --entries 1000000
+from array import array
+from datetime import date, datetime
+import argparse
+import sys
+import time
+import numpy as np
+from eldesalarms.analytics import LogColumns, as_timestamp
+from eldesalarms.models import LogBatch
+
+
+def make_batch(entries: int, apartments: int, seed: int = 0) -> LogBatch:
+    rng = np.random.default_rng(seed)
+    batch = LogBatch()
+    start = as_timestamp(datetime(2023, 1, 1))
+    timestamps = np.sort(rng.integers(start, start + 365 * 24 * 3600 * 10**6, entries))
+    apartments = rng.integers(1, apartments + 1, entries)
+    batch.strings = [f'{apt}TVPerson' for apt in range(apartments.max() + 1)]
+    batch.strings += [f'0870{apt:06d}' for apt in range(apartments.max() + 1)]
+    batch.timestamps = array('q', timestamps.astype(np.int64).tobytes())
+    batch.apt_nos = array('q', apartments.astype(np.int64).tobytes())
+    batch.who_indexes = array('L', apartments.astype(f'u{batch.who_indexes.itemsize}').tobytes())
+    batch.phone_indexes = array('L', (apartments + apartments.max() + 1).astype(
+        f'u{batch.phone_indexes.itemsize}').tobytes())
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark eldesalarms.analytics')
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--apartments', type=int, default=200)
+    args = parser.parse_args(sys.argv[1:])
+
+    batch = make_batch(args.entries, args.apartments)
+    t = time.perf_counter()
+    columns = LogColumns(batch)
+    print(f'{"columns":>28}: {time.perf_counter() - t:.3f}s')
+    for name, run in (('counts_per_day', columns.counts_per_day),
+                      ('counts_per_apartment_per_day', columns.counts_per_apartment_per_day),
+                      ('hour_histogram', columns.hour_histogram),
+                      ('weekday_histogram', columns.weekday_histogram),
+                      ('phone_activity', columns.phone_activity),
+                      ('summary', lambda: columns.summary(date(2023, 12, 1)))):
+        t = time.perf_counter()
+        run()
+        print(f'{name:>28}: {time.perf_counter() - t:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
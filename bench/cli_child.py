@@ -0,0 +1,13 @@
+# Run gatecontrol against the local server at URL, see bench_import.py.
+#
+#   python -X importtime bench/cli_child.py URL gatecontrol-arguments...
+import sys
+from local import intercept
+import gatecontrol
+
+
+if __name__ == '__main__':
+    url = sys.argv[1]
+    sys.argv = ['gatecontrol.py'] + sys.argv[2:]
+    with intercept(url):
+        gatecontrol.main()
@@ -0,0 +1,42 @@
+# Send the requests for gates.eldesalarms.com to a local server instead, see
+# portal.py. Kept apart from the portal so a child process running the CLI
+# against it only imports what the CLI itself needs.
+from contextlib import contextmanager
+import requests
+from eldesalarms.api import BASE_URL
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    # Sends the requests for BASE_URL to the local server instead. The request
+    # is copied, so cookies are still stored for and sent to BASE_URL.
+    def __init__(self, local_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.local_url = local_url
+
+    def send(self, request, **kwargs):
+        local = request.copy()
+        local.url = request.url.replace(BASE_URL, self.local_url, 1)
+        response = super().send(local, **kwargs)
+        response.url = request.url
+        return response
+
+
+# Send the requests for BASE_URL of every session to local_url while in the
+# with block, including sessions created by gatecontrol.main
+@contextmanager
+def intercept(local_url: str, **kwargs):
+    adapter = LocalAdapter(local_url, **kwargs)
+    get_adapter = requests.Session.get_adapter
+
+    def local_adapter(session, url):
+        if url.startswith(BASE_URL):
+            return adapter
+        return get_adapter(session, url)
+
+    # Patched by hand, as unittest.mock would add asyncio to the imports measured
+    requests.Session.get_adapter = local_adapter
+    try:
+        yield adapter
+    finally:
+        requests.Session.get_adapter = get_adapter
+        adapter.close()
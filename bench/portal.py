@@ -0,0 +1,340 @@
+# A local stand-in for gates.eldesalarms.com, for benchmarks. It serves the
+# login and CSRF flow, the paginated user grid, the add and delete user
+# endpoints, log downloads and synchronization progress, with a configurable
+# number of users, log size and latency.
+#
+#   with FakePortal(PortalConfig(users=500, latency=0.05)) as portal, portal.intercept():
+#       session = UserSession(portal.config.username, portal.config.password)
+#       session.login()  # talks to the local server
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+import json
+import re
+import secrets
+import threading
+import time
+import requests
+from eldesalarms.api import BASE_URL
+from local import LocalAdapter, intercept
+
+
+@dataclass
+class PortalConfig:
+    username: str = 'user'
+    password: str = 'pass'
+    # Users on each device when it is first used
+    users: int = 100
+    # Users shown on each page of the user grid
+    page_size: int = 10
+    # Log entries for each day of a log download
+    entries_per_day: int = 50
+    # Seconds added to every request
+    latency: float = 0.0
+    # Seconds added to a log download for each day of its range
+    latency_per_day: float = 0.0
+    # Seconds a synchronization takes to reach 100%
+    sync_seconds: float = 3.0
+
+
+class Device:
+
+    def __init__(self, device_id: int, users: int):
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        # number -> (name, phone, output)
+        self.users = {number: (f'{number % 99 + 1}TVPerson{number}', f'087{number:07d}', 'Gate')
+                      for number in range(1, users + 1)}
+        # Adds posted to a slot that was already taken, which overwrote a user
+        self.overwrites = 0
+        self.sync_started = None
+
+    # The lowest slot without a user, which the add user form posts to
+    def free_number(self) -> int:
+        number = 1
+        while number in self.users:
+            number += 1
+        return number
+
+
+# XPath of the last page link, parsers.LAST_PAGE_ELEMENT:
+# /html/body/div[1]/section/div[1]/div/div/div[4]/div/div[2]/div[5]/div/div[2]/ul/li[12]/a
+USER_PAGE_TEMPLATE = (
+    '<html><body><div><section><div><div><div>'
+    '<div></div><div></div><div></div>'
+    '<div><div><div></div><div>'
+    '<div></div><div></div><div></div><div></div>'
+    '<div><div><div></div><div>'
+    '<ul>{pager}</ul>'
+    '<table class="items table table-striped table-condensed"><tbody>{rows}</tbody></table>'
+    '</div></div></div>'
+    '</div></div></div>'
+    '</div></div></div></section></div></body></html>')
+
+USER_ROW_TEMPLATE = (
+    '<tr><td>{name}</td><td>{phone}</td><td>{output}</td>'
+    '<td><a href="/en/gatesconfig/settings/usersdelete/ajax/1/device_id/{device_id}/number/{number}/tab/1.html">'
+    'Delete</a></td></tr>')
+
+ADD_USER_FORM_TEMPLATE = (
+    '<html><body><form action="/en/gatesconfig/settings/users/ajax/1/device_id/{device_id}/number/{number}.html" method="post">'
+    '<input type="hidden" name="YII_CSRF_TOKEN" value="{token}">'
+    '<select id="GatesconfigDeviceUsersdatabase_output">'
+    '<option value="1">Gate</option><option value="2">Barrier</option><option value="3">All</option>'
+    '</select></form></body></html>')
+
+ROUTES = [
+    ('GET', re.compile(r'/en/user/login\.html'), 'login_page'),
+    ('POST', re.compile(r'/en/user/login\.html'), 'login'),
+    ('GET', re.compile(r'/user/logout'), 'logout'),
+    ('GET', re.compile(r'/gatesconfig/settings/configuration/device_id/(\d+)'), 'first_user_page'),
+    ('GET', re.compile(r'/en/gatesconfig/settings/configuration/ajax/gatesconfig-device-usersdatabase-grid/'
+                       r'device_id/(\d+)/GatesconfigDeviceUsersdatabase_page/(\d+)\.html'), 'user_page'),
+    ('GET', re.compile(r'/en/gatesconfig/settings/users/ajax/1/device_id/(\d+)/tab/1\.html'), 'add_user_form'),
+    ('POST', re.compile(r'/en/gatesconfig/settings/users/ajax/1/device_id/(\d+)/number/(\d+)\.html'), 'add_user'),
+    ('POST', re.compile(r'/en/gatesconfig/settings/usersdelete/ajax/1/device_id/(\d+)/number/(\d+)/tab/1\.html'),
+     'delete_user'),
+    ('GET', re.compile(r'/en/gatesconfig/settings/getlog/ajax/1/device_id/(\d+)\.html'), 'log_link'),
+    ('GET', re.compile(r'/logfile/device_id/(\d+)'), 'log_file'),
+    ('GET', re.compile(r'/en/gatesconfig/settings/start/devId/(\d+)\.html'), 'start_sync'),
+    ('GET', re.compile(r'/gatesconfig/settings/check'), 'sync_progress'),
+]
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    # Keep connections open, like the real portal, so pooling can be measured
+    protocol_version = 'HTTP/1.1'
+    portal: 'FakePortal' = None
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method: str):
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        self.form = parse_qs(self.rfile.read(length).decode('utf-8')) if length else {}
+        cookies = SimpleCookie(self.headers.get('Cookie', ''))
+        self.session_id = cookies['PHPSESSID'].value if 'PHPSESSID' in cookies else None
+        self.portal.count(url.path)
+        if self.portal.config.latency:
+            time.sleep(self.portal.config.latency)
+
+        for route_method, pattern, name in ROUTES:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                if not name.startswith('login') and not self.portal.logged_in(self.session_id):
+                    return self.respond(302, headers={'Location': '/en/user/login.html'})
+                return getattr(self, name)(*match.groups())
+        self.respond(404)
+
+    def respond(self, status: int = 200, body: str = '', content_type: str = 'text/html; charset=utf-8',
+                headers: dict | None = None, cookies: dict | None = None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        for name, value in (cookies or {}).items():
+            self.send_header('Set-Cookie', f'{name}={value}; path=/')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+    def device(self, device_id: str) -> Device:
+        return self.portal.device(int(device_id))
+
+    def valid_token(self) -> bool:
+        return self.form.get('YII_CSRF_TOKEN', [None])[0] == self.portal.token
+
+    # Users already logged in are redirected, everyone else gets a session and
+    # the CSRF token cookie, serialized the way Yii does
+    def login_page(self):
+        if self.portal.logged_in(self.session_id):
+            return self.respond(302, headers={'Location': '/'})
+        token = quote(f's:40:"{self.portal.token}";')
+        self.respond(body='<html><body><form method="post"></form></body></html>',
+                     cookies={'PHPSESSID': secrets.token_hex(13), 'YII_CSRF_TOKEN': token})
+
+    def login(self):
+        config = self.portal.config
+        if (not self.valid_token() or self.form.get('UserLogin[username]') != [config.username]
+                or self.form.get('UserLogin[password]') != [config.password]):
+            return self.respond(200, '<html><body>Incorrect username or password</body></html>')
+        # A new session id on login. No Location, so the client sees the 302.
+        session_id = self.portal.new_session()
+        self.respond(302, cookies={'PHPSESSID': session_id})
+
+    def logout(self):
+        self.portal.end_session(self.session_id)
+        self.respond(302, headers={'Location': '/en/user/login.html'})
+
+    def first_user_page(self, device_id: str):
+        self.user_page(device_id, '1')
+
+    def user_page(self, device_id: str, page_no: str):
+        device = self.device(device_id)
+        page_size = self.portal.config.page_size
+        with device.lock:
+            users = sorted(device.users.items())
+        max_pages = max(1, -(-len(users) // page_size))
+        start = (int(page_no) - 1) * page_size
+        rows = ''.join(USER_ROW_TEMPLATE.format(name=name, phone=phone, output=output,
+                                                device_id=device.device_id, number=number)
+                       for number, (name, phone, output) in users[start:start + page_size])
+        last_page = (f'/en/gatesconfig/settings/configuration/ajax/gatesconfig-device-usersdatabase-grid/'
+                     f'device_id/{device.device_id}/GatesconfigDeviceUsersdatabase_page/{max_pages}.html')
+        pager = '<li></li>' * 11 + f'<li><a href="{last_page}">Last</a></li>'
+        self.respond(body=USER_PAGE_TEMPLATE.format(pager=pager, rows=rows))
+
+    # Like the real portal, the form posts to the slot that is free when it
+    # is served, so two forms served before either is posted share a slot
+    def add_user_form(self, device_id: str):
+        device = self.device(device_id)
+        with device.lock:
+            number = device.free_number()
+        self.respond(body=ADD_USER_FORM_TEMPLATE.format(device_id=device_id, number=number,
+                                                        token=self.portal.token))
+
+    # The user is written to the slot posted to, replacing any user in it
+    def add_user(self, device_id: str, number: str):
+        if not self.valid_token():
+            return self.respond(400)
+        device = self.device(device_id)
+        outputs = {'1': 'Gate', '2': 'Barrier', '3': 'All'}
+        with device.lock:
+            if int(number) in device.users:
+                device.overwrites += 1
+            device.users[int(number)] = (
+                self.form['GatesconfigDeviceUsersdatabase[user_name]'][0],
+                self.form['GatesconfigDeviceUsersdatabase[phone]'][0],
+                outputs.get(self.form.get('GatesconfigDeviceUsersdatabase[output]', ['1'])[0], 'Gate'))
+        self.respond()
+
+    def delete_user(self, device_id: str, number: str):
+        if not self.valid_token():
+            return self.respond(400)
+        device = self.device(device_id)
+        with device.lock:
+            removed = device.users.pop(int(number), None)
+        self.respond(200 if removed else 404)
+
+    # The page with the link to the log file, at /html/body/div/div/a[2]
+    def log_link(self, device_id: str):
+        link = f'logfile/device_id/{device_id}?start={self.query["logstart"][0]}&end={self.query["logend"][0]}'
+        self.respond(body=f'<html><body><div><div><a href="#">Close</a><a href="{link}">Download</a>'
+                          '</div></div></body></html>')
+
+    def log_file(self, device_id: str):
+        config = self.portal.config
+        start = date.fromisoformat(self.query['start'][0])
+        end = date.fromisoformat(self.query['end'][0])
+        days = (end - start).days + 1
+        if config.latency_per_day:
+            time.sleep(config.latency_per_day * days)
+        lines = []
+        for day in range(days):
+            when = datetime.combine(start + timedelta(days=day), datetime.min.time())
+            for i in range(config.entries_per_day):
+                stamp = (when + timedelta(seconds=i * 86400 // config.entries_per_day)).strftime('%Y.%m.%d %H:%M:%S')
+                lines.append(f'{stamp} Opened by user:{i % 99 + 1}TVPerson{i}(call\nR:1):08700{i:05d}\n')
+        self.respond(body=''.join(lines), content_type='text/plain; charset=utf-8')
+
+    def start_sync(self, device_id: str):
+        device = self.device(device_id)
+        with device.lock:
+            device.sync_started = time.monotonic()
+        self.respond()
+
+    # {"percentage":0,"stop":1,"state_string":"Downloading data"}
+    def sync_progress(self):
+        device = self.device(self.query['devId'][0])
+        with device.lock:
+            started = device.sync_started
+        if started is None:
+            percentage = 100
+        elif self.portal.config.sync_seconds <= 0:
+            percentage = 100
+        else:
+            percentage = min(100, int(100 * (time.monotonic() - started) / self.portal.config.sync_seconds))
+        self.respond(body=json.dumps({'percentage': percentage, 'stop': 1, 'state_string': 'Downloading data'}),
+                     content_type='application/json')
+
+
+class FakePortal:
+
+    def __init__(self, config: PortalConfig | None = None):
+        self.config = config or PortalConfig()
+        self.token = secrets.token_hex(20)
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.devices = {}
+        # Requests served, by path
+        self.requests = {}
+        handler = type('Handler', (PortalHandler,), {'portal': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self) -> 'FakePortal':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+    def count(self, path: str):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def device(self, device_id: int) -> Device:
+        with self.lock:
+            if device_id not in self.devices:
+                self.devices[device_id] = Device(device_id, self.config.users)
+            return self.devices[device_id]
+
+    def new_session(self) -> str:
+        session_id = secrets.token_hex(13)
+        with self.lock:
+            self.sessions.add(session_id)
+        return session_id
+
+    def end_session(self, session_id: str | None):
+        with self.lock:
+            self.sessions.discard(session_id)
+
+    def logged_in(self, session_id: str | None) -> bool:
+        with self.lock:
+            return session_id in self.sessions
+
+    def adapter(self, **kwargs) -> LocalAdapter:
+        return LocalAdapter(self.url, **kwargs)
+
+    # Send the requests for BASE_URL of one session to this portal
+    def connect(self, session: requests.Session, **kwargs):
+        session.mount(BASE_URL, self.adapter(**kwargs))
+
+    # Send the requests for BASE_URL of every session to this portal while in
+    # the with block, including sessions created by gatecontrol.main
+    def intercept(self, **kwargs):
+        return intercept(self.url, **kwargs)
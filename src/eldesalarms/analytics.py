@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Iterable
+import numpy as np
+from .models import LogBatch, LogEntry, BATCH_EPOCH, NO_APT_NO
+
+
+US_PER_HOUR = 3600 * 1000 * 1000
+US_PER_DAY = 24 * US_PER_HOUR
+# BATCH_EPOCH (1970-01-01) was a Thursday, so day 0 is weekday 3
+EPOCH_WEEKDAY = BATCH_EPOCH.weekday()
+
+
+@dataclass
+class PhoneActivity:
+    phone: str
+    first_seen: datetime
+    last_seen: datetime
+    count: int
+
+
+def as_datetime(timestamp: int) -> datetime:
+    return BATCH_EPOCH + timedelta(microseconds=timestamp)
+
+
+def as_timestamp(when: date) -> int:
+    if not isinstance(when, datetime):
+        when = datetime.combine(when, datetime.min.time())
+    return (when - BATCH_EPOCH) // timedelta(microseconds=1)
+
+
+# The log entries as NumPy columns, so they can be grouped and counted
+# without a Python loop per entry. The columns are copied from the arrays of
+# a LogBatch; who and phone are codes into `strings`.
+class LogColumns:
+
+    def __init__(self, batch: LogBatch):
+        self.strings = list(batch.strings)
+        self.timestamps = np.frombuffer(batch.timestamps, dtype=batch.timestamps.typecode).copy()
+        self.apt_nos = np.frombuffer(batch.apt_nos, dtype=batch.apt_nos.typecode).copy()
+        self.who_codes = np.frombuffer(batch.who_indexes, dtype=batch.who_indexes.typecode).astype(np.intp)
+        self.phone_codes = np.frombuffer(batch.phone_indexes, dtype=batch.phone_indexes.typecode).astype(np.intp)
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[LogEntry]) -> 'LogColumns':
+        return cls(entries if isinstance(entries, LogBatch) else LogBatch(entries))
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    # Days since BATCH_EPOCH of each entry
+    def days(self) -> np.ndarray:
+        return self.timestamps // US_PER_DAY
+
+    def counts_per_day(self) -> [tuple[date, int]]:
+        days, counts = np.unique(self.days(), return_counts=True)
+        return [(BATCH_EPOCH.date() + timedelta(days=day), count)
+                for day, count in zip(days.tolist(), counts.tolist())]
+
+    # (day, apt_no, count) for every day and apartment with entries, ordered
+    # by day then apartment. apt_no is None for entries without one.
+    def counts_per_apartment_per_day(self) -> [tuple[date, int | None, int]]:
+        if not len(self):
+            return []
+        # Group on one integer key per (day, apartment) pair, which is much
+        # faster than np.unique over rows
+        days = self.days()
+        first_day, first_apt_no = days.min(), self.apt_nos.min()
+        span = int(self.apt_nos.max() - first_apt_no) + 1
+        keys, counts = np.unique((days - first_day) * span + (self.apt_nos - first_apt_no),
+                                 return_counts=True)
+        days, apt_nos = np.divmod(keys, span)
+        days += first_day
+        apt_nos += first_apt_no
+        return [(BATCH_EPOCH.date() + timedelta(days=day), None if apt_no == NO_APT_NO else apt_no, count)
+                for day, apt_no, count in zip(days.tolist(), apt_nos.tolist(), counts.tolist())]
+
+    # Number of entries in each hour of the day, 0 to 23
+    def hour_histogram(self) -> np.ndarray:
+        return np.bincount((self.timestamps // US_PER_HOUR) % 24, minlength=24)
+
+    # Number of entries on each day of the week, Monday (0) to Sunday (6)
+    def weekday_histogram(self) -> np.ndarray:
+        return np.bincount((self.days() + EPOCH_WEEKDAY) % 7, minlength=7)
+
+    # First and last time each phone was seen, and how often, keyed by phone.
+    # Entries without a phone are left out.
+    def phone_activity(self) -> dict[str, PhoneActivity]:
+        # The codes are already small integers, so they index the results directly
+        first = np.full(len(self.strings), np.iinfo(np.int64).max, dtype=np.int64)
+        last = np.full(len(self.strings), np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(first, self.phone_codes, self.timestamps)
+        np.maximum.at(last, self.phone_codes, self.timestamps)
+        counts = np.bincount(self.phone_codes, minlength=len(self.strings))
+        codes = np.flatnonzero(counts)
+        activity = {}
+        for code, first_seen, last_seen, count in zip(codes.tolist(), first[codes].tolist(),
+                                                      last[codes].tolist(), counts[codes].tolist()):
+            phone = self.strings[code]
+            if phone is not None:
+                activity[phone] = PhoneActivity(phone, as_datetime(first_seen),
+                                                as_datetime(last_seen), count)
+        return activity
+
+    # Phones not seen since `since`, including any of `phones` (for example the
+    # users on the device) that are not in the entries at all
+    def inactive_phones(self, since: date, phones: Iterable[str] = ()) -> [str]:
+        activity = self.phone_activity()
+        cutoff = as_datetime(as_timestamp(since))
+        inactive = [phone for phone, seen in activity.items() if seen.last_seen < cutoff]
+        inactive += [phone for phone in dict.fromkeys(phones) if phone not in activity]
+        return sorted(inactive)
+
+    # All of the above as a dict that can be written as JSON
+    def summary(self, inactive_since: date | None = None, phones: Iterable[str] = ()) -> dict:
+        summary = {
+            'entries': len(self),
+            'per_day': [{'day': day.isoformat(), 'count': count}
+                        for day, count in self.counts_per_day()],
+            'per_apartment_per_day': [{'day': day.isoformat(), 'apt_no': apt_no, 'count': count}
+                                      for day, apt_no, count in self.counts_per_apartment_per_day()],
+            'per_hour': self.hour_histogram().tolist(),
+            'per_weekday': self.weekday_histogram().tolist(),
+            'phones': [{'phone': seen.phone, 'first_seen': seen.first_seen.isoformat(),
+                        'last_seen': seen.last_seen.isoformat(), 'count': seen.count}
+                       for seen in sorted(self.phone_activity().values(), key=lambda seen: seen.phone)],
+        }
+        if inactive_since is not None:
+            summary['inactive_since'] = as_datetime(as_timestamp(inactive_since)).isoformat()
+            summary['inactive_phones'] = self.inactive_phones(inactive_since, phones)
+        return summary
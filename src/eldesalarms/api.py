@@ -1,98 +1,315 @@
-from dataclasses import dataclass, field
-from datetime import date, datetime
+from dataclasses import replace
+from enum import Enum
+from datetime import date, datetime, timedelta
 from http import HTTPStatus
 import time
-from bs4 import BeautifulSoup
-from lxml import etree
 import requests
 from .session import UserSession, BASE_HEADERS
+from .models import User, LogEntry, LogBatch, AddUserForm
+from .logstore import LogStore, as_date
+from .usersnapshot import UserSnapshot, UserRefresh, content_hash
+from .bulk import upload_users, DEFAULT_UPLOAD_WORKERS
+from .parsers import LAST_PAGE_ELEMENT, DEFAULT_PARSER, UserPage, get_user_page_parser, row_to_user
 import re
 import logging
-from progress.bar import Bar
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Generator, Iterable, Iterator
+from collections import deque
 
 
 BASE_URL = 'https://gates.eldesalarms.com'
 INITIAL_URL = 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}#tabs_tab_users'
 USER_DATA_URL = 'https://gates.eldesalarms.com/en/gatesconfig/settings/configuration/ajax/gatesconfig-device-usersdatabase-grid/device_id/{}/GatesconfigDeviceUsersdatabase_page/{}.html?ajax=gatesconfig-device-usersdatabase-grid'  # noqa: E501
 LOG_FILE_URL = 'https://gates.eldesalarms.com/en/gatesconfig/settings/getlog/ajax/1/device_id/{}.html?_={}&logstart={}&logend={}'
+DELETEUSER_URL = 'https://gates.eldesalarms.com/en/gatesconfig/settings/usersdelete/ajax/1/device_id/{}/number/{}/tab/1.html?ajax=gatesconfig-device-usersdatabase-grid'  # noqa: E501
 ADDUSER_PAGE_URL = 'https://gates.eldesalarms.com/en/gatesconfig/settings/users/ajax/1/device_id/{}/tab/1.html?_={}'
 ADDUSER_ACTION_ELEMENT = '/html/body/form'
 ADDUSER_CONTROLLER_ELEMENT = '//*[@id="GatesconfigDeviceUsersdatabase_output"]/option'
-LAST_PAGE_ELEMENT = '/html/body/div[1]/section/div[1]/div/div/div[4]/div/div[2]/div[5]/div/div[2]/ul/li[12]/a'\
-
+ADDUSER_TOKEN_ELEMENT = '/html/body/form//input[@name="YII_CSRF_TOKEN"]'
 SYNC_URL = 'https://gates.eldesalarms.com/en/gatesconfig/settings/start/devId/{}.html'  # device_id
 SYNC_PROGRESS_URL = 'https://gates.eldesalarms.com/gatesconfig/settings/check?devId={}'  # device_id
 
 
-@dataclass
-class User:
-    name: str
-    phone: str
-    output: str = ''
-    app_access: bool = True
-    password: str = field(init=False, default=None)
-
-
-@dataclass
-class LogEntry:
-    when: datetime
-    who: str
-    phone: str
-    apt_no: str | None
-
-
 LOG_DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
 # 2023.09.23 20:08:56 Opened by user:18TVName(callR:1):0871234567
+# who is the text between user: and (callR, apt_no is the number prefixing
+# the who, and phone is the number after (callR:1):
+LOG_LINE_PATTERN = re.compile(
+    r'\d{4}\.\d{2}\.\d{2} \d{2}:\d{2}:\d{2}'
+    r'(?:.*?user:(?P<who>(?P<apt_no>\d+)?.*?)(?=\(callR))?'
+    r'(?:.*?\(callR:1\):(?P<phone>\d+))?')
 
 # Length of time to wait for the synchronization to complete
 SYNC_TIMEOUT_SECONDS = 180
-# Length of time to wait between checking the synchronization progress
+# Longest time to wait between checking the synchronization progress
 SYNC_SLEEP_DURATION_SECONDS = 10
+# Shortest time to wait between checking the synchronization progress
+SYNC_MIN_SLEEP_DURATION_SECONDS = 1
+# After starting a sync, the portal may still report 100% for the last one.
+# 100% is only taken to mean the new sync is complete once it has reported
+# less, or this many seconds after starting it.
+SYNC_START_GRACE_SECONDS = SYNC_SLEEP_DURATION_SECONDS
+
+# Number of threads used to prefetch user pages
+DEFAULT_PREFETCH_WORKERS = 4
+
+# Number of threads used to download log chunks
+DEFAULT_LOG_WORKERS = 4
+# Sizes get_logs can split a date range into
+LOG_CHUNKS = ('day', 'week', 'month')
+
+# Status codes returned when posting a user that suggest the cached add user
+# form (or its CSRF token) is stale, so the form is refreshed and the post retried
+STALE_FORM_STATUS_CODES = (HTTPStatus.BAD_REQUEST,
+                           HTTPStatus.FORBIDDEN, HTTPStatus.NOT_FOUND)
 
 # Date format used by the API for log requests
 LOGAPI_DATE_FMT = '%Y-%m-%d'
 
 
+# Decides how long to wait before checking the synchronization progress again.
+# Starts with short waits, then waits about half the time the sync is expected
+# to take to complete, based on the rate the percentage has been going up.
+# When there is no progress the wait is doubled.
+class SyncPoller:
+
+    def __init__(self, min_interval: float = SYNC_MIN_SLEEP_DURATION_SECONDS,
+                 max_interval: float = SYNC_SLEEP_DURATION_SECONDS):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.started = None
+        self.first_percentage = None
+
+    def next_interval(self, percentage: int | None, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        if percentage is None:
+            self.interval = min(self.max_interval, self.interval * 2)
+        elif self.started is None:
+            self.started, self.first_percentage = now, percentage
+        else:
+            progress = percentage - self.first_percentage
+            elapsed = now - self.started
+            if progress > 0 and elapsed > 0:
+                remaining = (100 - percentage) * elapsed / progress
+                self.interval = remaining / 2
+            else:
+                self.interval *= 2
+        self.interval = min(self.max_interval, max(self.min_interval, self.interval))
+        return self.interval
+
+
+class SyncStep(Enum):
+    # Check the percentage complete, and send it back
+    CHECK = 'check'
+    # Start a sync on the device
+    START = 'start'
+    # The sync is running from the given percentage complete
+    RUNNING = 'running'
+    # Wait the given number of seconds before the next check
+    WAIT = 'wait'
+    # Report the given percentage complete
+    PROGRESS = 'progress'
+
+
+# The steps of a synchronization, as (step, value) pairs: attach to the sync
+# that is already running or start one, then check on it until it completes.
+# The steps make no requests and never wait themselves; the caller does, see
+# DeviceApi.sync_synchronize.
+# Returns True once the sync is complete.
+def sync_steps(device_id: int, poller: SyncPoller | None = None,
+               start_grace: float = SYNC_START_GRACE_SECONDS) -> Generator[tuple[SyncStep, object], int | None, bool]:
+    poller = poller or SyncPoller()
+    percentage_complete = yield SyncStep.CHECK, None
+    # Time the sync was started, until it reports less than 100%
+    started = None
+    if percentage_complete is not None and 0 < percentage_complete < 100:
+        logging.info(
+            f'Device {device_id} synchronization already running ({percentage_complete}% complete), waiting for it')
+    else:
+        yield SyncStep.START, None
+        started = time.monotonic()
+        percentage_complete = 0
+    yield SyncStep.RUNNING, percentage_complete
+    while True:
+        yield SyncStep.WAIT, poller.next_interval(percentage_complete)
+        percentage_complete = yield SyncStep.CHECK, None
+        if percentage_complete == 100 and started is not None and time.monotonic() - started < start_grace:
+            # Still the last sync, the new one hasn't been seen running yet
+            logging.debug(f'Device {device_id} synchronization not started yet')
+            percentage_complete = None
+            continue
+        if percentage_complete is not None:
+            started = None
+            yield SyncStep.PROGRESS, percentage_complete
+        if percentage_complete == 100:
+            return True
+
+
+class SyncStatus(Enum):
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+# A synchronization running in the background, see DeviceApi.start_synchronize
+class SyncHandle:
+
+    def __init__(self, device_id: int):
+        self.device_id = device_id
+        from concurrent.futures import Future
+
+        self.future = Future()
+        self.stop = threading.Event()
+        # Percentage complete when last checked
+        self.percentage = None
+
+    def status(self) -> SyncStatus:
+        if self.future.cancelled():
+            return SyncStatus.CANCELLED
+        if not self.future.done():
+            return SyncStatus.CANCELLED if self.stop.is_set() else SyncStatus.RUNNING
+        if self.future.exception() is not None:
+            return SyncStatus.FAILED
+        # A sync stopped by cancel() before it completed returns False
+        return SyncStatus.COMPLETED if self.future.result() else SyncStatus.CANCELLED
+
+    # Wait up to timeout seconds (forever if None) for the sync to complete.
+    # Returns False if it was cancelled. Raises TimeoutError if it doesn't
+    # complete in time, but the sync carries on.
+    def wait(self, timeout: float | None = None) -> bool:
+        from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+
+        try:
+            return self.future.result(timeout=timeout)
+        except CancelledError:
+            # Cancelled before its thread started
+            return False
+        except FutureTimeoutError:
+            raise TimeoutError(
+                'Unable to complete synchronization within {} seconds. It will continue in the background'.format(timeout))
+
+    # Stop checking on the sync. The device can't be told to stop, so a sync
+    # that has started on the device still completes there.
+    def cancel(self):
+        self.stop.set()
+        self.future.cancel()
+
+
+# Split start..end (inclusive) into consecutive (start, end) ranges of a day,
+# a week or a calendar month
+def split_date_range(start: date, end: date, chunk: str) -> [tuple[date, date]]:
+    if chunk not in LOG_CHUNKS:
+        raise ValueError(
+            f'Unknown chunk size {chunk}. Valid values are {LOG_CHUNKS}')
+    start, end = as_date(start), as_date(end)
+    ranges = []
+    while start <= end:
+        if chunk == 'day':
+            chunk_end = start
+        elif chunk == 'week':
+            chunk_end = start + timedelta(days=6)
+        else:
+            next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            chunk_end = next_month - timedelta(days=1)
+        chunk_end = min(chunk_end, end)
+        ranges.append((start, chunk_end))
+        start = chunk_end + timedelta(days=1)
+    return ranges
+
+
 class DeviceApi:
 
     class UserIterator:
-        def __init__(self, api):
+        def __init__(self, api, prefetch: int = 0, workers: int = DEFAULT_PREFETCH_WORKERS):
             self.api = api
             self.cache = []
-            self.headers = BASE_HEADERS
-            self.headers['Path'] = '/gatesconfig/settings/configuration/device_id/{}'.format(
-                self.api.device_id)
-            self.headers = self.headers.update(
-                {'X-Requested-With': 'XMLHttpRequest', 'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
-                    api.device_id)})
+            self.headers = {**BASE_HEADERS,
+                            'Path': '/gatesconfig/settings/configuration/device_id/{}'.format(self.api.device_id),
+                            'X-Requested-With': 'XMLHttpRequest',
+                            'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
+                                api.device_id)}
 
             page = self.api.user_session.get(INITIAL_URL.format(
                 self.api.device_id), headers=self.headers)
 
-            # Get the number of pages
-            soup = BeautifulSoup(page.content, "html5lib")
-            dom = etree.HTML(str(soup))
-            last_page_url = dom.xpath(LAST_PAGE_ELEMENT)[
-                0].attrib["href"]
-            match = re.search(r'/(\d+)\.html$', last_page_url)
-            self.max_pages = int(match.group(1) if match else None)
-            table = soup.find(
-                'table', class_='items table table-striped table-condensed')
-
-            # Get the Users on this page
-            tbody = table.find('tbody')
-            for i, row in enumerate(tbody.find_all('tr')):
-                data = row.find_all('td')
-                user = DeviceApi.UserIterator.row_to_user(data)
-                self.cache.append(user)
+            # Get the number of pages and the Users on this page
+            first_page = self.api.user_page(1, page.content)
+            self.max_pages = first_page.max_pages or 1
+            if self.api.user_snapshot is not None:
+                self.api.user_snapshot.truncate(self.max_pages)
+            self.cache = first_page.users
             self.page_no = 2
             self.cache.reverse()
 
+            # Pages N+1..N+prefetch are requested in the background while page N
+            # is being consumed. Futures are kept in page order, so users are still
+            # returned in the same order as when fetching serially.
+            self.prefetch = max(0, prefetch)
+            self.pending = deque()
+            self.executor = None
+            if self.prefetch > 0 and self.max_pages >= self.page_no:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(
+                    max_workers=max(1, min(workers, self.prefetch)))
+                self._schedule()
+
         @staticmethod
         def row_to_user(data):
-            return User(data[0].text.strip(), data[1].text.strip(),
-                        data[2].text.strip(), True)
+            return row_to_user(data)
+
+        def fetch_page(self, page_no: int) -> [User]:
+            page = self.api.user_session.get(USER_DATA_URL.format(
+                self.api.device_id, page_no), headers=self.headers)
+            return self.api.user_page(page_no, page.content).users
+
+        def _schedule(self):
+            # Keep at most `prefetch` pages in flight (or waiting to be consumed)
+            # so memory stays bounded regardless of the number of pages.
+            while len(self.pending) < self.prefetch and self.page_no <= self.max_pages:
+                self.pending.append(self.executor.submit(
+                    self.fetch_page, self.page_no))
+                self.page_no += 1
+
+        def _next_page(self) -> list[User] | None:
+            if self.executor is not None:
+                if not self.pending:
+                    self.close()
+                    return None
+                try:
+                    users = self.pending.popleft().result()
+                except BaseException:
+                    self.close()
+                    raise
+                self._schedule()
+                return users
+            if self.page_no <= self.max_pages:
+                users = self.fetch_page(self.page_no)
+                self.page_no += 1
+                return users
+            return None
+
+        # Stop prefetching. Called once the last page has been fetched or a page
+        # fails, and when leaving a with block or dropping the iterator part way.
+        def close(self):
+            if getattr(self, 'executor', None) is not None:
+                for future in self.pending:
+                    future.cancel()
+                self.pending.clear()
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                self.page_no = self.max_pages + 1
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exception_type, exception_value, traceback):
+            self.close()
+
+        def __del__(self):
+            self.close()
 
         def __iter__(self):
             return self
@@ -101,132 +318,243 @@ class DeviceApi:
             if len(self.cache) != 0:
                 return self.cache.pop()
             else:
-                if self.page_no <= self.max_pages:
-                    page = self.api.user_session.get(USER_DATA_URL.format(
-                        self.api.device_id, self.page_no), headers=self.headers)
-                    soup = BeautifulSoup(page.content, "html5lib")
-                    table = soup.find(
-                        'table', class_='items table table-striped table-condensed')
-                    tbody = table.find('tbody')
-                    for i, row in enumerate(tbody.find_all('tr')):
-                        data = row.find_all('td')
-                        user = DeviceApi.UserIterator.row_to_user(data)
-                        self.cache.append(user)
-                    self.page_no += 1
-                    self.cache.reverse()
-                    # Assumes there is at least one user on the last page
-                    return self.cache.pop()
-                else:
+                users = self._next_page()
+                if users is None:
                     raise StopIteration()
+                self.cache = users
+                self.cache.reverse()
+                # Assumes there is at least one user on the last page
+                return self.cache.pop()
 
-    def __init__(self, user_session: UserSession, device_id: int):
+    def __init__(self, user_session: UserSession, device_id: int, parser: str = DEFAULT_PARSER,
+                 log_store: LogStore | None = None, user_snapshot: UserSnapshot | None = None):
         if not user_session.logged_in and not user_session.login():
             raise ValueError('Session must be logged in to use the api')
         self.user_session = user_session
         self.device_id = device_id
+        # Backend used to parse the user grid pages, see parsers.PARSERS
+        self.parser = get_user_page_parser(parser)
+        # The output options of the add user form are the same for every user
+        # on the device, so they are parsed once and shared by all add_user calls
+        self.add_user_outputs = None
+        self.form_cache_hits = 0
+        self.form_cache_misses = 0
+        self._form_lock = threading.Lock()
+        # Held from getting the add user form to posting it, so concurrent
+        # adds are never given the same free slot
+        self._add_lock = threading.Lock()
+        # Optional logstore.LogStore used to avoid downloading logs again
+        self.log_store = log_store
+        # Optional usersnapshot.UserSnapshot of the parsed user pages, so
+        # pages that have not changed are not parsed again. Without one, no
+        # users are kept after they have been returned.
+        self.user_snapshot = user_snapshot
+        self.metrics = user_session.metrics
 
     @property
     def users(self):
         return DeviceApi.UserIterator(self)
 
+    def parse_user_page(self, content: bytes) -> UserPage:
+        with self.metrics.time(f'parse_user_page_{self.parser.name}'):
+            page = self.parser.parse(content)
+        self.metrics.increment('users_parsed', len(page.users))
+        return page
+
+    # The users on grid page page_no. With a snapshot, a page with the same
+    # content as in the snapshot is taken from it instead of being parsed again.
+    def user_page(self, page_no: int, content: bytes) -> UserPage:
+        if self.user_snapshot is None:
+            return self.parse_user_page(content)
+        digest = content_hash(content)
+        page = self.user_snapshot.page(page_no, digest)
+        if page is not None:
+            self.metrics.increment('user_pages_unchanged')
+            return page
+        page = self.parse_user_page(content)
+        self.user_snapshot.put(page_no, digest, page)
+        return page
+
+    # Iterate over the users, optionally fetching up to `prefetch` pages ahead
+    # using a pool of `workers` threads
+    def iter_users(self, prefetch: int = 0, workers: int = DEFAULT_PREFETCH_WORKERS):
+        return DeviceApi.UserIterator(self, prefetch=prefetch, workers=workers)
+
+    # Download the users again, parsing only the pages that changed since the
+    # snapshot. Returns every user, and the rows changed since the snapshot.
+    # Without a snapshot, one is kept in memory from now on.
+    def refresh_users(self, prefetch: int = 0, workers: int = DEFAULT_PREFETCH_WORKERS) -> UserRefresh:
+        if self.user_snapshot is None:
+            self.user_snapshot = UserSnapshot(None, self.device_id)
+        previous = self.user_snapshot.users()
+        return UserRefresh.compare(previous, list(self.iter_users(prefetch, workers)))
+
     @staticmethod
     def parse_log_line(line: str) -> LogEntry:
-        datestr = line[0:19]
-        when = datetime.strptime(datestr, LOG_DATE_FORMAT)
-
         # 2023.09.23 20:08:56 Opened by user:18TVperson1(callR:1):0871234567
-        # Extract who, which is the text between user: and (callR
-        who_pattern = r'user:(.*?)\(callR'
-        who_match = re.search(who_pattern, line)
-        if who_match:
-            who = who_match.group(1)
-        else:
-            who = None
+        match = LOG_LINE_PATTERN.match(line)
+        if match is None:
+            raise ValueError(
+                f'Log line does not start with a {LOG_DATE_FORMAT} timestamp: {line}')
+
+        # The timestamp is at a fixed position, so slicing it is much cheaper
+        # than datetime.strptime
+        when = datetime(int(line[0:4]), int(line[5:7]), int(line[8:10]),
+                        int(line[11:13]), int(line[14:16]), int(line[17:19]))
 
-        # Extract apt_no which is the number prefixing the who
         # There are other users like the cleaners etc that don't have an apt_no
-        if who:
-            apt_match = re.match(r'^(\d+)', who)
-            apt_no = int(apt_match.group(1)) if apt_match else None
-
-        # Extract phone, which is the text between (callR:1): and the end of the line
-        phone_pattern = r"\(callR:1\):(\d+)"
-        phone_match = re.search(phone_pattern, line)
-        if phone_match:
-            phone = phone_match.group(1)
-        else:
-            phone = None
+        who, apt_no, phone = match.group('who', 'apt_no', 'phone')
+        return LogEntry(when, who, phone, int(apt_no) if apt_no else None)
 
-        return LogEntry(when, who, phone, apt_no)
+    @staticmethod
+    def parse_log_lines(lines: Iterable[str]) -> Iterator[LogEntry]:
+        return map(DeviceApi.parse_log_line, lines)
 
     # https://gates.eldesalarms.com/en/gatesconfig/settings/usersdelete/ajax/1/device_id/50550/number/385/tab/1.html?ajax=gatesconfig-device-usersdatabase-grid
     # ajax: gatesconfig-device-usersdatabase-grid
     # form_data: YII_CSRF_TOKEN=e3ebb2f36832762b9a3159c3d6b54a4d85d2fe74
 
     def remove_user(self, user: User) -> bool:
-        return False
+        number = user.number
+        if number is None:
+            number = self.user_numbers([user]).get(user.phone.strip())
+            if number is None:
+                logging.error(
+                    f'User {user.name} with phone {user.phone} is not on the device')
+                return False
+
+        # remove_users calls this from several threads, so the shared headers
+        # are copied rather than updated
+        headers = {**BASE_HEADERS,
+                   'X-Requested-With': 'XMLHttpRequest',
+                   'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
+                       self.device_id)}
+        try:
+            response = self.user_session.post(url=DELETEUSER_URL.format(self.device_id, number),
+                                              data={'YII_CSRF_TOKEN': self.user_session.token}, headers=headers)
+        except requests.exceptions.RequestException as e:
+            logging.error(f'Error occurred while removing user: {e}')
+            raise ValueError(
+                'Error occurred while removing user. See log for details.') from e
 
-    # Add users to the device, returning the users that were added
-    def add_users(self, users: [User]) -> [User]:
-        added_users = []
+        if response.status_code not in [HTTPStatus.OK, HTTPStatus.FOUND]:
+            logging.error(
+                f'Error occurred while removing user {user.name}. Status code {response.status_code}')
+            return False
+        return True
+
+    # Map the phone numbers of the given users to their number on the device,
+    # using a single pass over the user grid
+    def user_numbers(self, users: [User]) -> dict[str, int]:
+        phones = {user.phone.strip() for user in users}
+        numbers = {}
+        for user in self.users:
+            phone = user.phone.strip()
+            if phone in phones and user.number is not None:
+                numbers.setdefault(phone, user.number)
+                if len(numbers) == len(phones):
+                    break
+        return numbers
+
+    # Remove users from the device, returning the users that were removed.
+    # Users without a number are looked up in one pass over the user grid, then
+    # up to `workers` removes are issued concurrently.
+    def remove_users(self, users: [User], workers: int = DEFAULT_UPLOAD_WORKERS) -> [User]:
+        users = list(users)
+        missing = [user for user in users if user.number is None]
+        numbers = self.user_numbers(missing) if missing else {}
+
+        to_remove = []
         for user in users:
+            if user.number is None:
+                number = numbers.get(user.phone.strip())
+                if number is None:
+                    logging.error(
+                        f'User {user.name} with phone {user.phone} is not on the device')
+                    continue
+                user = replace(user, number=number)
+            to_remove.append(user)
+
+        def remove(user: User) -> bool:
             try:
-                self.add_user(user)
-                added_users.append(user)
+                return self.remove_user(user)
             except ValueError as e:
                 logging.error(
-                    f'Error occurred while adding user {user.name}: {e}')
-        return added_users
-
-    # https://gates.eldesalarms.com/en/gatesconfig/settings/users/ajax/1/device_id/50550/number/385.html
-    def add_user(self, user: User):
-
+                    f'Error occurred while removing user {user.name}: {e}')
+                return False
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            removed = list(executor.map(remove, to_remove))
+        return [user for user, ok in zip(to_remove, removed) if ok]
+
+    # Add users to the device, returning the users that were added.
+    # See bulk.upload_users for the per user results.
+    def add_users(self, users: [User], workers: int = 1, rate_limit: float | None = None) -> [User]:
+        return [result.user for result in upload_users(self, users, workers, rate_limit)
+                if result.added]
+
+    # Get the add user form. Its action posts to the slot that is free when
+    # the form is served (.../number/<slot>.html), so the form is fetched for
+    # every user. Only the output options, which are the same for the whole
+    # device, are cached, unless refresh is True.
+    def get_add_user_form(self, refresh: bool = False) -> AddUserForm:
         # Use timestamp a a cachebuster
         now = datetime.now()
         cache_buster = str(int(time.mktime(now.timetuple())))
 
         request_url = ADDUSER_PAGE_URL.format(self.device_id, cache_buster)
-        headers = BASE_HEADERS
-        headers['Path'] = request_url
-        headers = headers.update(
-            {'X-Requested-With': 'XMLHttpRequest', 'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
-                self.device_id)})
-
-        try:
-            # Find the url to post the new user to
-            page = self.user_session.get(request_url, headers=BASE_HEADERS)
-            soup = BeautifulSoup(page.content, "html5lib")
-            dom = etree.HTML(str(soup))
-            adduser_post_url = dom.xpath(ADDUSER_ACTION_ELEMENT)[
-                0].attrib["action"]
+        headers = {**BASE_HEADERS,
+                   'Path': request_url,
+                   'X-Requested-With': 'XMLHttpRequest',
+                   'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
+                       self.device_id)}
 
+        # Find the url to post the new user to
+        page = self.user_session.get(request_url, headers=headers)
+        from lxml import etree
+
+        with self.metrics.time('parse_add_user_form_lxml'):
+            dom = etree.HTML(page.content)
+        with self.metrics.time('parse_add_user_form_xpath'):
+            forms = dom.xpath(ADDUSER_ACTION_ELEMENT) if dom is not None else []
+            if not forms:
+                raise ValueError('Unable to find the add user form')
+            adduser_post_url = forms[0].attrib["action"]
             logging.debug(f'URL to create a new User{adduser_post_url}')
-            options = dom.xpath(ADDUSER_CONTROLLER_ELEMENT)
 
-            # Dictionary with option text as key and option value as value.
-            adduser_controller_options = {el.text: el.get('value')
-                                          for el in options if el is not None and el.text is not None}
+            tokens = dom.xpath(ADDUSER_TOKEN_ELEMENT)
+            token = tokens[0].get('value') if tokens else None
 
-            if user.output not in adduser_controller_options:
-                raise ValueError(
-                    f'Output {user.output} is not a valid output parameter. Valid values are {adduser_controller_options.keys()}')
-
-            params = {'YII_CSRF_TOKEN': self.user_session.token,
-                      'GatesconfigDeviceUsersdatabase[phone]': user.phone,
-                      'GatesconfigDeviceUsersdatabase[user_name]': user.name,
-                      'GatesconfigDeviceUsersdatabase[app]': '1' if user.app_access else '0',
-                      'GatesconfigDeviceUsersdatabase[app_password]': user.phone[:-6],
-                      'GatesconfigDeviceUsersdatabase[output]': adduser_controller_options[user.output],
-                      'GatesconfigDeviceUsersdatabase[schedulerList]': '',
-                      'GatesconfigDeviceUsersdatabase[validuntildate]': '',
-                      'GatesconfigDeviceUsersdatabase[ring_counter]': ''
-                      }
-
-            url = f'{BASE_URL}{adduser_post_url}'
-            response = self.user_session.post(url=url, data=params, headers=BASE_HEADERS.update(
-                {'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
-                 'Host': 'gates.eldesalarms.com',
-                 'Origin': 'https://gates.eldesalarms.com'}))
+            with self._form_lock:
+                if self.add_user_outputs is not None and not refresh:
+                    self.form_cache_hits += 1
+                else:
+                    self.form_cache_misses += 1
+                    options = dom.xpath(ADDUSER_CONTROLLER_ELEMENT)
+
+                    # Dictionary with option text as key and option value as value.
+                    self.add_user_outputs = {el.text: el.get('value')
+                                             for el in options if el is not None and el.text is not None}
+                outputs = self.add_user_outputs
+
+        return AddUserForm(adduser_post_url, outputs, token)
+
+    # https://gates.eldesalarms.com/en/gatesconfig/settings/users/ajax/1/device_id/50550/number/385.html
+    def add_user(self, user: User) -> bool:
+        try:
+            with self._add_lock:
+                form = self.get_add_user_form()
+                response = self._post_user(form, user)
+
+                # The cached outputs may be stale, or the session expired between
+                # getting the form and posting it, so get a fresh one and try once more
+                if response.status_code in STALE_FORM_STATUS_CODES:
+                    logging.info(
+                        f'Adding user {user.name} failed with status code {response.status_code}, refreshing the add user form')
+                    form = self.get_add_user_form(refresh=True)
+                    response = self._post_user(form, user)
 
             if response.status_code != HTTPStatus.OK:
                 raise ValueError(
@@ -235,9 +563,101 @@ class DeviceApi:
         except requests.exceptions.RequestException as e:
             logging.error(f'Error occurred while adding user: {e}')
             raise ValueError(
-                'Error occurred while adding user. See log for details.')
+                'Error occurred while adding user. See log for details.') from e
 
-    def get_logs(self, start: date, end: date) -> [LogEntry]:
+        return True
+
+    def _post_user(self, form: AddUserForm, user: User) -> requests.Response:
+        if user.output not in form.outputs:
+            raise ValueError(
+                f'Output {user.output} is not a valid output parameter. Valid values are {form.outputs.keys()}')
+
+        params = {'YII_CSRF_TOKEN': form.token or self.user_session.token,
+                  'GatesconfigDeviceUsersdatabase[phone]': user.phone,
+                  'GatesconfigDeviceUsersdatabase[user_name]': user.name,
+                  'GatesconfigDeviceUsersdatabase[app]': '1' if user.app_access else '0',
+                  'GatesconfigDeviceUsersdatabase[app_password]': user.phone[:-6],
+                  'GatesconfigDeviceUsersdatabase[output]': form.outputs[user.output],
+                  'GatesconfigDeviceUsersdatabase[schedulerList]': '',
+                  'GatesconfigDeviceUsersdatabase[validuntildate]': '',
+                  'GatesconfigDeviceUsersdatabase[ring_counter]': ''
+                  }
+
+        url = f'{BASE_URL}{form.action}'
+        return self.user_session.post(url=url, data=params, headers={
+            **BASE_HEADERS,
+            'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
+            'Host': 'gates.eldesalarms.com',
+            'Origin': 'https://gates.eldesalarms.com'})
+
+    # See iter_logs for the chunk and workers parameters
+    def get_logs(self, start: date, end: date, chunk: str | None = None,
+                 workers: int = DEFAULT_LOG_WORKERS) -> [LogEntry]:
+        return list(self.iter_logs(start, end, chunk, workers))
+
+    # As get_logs, but collected into a LogBatch, which takes a fraction of
+    # the memory of a list of LogEntry for long ranges
+    def get_log_batch(self, start: date, end: date, chunk: str | None = None,
+                      workers: int = DEFAULT_LOG_WORKERS) -> LogBatch:
+        return LogBatch(self.iter_logs(start, end, chunk, workers))
+
+    # Stream the log entries between start and end (inclusive), parsing each
+    # record as it is downloaded rather than holding the whole file in memory.
+    # If there is a log store, only the days it is missing are downloaded, and
+    # the entries are returned from the store in chronological order.
+    # If chunk is one of LOG_CHUNKS the range is split into chunks of that size,
+    # which are downloaded concurrently by up to `workers` threads.
+    def iter_logs(self, start: date, end: date, chunk: str | None = None,
+                  workers: int = DEFAULT_LOG_WORKERS) -> Iterator[LogEntry]:
+        def download(start: date, end: date) -> Iterator[LogEntry]:
+            if chunk is None:
+                return self.download_logs(start, end)
+            return self.download_logs_chunked(start, end, chunk, workers)
+
+        if self.log_store is None:
+            yield from download(start, end)
+            return
+
+        for missing_start, missing_end in self.log_store.missing_ranges(start, end):
+            self.log_store.replace(missing_start, missing_end,
+                                   download(missing_start, missing_end))
+        yield from self.log_store.query(start, end)
+
+    # Download the log entries between start and end (inclusive) in chunks,
+    # returning them in chronological order
+    def download_logs_chunked(self, start: date, end: date, chunk: str,
+                              workers: int = DEFAULT_LOG_WORKERS) -> Iterator[LogEntry]:
+        def download_chunk(chunk_start: date, chunk_end: date) -> [LogEntry]:
+            # Drop anything outside the chunk, so entries on the boundary of
+            # two chunks are only returned once
+            after_end = chunk_end + timedelta(days=1)
+            entries = [entry for entry in self.download_logs(chunk_start, chunk_end)
+                       if chunk_start <= entry.when.date() < after_end]
+            entries.sort(key=lambda entry: entry.when)
+            return entries
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        chunks = split_date_range(start, end, chunk)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            try:
+                # Keep at most `workers` chunks in flight, and yield them in order
+                for chunk_range in chunks:
+                    pending.append(executor.submit(download_chunk, *chunk_range))
+                    if len(pending) >= workers:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    # Download the log entries between start and end (inclusive). Records
+    # before `since` are skipped without being parsed.
+    def download_logs(self, start: date, end: date, since: datetime | None = None) -> Iterator[LogEntry]:
+        from bs4 import BeautifulSoup
+        from lxml import etree
 
         logging.info(f'Getting gate logs from {start} to {end} inclusive.')
 
@@ -248,53 +668,144 @@ class DeviceApi:
         request_url = LOG_FILE_URL.format(self.device_id, cache_buster, start.strftime(
             LOGAPI_DATE_FMT), end.strftime(LOGAPI_DATE_FMT))
 
-        headers = BASE_HEADERS
-        headers['Path'] = request_url
-        headers = headers.update(
-            {'X-Requested-With': 'XMLHttpRequest', 'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
-                self.device_id)})
+        headers = {**BASE_HEADERS,
+                   'Path': request_url,
+                   'X-Requested-With': 'XMLHttpRequest',
+                   'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(
+                       self.device_id)}
 
         # Request the log file link
         page = self.user_session.get(request_url, headers=headers)
-        soup = BeautifulSoup(page.content, "html5lib")
-        dom = etree.HTML(str(soup))
-        download_url = dom.xpath(dl_button)[0].attrib['href']
+        with self.metrics.time('parse_log_link_html5lib'):
+            soup = BeautifulSoup(page.content, "html5lib")
+        with self.metrics.time('parse_log_link_xpath'):
+            dom = etree.HTML(str(soup))
+            download_url = dom.xpath(dl_button)[0].attrib['href']
 
         # Download the log file from the URL
         log = self.user_session.get(
-            f"{BASE_URL}/{download_url}", headers=headers)
-
+            f"{BASE_URL}/{download_url}", headers=headers, stream=True)
+        try:
+            if log.encoding is None:
+                log.encoding = 'utf-8'
+            lines = log.iter_lines(decode_unicode=True)
+            if not self.metrics.enabled:
+                yield from DeviceApi.join_log_lines(lines, since)
+                return
+            # Downloading and parsing are interleaved, so they are timed together,
+            # excluding the time spent by the consumer between entries
+            entries = DeviceApi.join_log_lines(lines, since)
+            while True:
+                with self.metrics.time('log_stream'):
+                    entry = next(entries, None)
+                if entry is None:
+                    break
+                self.metrics.increment('log_entries')
+                yield entry
+        finally:
+            log.close()
+
+    # Join the two line records of a log file and parse them. If since is set,
+    # records before it are skipped by comparing their timestamp text, which
+    # sorts chronologically, so they are never parsed.
+    @staticmethod
+    def join_log_lines(lines: Iterable[str], since: datetime | None = None) -> Iterator[LogEntry]:
         # text looks like
         # 2023.09.23 20:08:56 Opened by user:18TVperson1(call
         # R:1):0871234567
-        lines_in = iter(log.text.splitlines())
-        log_entries = []
-        for line in lines_in:
-            log_entries.append(DeviceApi.parse_log_line(line + next(lines_in)))
-
-        return log_entries
-
-    def synchronize(self):
-        # Set a timeout value
-        timeout = 180  # seconds
-
-        # Using ThreadPoolExecutor to run the function with a timeout
-        with ThreadPoolExecutor() as executor:
-            future = executor.submit(self.sync_synchronize)
+        since = since.strftime(LOG_DATE_FORMAT) if since is not None else None
+        first = None
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line:
+                continue
+            if first is None:
+                first = line
+            else:
+                if since is None or first[:len(since)] >= since:
+                    yield DeviceApi.parse_log_line(first + line)
+                first = None
+        if first is not None:
+            logging.warning(f'Incomplete log record: {first}')
+            if since is None or first[:len(since)] >= since:
+                yield DeviceApi.parse_log_line(first)
+
+    # Synchronize the device, waiting up to timeout seconds for it to complete
+    def synchronize(self, timeout: float = SYNC_TIMEOUT_SECONDS, on_progress=None):
+        handle = self.start_synchronize(on_progress, progress_bar=True)
+        return handle.wait(timeout)
+
+    # Start synchronizing the device in the background, returning a SyncHandle
+    # to check on it. Nothing waits for the sync unless SyncHandle.wait is called.
+    def start_synchronize(self, on_progress=None, progress_bar: bool = False) -> 'SyncHandle':
+        handle = SyncHandle(self.device_id)
+
+        def run():
+            if not handle.future.set_running_or_notify_cancel():
+                return
             try:
-                result = future.result(timeout=SYNC_TIMEOUT_SECONDS)
-            except TimeoutError:
-                raise TimeoutError(
-                    'Unable to complete synchronization within {} seconds. It will continue in the background'.format(timeout))
-        return result
-
-    def sync_synchronize(self):
+                def progress(percentage_complete: int):
+                    handle.percentage = percentage_complete
+                    if on_progress is not None:
+                        on_progress(percentage_complete)
+                handle.future.set_result(self.sync_synchronize(
+                    progress, progress_bar=progress_bar, stop=handle.stop))
+            except BaseException as e:
+                handle.future.set_exception(e)
+
+        # A daemon thread, so exiting doesn't wait for the sync to complete
+        threading.Thread(target=run, name=f'sync-{self.device_id}', daemon=True).start()
+        return handle
+
+    # Synchronize the device, waiting until it is complete. If a sync is already
+    # running it is waited for instead of starting another. on_progress is
+    # called with the percentage complete each time it is checked. Setting the
+    # stop event stops waiting, and returns False.
+    def sync_synchronize(self, on_progress=None, progress_bar: bool = True,
+                         stop: threading.Event | None = None, poller: SyncPoller | None = None):
+        stop = stop or threading.Event()
+        bar = None
+        if progress_bar:
+            from progress.bar import Bar
+
+            bar = Bar('Synchronizing...', max=100)
+        steps = sync_steps(self.device_id, poller)
+        result = None
+        try:
+            while True:
+                step, value = steps.send(result)
+                result = None
+                if step is SyncStep.CHECK:
+                    result = self.sync_progress()
+                elif step is SyncStep.START:
+                    self.start_sync()
+                elif step is SyncStep.WAIT:
+                    with self.metrics.time('sync_wait'):
+                        if stop.wait(value):
+                            return False
+                    self.metrics.increment('sync_polls')
+                elif step is SyncStep.PROGRESS and on_progress is not None:
+                    on_progress(value)
+                if bar is not None and step in (SyncStep.RUNNING, SyncStep.PROGRESS):
+                    bar.index = value
+                    bar.update()
+        except StopIteration:
+            if bar is not None:
+                bar.finish()
+            return True
+        finally:
+            steps.close()
+
+    # Ask the portal to start synchronizing the device
+    def start_sync(self):
         try:
             sync_response = self.user_session.get(
-                SYNC_URL.format(self.device_id), headers=BASE_HEADERS.update(
-                    {'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
-                     'Host': 'gates.eldesalarms.com',
-                     'Origin': 'https://gates.eldesalarms.com'}))
+                SYNC_URL.format(self.device_id), headers={
+                    **BASE_HEADERS,
+                    'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
+                    'Host': 'gates.eldesalarms.com',
+                    'Origin': 'https://gates.eldesalarms.com'})
 
             if sync_response.status_code not in [HTTPStatus.OK, HTTPStatus.FOUND]:
                 raise ValueError(
@@ -303,40 +814,20 @@ class DeviceApi:
             logging.error(f'Error occurred while synchronizing: {e}')
             raise ValueError('Error occurred while synchronizing')
 
-        synced = False
-        bar = Bar('Synchronizing...', max=100)
-        bar.index = 0
-        bar.update()
-        time.sleep(SYNC_SLEEP_DURATION_SECONDS)
-        progress_response = None
-        while not synced:
-            try:
-                progress_response = self.user_session.get(
-                    SYNC_PROGRESS_URL.format(self.device_id), headers=BASE_HEADERS.update(
-                        {'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
-                         'Host': 'gates.eldesalarms.com',
-                         'Origin': 'https://gates.eldesalarms.com',
-                         'X-Requested-With': 'XMLHttpRequest'}))
-                # {"percentage":0,"stop":1,"state_string":"Downloading data"}
-
-            except requests.exceptions.RequestException as e:
-                logging.debug(
-                    f'Error occurred while synchronizing. Sync will still continue. Error: {e}')
-
-            if progress_response is not None:
-                percentage_complete = int(
-                    progress_response.json()["percentage"])
-                bar.index = percentage_complete
-                bar.update()
-                progress_response = None
-                if percentage_complete == 100:
-                    bar.finish()
-                    synced = True
-                else:
-                    time.sleep(SYNC_SLEEP_DURATION_SECONDS)
-                    bar.update()
-            else:
-                time.sleep(SYNC_SLEEP_DURATION_SECONDS)
-                bar.update()
-
-        return True
+    # The percentage of the synchronization that is complete, or None if the
+    # progress couldn't be read. The sync continues either way.
+    def sync_progress(self) -> int | None:
+        try:
+            progress_response = self.user_session.get(
+                SYNC_PROGRESS_URL.format(self.device_id), headers={
+                    **BASE_HEADERS,
+                    'Referer': 'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/{}'.format(self.device_id),
+                    'Host': 'gates.eldesalarms.com',
+                    'Origin': 'https://gates.eldesalarms.com',
+                    'X-Requested-With': 'XMLHttpRequest'})
+            # {"percentage":0,"stop":1,"state_string":"Downloading data"}
+            return int(progress_response.json()["percentage"])
+        except requests.exceptions.RequestException as e:
+            logging.debug(
+                f'Error occurred while synchronizing. Sync will still continue. Error: {e}')
+            return None
@@ -0,0 +1,83 @@
+from dataclasses import dataclass
+from enum import Enum
+import logging
+import threading
+import time
+import requests
+from .models import User
+
+
+# Number of users added concurrently by default
+DEFAULT_UPLOAD_WORKERS = 4
+
+
+class AddUserStatus(Enum):
+    ADDED = 'added'
+    # The portal refused the user, e.g. an invalid output
+    REJECTED = 'rejected'
+    # The request failed before the portal could answer
+    ERROR = 'error'
+
+
+@dataclass
+class AddUserResult:
+    user: User
+    status: AddUserStatus
+    reason: str | None = None
+
+    @property
+    def added(self) -> bool:
+        return self.status is AddUserStatus.ADDED
+
+
+class RateLimiter:
+    # Spaces calls to acquire() at least 1/rate seconds apart, across all threads
+
+    def __init__(self, rate: float | None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def add_user_result(api, user: User, limiter: RateLimiter | None = None) -> AddUserResult:
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        api.add_user(user)
+        return AddUserResult(user, AddUserStatus.ADDED)
+    except ValueError as e:
+        logging.error(f'Error occurred while adding user {user.name}: {e}')
+        if isinstance(e.__cause__, requests.exceptions.RequestException):
+            return AddUserResult(user, AddUserStatus.ERROR, str(e.__cause__))
+        return AddUserResult(user, AddUserStatus.REJECTED, str(e))
+
+
+# Add users to the device using up to `workers` threads, which share the
+# api's session (and its connection pool). `rate_limit` caps the number of
+# users added per second. Returns one result per user, in the input order.
+# The add user form only names a free slot, without reserving it, so
+# DeviceApi.add_user adds one user to a device at a time. More workers do
+# not make adds to one DeviceApi faster.
+def upload_users(api, users: [User], workers: int = DEFAULT_UPLOAD_WORKERS,
+                 rate_limit: float | None = None) -> [AddUserResult]:
+    limiter = RateLimiter(rate_limit)
+    users = list(users)
+    if workers <= 1 or len(users) <= 1:
+        return [add_user_result(api, user, limiter) for user in users]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(add_user_result, api, user, limiter)
+                   for user in users]
+        return [future.result() for future in futures]
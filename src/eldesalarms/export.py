@@ -0,0 +1,168 @@
+from dataclasses import fields
+from datetime import datetime
+from itertools import islice
+from operator import attrgetter
+from typing import Callable, Iterable, Iterator, TextIO, Union, get_args, get_origin, get_type_hints
+import csv
+import json
+import os
+import sqlite3
+import types
+
+
+# Formats records can be written in. parquet and arrow (Arrow IPC) need pyarrow.
+EXPORT_FORMATS = ('csv', 'ndjson', 'sqlite', 'parquet', 'arrow')
+# Formats written as text, which can go to stdout
+TEXT_FORMATS = ('csv', 'ndjson')
+ARROW_FORMATS = ('parquet', 'arrow')
+
+EXTENSION_FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+                     '.sqlite': 'sqlite', '.sqlite3': 'sqlite', '.db': 'sqlite',
+                     '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+# Number of records written at a time
+EXPORT_BATCH_SIZE = 5000
+# Buffer size of the files written
+EXPORT_BUFFER_SIZE = 1024 * 1024
+
+
+# The format to write file_name in: the one asked for, otherwise the one for
+# its extension, otherwise csv
+def export_format(file_name: str, format: str | None = None) -> str:
+    if format:
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown format {format}. Valid formats are {EXPORT_FORMATS}')
+        return format
+    return EXTENSION_FORMATS.get(os.path.splitext(file_name)[1].lower(), 'csv')
+
+
+def import_pyarrow(format: str):
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ValueError(f'The {format} format needs pyarrow to be installed') from e
+    return pyarrow
+
+
+def has_pyarrow() -> bool:
+    try:
+        import_pyarrow('arrow')
+    except ValueError:
+        return False
+    return True
+
+
+def batches(records: Iterable, size: int = EXPORT_BATCH_SIZE) -> Iterator[list]:
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
+
+
+# The field names of the record type, and a function returning the values of
+# a record as a tuple in the same order. Much cheaper than asdict per record.
+def record_fields(record_type) -> tuple[list[str], Callable]:
+    names = [f.name for f in fields(record_type)]
+    getter = attrgetter(*names)
+    return names, getter if len(names) > 1 else lambda record: (getter(record),)
+
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def sql_value(value):
+    return value.isoformat(sep=' ') if isinstance(value, datetime) else value
+
+
+def write_csv(records: Iterable, record_type, stream: TextIO, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    names, values = record_fields(record_type)
+    writer = csv.writer(stream)
+    writer.writerow(names)
+    count = 0
+    for batch in batches(records, batch_size):
+        writer.writerows(map(values, batch))
+        count += len(batch)
+    return count
+
+
+def write_ndjson(records: Iterable, record_type, stream: TextIO, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    names, values = record_fields(record_type)
+    encoder = json.JSONEncoder(ensure_ascii=False, default=json_value, separators=(',', ':'))
+    count = 0
+    for batch in batches(records, batch_size):
+        stream.write(''.join(encoder.encode(dict(zip(names, values(record)))) + '\n'
+                             for record in batch))
+        count += len(batch)
+    return count
+
+
+def write_sqlite(records: Iterable, record_type, path: str, table: str,
+                 batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    names, values = record_fields(record_type)
+    columns = ', '.join(f'"{name}"' for name in names)
+    insert = f'INSERT INTO "{table}" ({columns}) VALUES ({", ".join("?" * len(names))})'
+    connection = sqlite3.connect(path)
+    try:
+        count = 0
+        with connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+            for batch in batches(records, batch_size):
+                connection.executemany(
+                    insert, ([sql_value(value) for value in values(record)] for record in batch))
+                count += len(batch)
+        return count
+    finally:
+        connection.close()
+
+
+def arrow_type(pa, hint):
+    # int | None and Optional[int] are written as a nullable int
+    if get_origin(hint) in (Union, types.UnionType):
+        hint = next(arg for arg in get_args(hint) if arg is not type(None))
+    return {bool: pa.bool_(), int: pa.int64(), float: pa.float64(),
+            datetime: pa.timestamp('us')}.get(hint, pa.string())
+
+
+def arrow_schema(pa, record_type):
+    hints = get_type_hints(record_type)
+    return pa.schema([(f.name, arrow_type(pa, hints[f.name])) for f in fields(record_type)])
+
+
+# Write the records as Parquet (format 'parquet') or an Arrow IPC file
+# (format 'arrow'), one record batch per batch of records
+def write_arrow(records: Iterable, record_type, path: str, format: str = 'arrow',
+                batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    pa = import_pyarrow(format)
+    schema = arrow_schema(pa, record_type)
+    _, values = record_fields(record_type)
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    count = 0
+    try:
+        for batch in batches(records, batch_size):
+            columns = [list(column) for column in zip(*map(values, batch))]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+# Write the records, dataclasses of record_type, to file in format. file is
+# a text stream for the text formats, and a path otherwise. table is the
+# table written to in the sqlite format.
+def write_records(records: Iterable, record_type, file: str | TextIO, format: str,
+                  table: str = 'records', batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    if format == 'csv':
+        return write_csv(records, record_type, file, batch_size)
+    if format == 'ndjson':
+        return write_ndjson(records, record_type, file, batch_size)
+    if format == 'sqlite':
+        return write_sqlite(records, record_type, file, table, batch_size)
+    if format in ARROW_FORMATS:
+        return write_arrow(records, record_type, file, format, batch_size)
+    raise ValueError(f'Unknown format {format}. Valid formats are {EXPORT_FORMATS}')
@@ -0,0 +1,126 @@
+from datetime import date, datetime
+from typing import Callable, Iterator
+import json
+import logging
+import os
+import threading
+import requests
+from .models import LogEntry
+
+
+# Directory the high-water marks are kept in, one file per device
+DEFAULT_FOLLOW_STATE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'eldesalarms', 'follow')
+# Seconds between polls for new log entries
+DEFAULT_FOLLOW_INTERVAL = 60
+
+
+# The position of the last log entry seen: its time, and the (phone, who) of
+# every entry seen at that time, as several entries can share a second
+class HighWaterMark:
+
+    def __init__(self, when: datetime | None = None, keys: set[tuple[str, str]] | None = None):
+        self.when = when
+        self.keys = keys or set()
+
+    def is_new(self, entry: LogEntry) -> bool:
+        if self.when is None or entry.when > self.when:
+            return True
+        return entry.when == self.when and (entry.phone, entry.who) not in self.keys
+
+    def advance(self, entries: [LogEntry]):
+        for entry in entries:
+            if self.when is None or entry.when > self.when:
+                self.when, self.keys = entry.when, set()
+            if entry.when == self.when:
+                self.keys.add((entry.phone, entry.who))
+
+    def as_dict(self) -> dict:
+        return {'when': self.when.isoformat() if self.when else None,
+                'keys': sorted([phone, who] for phone, who in self.keys)}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'HighWaterMark':
+        when = state.get('when')
+        return cls(datetime.fromisoformat(when) if when else None,
+                   {(phone, who) for phone, who in state.get('keys', [])})
+
+
+# Polls the logs of a device for entries newer than the high-water mark. Each
+# poll downloads from the day of the mark to today, but only the records at or
+# after the mark are parsed. The mark is saved to state_dir after the entries
+# of a poll have been handled, so after a restart following carries on where
+# it left off; entries may be repeated if it stops part way through a poll,
+# but none are missed.
+class LogFollower:
+
+    def __init__(self, api, state_dir: str | None = DEFAULT_FOLLOW_STATE_DIR,
+                 interval: float = DEFAULT_FOLLOW_INTERVAL):
+        self.api = api
+        self.state_dir = state_dir
+        self.interval = interval
+        self.mark = self.load()
+        # Mark after the last poll, saved by commit()
+        self.pending = None
+
+    @property
+    def state_file(self) -> str | None:
+        if self.state_dir is None:
+            return None
+        return os.path.join(self.state_dir, f'{self.api.device_id}.json')
+
+    def load(self) -> HighWaterMark:
+        if self.state_file is None or not os.path.isfile(self.state_file):
+            return HighWaterMark()
+        try:
+            with open(self.state_file) as f:
+                return HighWaterMark.from_dict(json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning(f'Ignoring invalid follow state {self.state_file}: {e}')
+            return HighWaterMark()
+
+    def save(self):
+        if self.state_file is None:
+            return
+        os.makedirs(self.state_dir, exist_ok=True)
+        temp_file = f'{self.state_file}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'device_id': self.api.device_id, **self.mark.as_dict()}, f)
+        os.replace(temp_file, self.state_file)
+
+    # The entries newer than the mark, in chronological order. Without a mark
+    # that is every entry of today. The mark only moves on when commit() is called.
+    def poll(self, today: date | None = None) -> [LogEntry]:
+        today = today or date.today()
+        start = self.mark.when.date() if self.mark.when is not None else today
+        entries = [entry for entry in self.api.download_logs(start, today, since=self.mark.when)
+                   if self.mark.is_new(entry)]
+        entries.sort(key=lambda entry: entry.when)
+        self.pending = HighWaterMark(self.mark.when, set(self.mark.keys))
+        self.pending.advance(entries)
+        return entries
+
+    def commit(self):
+        if self.pending is not None:
+            self.mark, self.pending = self.pending, None
+            self.save()
+
+    # Yield new entries as they appear, polling every `interval` seconds until
+    # stop is set. Polls that fail are logged and tried again at the next interval.
+    def follow(self, stop: threading.Event | None = None) -> Iterator[LogEntry]:
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                entries = self.poll()
+            except (ValueError, requests.exceptions.RequestException) as e:
+                logging.warning(f'Unable to get the logs of device {self.api.device_id}: {e}')
+                entries = None
+            if entries is not None:
+                yield from entries
+                self.commit()
+            stop.wait(self.interval)
+
+    # As follow, calling on_entry with each new entry
+    def run(self, on_entry: Callable[[LogEntry], None], stop: threading.Event | None = None):
+        for entry in self.follow(stop):
+            on_entry(entry)
@@ -0,0 +1,166 @@
+from datetime import date, datetime, timedelta
+from itertools import islice
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterable, Iterator
+from .models import LogEntry
+
+
+DEFAULT_LOG_STORE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'eldesalarms', 'logs.sqlite3')
+
+# Timestamps are stored as text in this format, so they sort chronologically
+STORE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+STORE_DAY_FORMAT = '%Y-%m-%d'
+
+# Number of rows read from the store at a time
+QUERY_BATCH_SIZE = 1000
+# Number of downloaded rows staged at a time
+STAGE_BATCH_SIZE = 1000
+# Seconds to wait for another connection, e.g. another device's store in the
+# same file, to finish writing
+BUSY_TIMEOUT_SECONDS = 30
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS log_entries (
+    device_id INTEGER NOT NULL,
+    "when" TEXT NOT NULL,
+    who TEXT,
+    phone TEXT,
+    apt_no INTEGER
+);
+CREATE INDEX IF NOT EXISTS log_entries_when ON log_entries (device_id, "when");
+CREATE TABLE IF NOT EXISTS fetched_days (
+    device_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (device_id, day)
+);
+'''
+
+# Entries are downloaded into this table, which is private to the connection
+# and kept outside the database file, so the file is only locked for writing
+# once the download is complete
+STAGE_SCHEMA = '''
+CREATE TEMP TABLE IF NOT EXISTS staged_entries (
+    "when" TEXT NOT NULL,
+    who TEXT,
+    phone TEXT,
+    apt_no INTEGER
+);
+'''
+
+
+def as_date(value: date) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def day_range(start: date, end: date) -> Iterator[date]:
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+# Local store of the log entries of a device. Days before today are recorded
+# as fetched once downloaded, so they are only downloaded once. Today and
+# later days are still open, and are always downloaded again.
+class LogStore:
+
+    def __init__(self, path: str, device_id: int):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.connection.executescript(STAGE_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def fetched_days(self, start: date, end: date) -> set[date]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT day FROM fetched_days WHERE device_id = ? AND day BETWEEN ? AND ?',
+                (self.device_id, start.strftime(STORE_DAY_FORMAT), end.strftime(STORE_DAY_FORMAT)))
+            return {datetime.strptime(day, STORE_DAY_FORMAT).date() for (day,) in rows}
+
+    # The (start, end) ranges of days, inclusive, that still need to be downloaded
+    def missing_ranges(self, start: date, end: date, today: date | None = None) -> [tuple[date, date]]:
+        start, end = as_date(start), as_date(end)
+        today = today or date.today()
+        fetched = self.fetched_days(start, end)
+        ranges = []
+        for day in day_range(start, end):
+            if day in fetched and day < today:
+                continue
+            if ranges and ranges[-1][1] == day - timedelta(days=1):
+                ranges[-1] = (ranges[-1][0], day)
+            else:
+                ranges.append((day, day))
+        return ranges
+
+    # Replace the entries between start and end (inclusive) with the given
+    # entries, and record the days before today as fetched. The entries, which
+    # may still be downloading, are staged first, then moved into the store in
+    # one short transaction, so other stores on the same file are not blocked
+    # for the length of the download, and a failed download changes nothing.
+    def replace(self, start: date, end: date, entries: Iterable[LogEntry], today: date | None = None) -> int:
+        start, end = as_date(start), as_date(end)
+        today = today or date.today()
+        rows = ((entry.when.strftime(STORE_DATE_FORMAT), entry.who, entry.phone, entry.apt_no)
+                for entry in entries)
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM staged_entries')
+        while batch := list(islice(rows, STAGE_BATCH_SIZE)):
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    'INSERT INTO staged_entries ("when", who, phone, apt_no) VALUES (?, ?, ?, ?)', batch)
+
+        # The portal may return entries outside the range, e.g. the first of
+        # the next day, so only the entries in the range are moved
+        range_start = start.strftime(STORE_DAY_FORMAT)
+        range_end = (end + timedelta(days=1)).strftime(STORE_DAY_FORMAT)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM log_entries WHERE device_id = ? AND "when" >= ? AND "when" < ?',
+                (self.device_id, range_start, range_end))
+            count = self.connection.execute(
+                'INSERT INTO log_entries (device_id, "when", who, phone, apt_no) '
+                'SELECT ?, "when", who, phone, apt_no FROM staged_entries '
+                'WHERE "when" >= ? AND "when" < ? ORDER BY rowid',
+                (self.device_id, range_start, range_end)).rowcount
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO fetched_days (device_id, day) VALUES (?, ?)',
+                ((self.device_id, day.strftime(STORE_DAY_FORMAT))
+                 for day in day_range(start, min(end, today - timedelta(days=1)))))
+            self.connection.execute('DELETE FROM staged_entries')
+        logging.debug(
+            f'Stored {count} log entries for device {self.device_id} from {start} to {end}')
+        return count
+
+    # The stored entries between start and end (inclusive), in chronological order
+    def query(self, start: date, end: date) -> Iterator[LogEntry]:
+        start, end = as_date(start), as_date(end)
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT "when", who, phone, apt_no FROM log_entries '
+                'WHERE device_id = ? AND "when" >= ? AND "when" < ? ORDER BY "when", rowid',
+                (self.device_id, start.strftime(STORE_DAY_FORMAT),
+                 (end + timedelta(days=1)).strftime(STORE_DAY_FORMAT)))
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(QUERY_BATCH_SIZE)
+            if not rows:
+                break
+            for when, who, phone, apt_no in rows:
+                yield LogEntry(datetime.fromisoformat(when), who, phone, apt_no)
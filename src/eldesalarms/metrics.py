@@ -0,0 +1,186 @@
+from contextlib import nullcontext
+from urllib.parse import urlparse
+import bisect
+import json
+import os
+import re
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histogram buckets, as in Prometheus
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Prefix of the Prometheus metric names
+METRIC_PREFIX = 'eldesalarms'
+
+# Short names of the portal endpoints, found by searching the URL path
+ENDPOINTS = (
+    ('login', re.compile(r'/user/login')),
+    ('logout', re.compile(r'/user/logout')),
+    ('user_page', re.compile(r'GatesconfigDeviceUsersdatabase_page/')),
+    ('users', re.compile(r'/settings/configuration/device_id/')),
+    ('add_user_form', re.compile(r'/settings/users/ajax/1/device_id/\d+/tab/')),
+    ('add_user', re.compile(r'/settings/users/')),
+    ('remove_user', re.compile(r'/settings/usersdelete/')),
+    ('log_link', re.compile(r'/settings/getlog/')),
+    ('sync_start', re.compile(r'/settings/start/')),
+    ('sync_progress', re.compile(r'/settings/check')),
+)
+# Anything else is assumed to be the log file the log link points to
+OTHER_ENDPOINT = 'log_file'
+
+# The timer used when metrics are disabled, which does nothing
+NULL_TIMER = nullcontext()
+
+
+def endpoint_name(url: str) -> str:
+    path = urlparse(url).path
+    for name, pattern in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return OTHER_ENDPOINT
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Count of the observations in each bucket, the last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts))}
+
+
+class Timer:
+
+    def __init__(self, metrics: 'Metrics', phase: str):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.metrics.observe_phase(self.phase, time.perf_counter() - self.start)
+
+
+# Counts, bytes and latency histograms of the requests made to each endpoint,
+# latency histograms of each phase of the work (parsing, waiting for a sync,
+# ...) and plain counters. When disabled every method returns straight away,
+# so an instance can always be passed around.
+class Metrics:
+
+    def __init__(self, enabled: bool = True, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests: dict[str, Histogram] = {}
+        self.request_bytes: dict[str, int] = {}
+        self.request_errors: dict[str, int] = {}
+        self.phases: dict[str, Histogram] = {}
+        self.counters: dict[str, int] = {}
+
+    def observe_request(self, url: str, seconds: float, size: int = 0, error: bool = False):
+        if not self.enabled:
+            return
+        endpoint = endpoint_name(url)
+        with self.lock:
+            if endpoint not in self.requests:
+                self.requests[endpoint] = Histogram(self.buckets)
+            self.requests[endpoint].observe(seconds)
+            self.request_bytes[endpoint] = self.request_bytes.get(endpoint, 0) + size
+            if error:
+                self.request_errors[endpoint] = self.request_errors.get(endpoint, 0) + 1
+
+    def observe_phase(self, phase: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = Histogram(self.buckets)
+            self.phases[phase].observe(seconds)
+
+    # Context manager timing the with block as the phase
+    def time(self, phase: str):
+        return Timer(self, phase) if self.enabled else NULL_TIMER
+
+    def increment(self, counter: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                'requests': {endpoint: {**histogram.as_dict(),
+                                        'bytes': self.request_bytes.get(endpoint, 0),
+                                        'errors': self.request_errors.get(endpoint, 0)}
+                             for endpoint, histogram in sorted(self.requests.items())},
+                'phases': {phase: histogram.as_dict() for phase, histogram in sorted(self.phases.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    # The metrics in the Prometheus text exposition format, for the
+    # node_exporter textfile collector
+    def to_prometheus(self) -> str:
+        metrics = self.as_dict()
+        lines = []
+
+        def histogram(name: str, label: str, histograms: dict, help: str):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} histogram')
+            for value, data in histograms.items():
+                cumulative = 0
+                for bound, count in data['buckets'].items():
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {data["sum"]}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {data["count"]}')
+
+        def counter(name: str, label: str | None, values: dict, help: str):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in values.items():
+                lines.append(f'{name}{{{label}="{key}"}} {value}' if label else f'{name} {value}')
+
+        histogram(f'{METRIC_PREFIX}_request_seconds', 'endpoint', metrics['requests'],
+                  'Latency of the requests to the portal.')
+        counter(f'{METRIC_PREFIX}_request_bytes_total', 'endpoint',
+                {endpoint: data['bytes'] for endpoint, data in metrics['requests'].items()},
+                'Bytes received from the portal.')
+        counter(f'{METRIC_PREFIX}_request_errors_total', 'endpoint',
+                {endpoint: data['errors'] for endpoint, data in metrics['requests'].items()},
+                'Requests to the portal that failed.')
+        histogram(f'{METRIC_PREFIX}_phase_seconds', 'phase', metrics['phases'],
+                  'Time spent in each phase of the work.')
+        for name, value in metrics['counters'].items():
+            counter(f'{METRIC_PREFIX}_{name}_total', None, {name: value}, f'Number of {name.replace("_", " ")}.')
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to path, in the Prometheus text format if it ends in
+    # .prom, otherwise as JSON. The file is replaced in one step, so a
+    # collector never reads it half written.
+    def write(self, path: str):
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        if path == '-':
+            print(text)
+            return
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
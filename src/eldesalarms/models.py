@@ -0,0 +1,90 @@
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+
+@dataclass(slots=True)
+class User:
+    name: str
+    phone: str
+    output: str = ''
+    app_access: bool = True
+    password: str = field(init=False, default=None)
+    # Slot of the user on the device, used to edit or remove it
+    number: int | None = field(default=None, compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class LogEntry:
+    when: datetime
+    who: str
+    phone: str
+    apt_no: int | None
+
+
+@dataclass
+class AddUserForm:
+    # URL the new user form is posted to
+    action: str
+    # Output option text to option value
+    outputs: dict[str, str]
+    # CSRF token embedded in the form, if any
+    token: str | None = None
+
+
+# LogBatch timestamps are stored as microseconds since this time
+BATCH_EPOCH = datetime(1970, 1, 1)
+# LogBatch apartment number for entries without one
+NO_APT_NO = -1
+
+
+# Column-oriented store for a large number of log entries. Instead of an
+# object per entry it holds parallel arrays of timestamps, apartment numbers
+# and indexes into tables of the distinct who and phone strings, which repeat
+# for every entry of the same user. Indexing and iterating return LogEntry.
+class LogBatch:
+
+    def __init__(self, entries: Iterable[LogEntry] = ()):
+        self.timestamps = array('q')
+        self.apt_nos = array('q')
+        self.who_indexes = array('L')
+        self.phone_indexes = array('L')
+        self.strings: list[str] = []
+        self.string_indexes: dict[str, int] = {}
+        self.extend(entries)
+
+    def intern(self, value: str) -> int:
+        index = self.string_indexes.get(value)
+        if index is None:
+            index = self.string_indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def append(self, entry: LogEntry):
+        if entry.apt_no is not None and int(entry.apt_no) < 0:
+            raise ValueError(f'Apartment number must not be negative: {entry.apt_no}')
+        self.timestamps.append((entry.when - BATCH_EPOCH) // timedelta(microseconds=1))
+        self.apt_nos.append(NO_APT_NO if entry.apt_no is None else int(entry.apt_no))
+        self.who_indexes.append(self.intern(entry.who))
+        self.phone_indexes.append(self.intern(entry.phone))
+
+    def extend(self, entries: Iterable[LogEntry]):
+        for entry in entries:
+            self.append(entry)
+
+    def when(self, index: int) -> datetime:
+        return BATCH_EPOCH + timedelta(microseconds=self.timestamps[index])
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index: int) -> LogEntry:
+        apt_no = self.apt_nos[index]
+        return LogEntry(self.when(index), self.strings[self.who_indexes[index]],
+                        self.strings[self.phone_indexes[index]],
+                        None if apt_no == NO_APT_NO else apt_no)
+
+    def __iter__(self) -> Iterator[LogEntry]:
+        for index in range(len(self)):
+            yield self[index]
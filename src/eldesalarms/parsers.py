@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+import logging
+import re
+from .models import User
+
+
+USER_TABLE_CLASS = 'items table table-striped table-condensed'
+USER_TABLE_ELEMENT = f'//table[@class="{USER_TABLE_CLASS}"]'
+USER_NUMBER_PATTERN = re.compile(r'/number/(\d+)')
+LAST_PAGE_ELEMENT = '/html/body/div[1]/section/div[1]/div/div/div[4]/div/div[2]/div[5]/div/div[2]/ul/li[12]/a'
+
+
+@dataclass
+class UserPage:
+    users: list[User]
+    # Number of pages in the user grid, or None if the page has no pager
+    max_pages: int | None = None
+
+
+def page_no_from_url(url: str) -> int | None:
+    match = re.search(r'/(\d+)\.html$', url)
+    return int(match.group(1)) if match else None
+
+
+def cell_text(cell) -> str:
+    from lxml import etree
+
+    # lxml elements only expose the text before their first child in .text
+    if isinstance(cell, etree._Element):
+        return ''.join(cell.itertext())
+    return cell.text
+
+
+def row_to_user(data) -> User:
+    return User(cell_text(data[0]).strip(), cell_text(data[1]).strip(),
+                cell_text(data[2]).strip(), True)
+
+
+def number_from_links(hrefs) -> int | None:
+    # The edit and delete buttons of a row link to .../number/<number>...
+    for href in hrefs:
+        match = USER_NUMBER_PATTERN.search(href)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+class SoupUserPageParser:
+    # Parses user grid pages with BeautifulSoup and html5lib. This is slow, but
+    # the most forgiving with malformed markup.
+    name = 'html5lib'
+
+    def parse(self, content: bytes) -> UserPage:
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(content, "html5lib")
+        table = soup.find('table', class_=USER_TABLE_CLASS)
+        if table is None:
+            raise ValueError('Unable to find the user table in the page')
+        tbody = table.find('tbody')
+        users = []
+        for row in tbody.find_all('tr'):
+            user = row_to_user(row.find_all('td'))
+            user.number = number_from_links(
+                a['href'] for a in row.find_all('a', href=True))
+            users.append(user)
+
+        from lxml import etree
+
+        dom = etree.HTML(str(soup))
+        last_page = dom.xpath(LAST_PAGE_ELEMENT)
+        max_pages = page_no_from_url(
+            last_page[0].attrib["href"]) if last_page else None
+        return UserPage(users, max_pages)
+
+
+class LxmlUserPageParser:
+    # Parses user grid pages with a single lxml parse. The rows and the pager are
+    # read from the same tree. Falls back to html5lib if the table can't be found.
+    name = 'lxml'
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback if fallback is not None else SoupUserPageParser()
+
+    def parse(self, content: bytes) -> UserPage:
+        from lxml import etree
+
+        dom = etree.HTML(content)
+        tables = dom.xpath(USER_TABLE_ELEMENT) if dom is not None else []
+        if not tables:
+            logging.debug(
+                f'User table not found by lxml, falling back to {self.fallback.name}')
+            return self.fallback.parse(content)
+
+        # html5lib adds the implied tbody, lxml leaves the rows where they are
+        rows = tables[0].xpath('./tbody/tr | ./tr')
+        users = []
+        for row in rows:
+            user = row_to_user(row.xpath('./td'))
+            user.number = number_from_links(row.xpath('.//a/@href'))
+            users.append(user)
+
+        last_page = dom.xpath(LAST_PAGE_ELEMENT)
+        max_pages = page_no_from_url(
+            last_page[0].get("href", "")) if last_page else None
+        return UserPage(users, max_pages)
+
+
+PARSERS = {parser.name: parser for parser in (LxmlUserPageParser, SoupUserPageParser)}
+DEFAULT_PARSER = LxmlUserPageParser.name
+
+
+def get_user_page_parser(name: str = DEFAULT_PARSER):
+    if name not in PARSERS:
+        raise ValueError(
+            f'Unknown parser {name}. Valid values are {list(PARSERS.keys())}')
+    return PARSERS[name]()
@@ -0,0 +1,65 @@
+from dataclasses import dataclass, field
+import logging
+from typing import Iterable
+from .bulk import AddUserResult, upload_users, DEFAULT_UPLOAD_WORKERS
+from .models import User
+
+
+@dataclass
+class ReconcilePlan:
+    # Users in the input that are not on the device
+    to_add: list[User] = field(default_factory=list)
+    # Users on the device that are not in the input
+    to_remove: list[User] = field(default_factory=list)
+    # (device, input) pairs with the same phone but a different name or output
+    changed: list[tuple[User, User]] = field(default_factory=list)
+    unchanged: int = 0
+
+    def describe(self) -> [str]:
+        lines = [f'+ {user.name} {user.phone} {user.output}' for user in self.to_add]
+        lines += [f'- {user.name} {user.phone} {user.output}' for user in self.to_remove]
+        lines += [f'~ {current.name} {current.phone} {current.output} -> {desired.name} {desired.output}'
+                  for current, desired in self.changed]
+        lines.append(f'{len(self.to_add)} to add, {len(self.to_remove)} to remove, '
+                     f'{len(self.changed)} changed, {self.unchanged} unchanged')
+        return lines
+
+
+def index_by_phone(users: Iterable[User]) -> dict[str, User]:
+    index = {}
+    for user in users:
+        phone = user.phone.strip()
+        if phone in index:
+            logging.warning(
+                f'Duplicate phone {phone} for {index[phone].name} and {user.name}, ignoring {user.name}')
+            continue
+        index[phone] = user
+    return index
+
+
+# Compare the users on the device (which may be streamed from api.users) with
+# the desired users, keyed by phone number
+def plan_reconcile(current: Iterable[User], desired: Iterable[User]) -> ReconcilePlan:
+    current_index = index_by_phone(current)
+    plan = ReconcilePlan()
+    for phone, user in index_by_phone(desired).items():
+        existing = current_index.pop(phone, None)
+        if existing is None:
+            plan.to_add.append(user)
+        elif (existing.name, existing.output) != (user.name, user.output):
+            plan.changed.append((existing, user))
+        else:
+            plan.unchanged += 1
+    plan.to_remove = list(current_index.values())
+    return plan
+
+
+# Apply the plan to the device. Removes are only issued when remove is True.
+# Changed users are reported in the plan, but left as they are.
+def apply_plan(api, plan: ReconcilePlan, remove: bool = False, workers: int = DEFAULT_UPLOAD_WORKERS,
+               rate_limit: float | None = None) -> tuple[list[AddUserResult], list[User]]:
+    results = upload_users(api, plan.to_add, workers, rate_limit)
+    removed = []
+    if remove and plan.to_remove:
+        removed = api.remove_users(plan.to_remove, workers)
+    return results, removed
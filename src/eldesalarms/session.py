@@ -1,8 +1,15 @@
+from contextlib import contextmanager
 from http import HTTPStatus
-import urllib.request
+import hashlib
+import json
+import os
+import random
+import threading
+import time
 import urllib.parse
-import urllib.error
 import requests
+from requests.adapters import HTTPAdapter
+from .metrics import Metrics
 import ssl
 import re
 import logging
@@ -11,6 +18,30 @@ import logging
 LOGIN_URL = "https://gates.eldesalarms.com/en/user/login.html"
 LOGOUT_URL = "https://gates.eldesalarms.com/user/logout"
 
+# Requests that end up on this path were redirected to log in again
+LOGIN_PATH = '/user/login'
+
+# Methods that can always be retried
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Status codes of transient failures worth retrying
+RETRY_STATUS_CODES = (HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.BAD_GATEWAY,
+                      HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT)
+DEFAULT_MAX_RETRIES = 3
+# Retry n waits a random time up to min(BACKOFF_MAX, BACKOFF_FACTOR * 2 ** n) seconds
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_BACKOFF_MAX = 30
+
+# Connection pools kept (one per host) and connections kept per pool. Concurrent
+# requests beyond pool_maxsize open connections that are thrown away afterwards.
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+# (connect, read) timeout in seconds applied to requests that don't set one
+DEFAULT_TIMEOUT = (10, 60)
+
+# Directory the logged in sessions are cached in, one file per username
+DEFAULT_SESSION_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'eldesalarms', 'sessions')
+
 BASE_HEADERS = {'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',  # noqa: E501
                 'Accept-Encoding': 'gzip, deflate, br',
                 'Accept-Language': 'en-GB,en;q=0.9',
@@ -33,14 +64,216 @@ BASE_HEADERS = {'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9
 class UserSession(requests.Session):
 
     # default constructor
-    def __init__(self, username: str, password: str):
+    def __init__(self, username: str, password: str, cache_dir: str | None = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+                 pool_connections: int = DEFAULT_POOL_CONNECTIONS, pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 timeout: float | tuple[float, float] | None = DEFAULT_TIMEOUT,
+                 metrics: Metrics | None = None):
         super().__init__()
+        # Retries are handled by request(), so the adapter doesn't retry itself
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize, max_retries=0)
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+        self.timeout = timeout
         self.logged_in = False
         self.username = username
         self.password = password
         self.token = None
+        # If set, the cookies and token are saved here so later sessions can
+        # skip logging in, see resume()
+        self.cache_dir = cache_dir
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = DEFAULT_BACKOFF_MAX
+        self.retries = 0
+        self.relogins = 0
+        # Incremented on every login, so threads that find the session expired
+        # at the same time only log in again once
+        self.login_count = 0
+        self._login_lock = threading.Lock()
+        self._local = threading.local()
+        # Request and phase timings, shared with the DeviceApi using this
+        # session. Disabled unless a Metrics is passed in.
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+    # How many connections were opened for how many requests. Connections are
+    # reused when there are more requests than connections.
+    def connection_stats(self) -> dict[str, int]:
+        pools = self.adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        return {'connections_opened': sum(pool.num_connections for pool in pools),
+                'requests': sum(pool.num_requests for pool in pools)}
+
+    # Requests made while logging in or out are sent as they are
+    @contextmanager
+    def _raw_requests(self):
+        self._local.raw = True
+        try:
+            yield
+        finally:
+            self._local.raw = False
+
+    @staticmethod
+    def is_login_redirect(url: str, response: requests.Response) -> bool:
+        if LOGIN_PATH in url:
+            return False
+        location = response.headers.get('Location', '') if response.is_redirect else ''
+        return LOGIN_PATH in location or LOGIN_PATH in (response.url or '')
+
+    # Send the request, recording its latency and size in the metrics
+    def _send_request(self, method, url, *args, **kwargs) -> requests.Response:
+        if not self.metrics.enabled:
+            return super().request(method, url, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.observe_request(url, time.perf_counter() - start, error=True)
+            raise
+        size = response.headers.get('Content-Length')
+        if size is None and not kwargs.get('stream'):
+            size = len(response.content or b'')
+        self.metrics.observe_request(url, time.perf_counter() - start, int(size or 0),
+                                     error=response.status_code >= HTTPStatus.BAD_REQUEST)
+        return response
+
+    def backoff(self, attempt: int):
+        self.retries += 1
+        self.metrics.increment('retries')
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
+        logging.debug(f'Retrying in {delay:.2f}s')
+        time.sleep(delay)
+
+    def relogin(self, login_count: int):
+        with self._login_lock:
+            # Another thread may have logged in again already
+            if self.login_count == login_count:
+                logging.info('Session expired, logging in again')
+                self.relogins += 1
+                self.metrics.increment('relogins')
+                self.cookies.clear()
+                self.login()
+                self.save()
+
+    # Log in again if the session has expired, and retry transient failures with
+    # jittered exponential backoff. POSTs are only retried after logging in
+    # again (the portal didn't act on them), or if idempotent=True is passed.
+    def request(self, method, url, *args, idempotent: bool | None = None, **kwargs):
+        # A hung socket would otherwise block forever
+        if self.timeout is not None and kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        if getattr(self._local, 'raw', False) or not self.logged_in:
+            return self._send_request(method, url, *args, **kwargs)
+
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        relogged_in = False
+        while True:
+            login_count = self.login_count
+            try:
+                response = self._send_request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                logging.debug(f'{method} {url} failed: {e}')
+                self.backoff(attempt)
+                attempt += 1
+                continue
+
+            if not relogged_in and self.is_login_redirect(url, response):
+                response.close()
+                relogged_in = True
+                self.relogin(login_count)
+                # The form data carries the token of the expired session
+                data = kwargs.get('data')
+                if isinstance(data, dict) and 'YII_CSRF_TOKEN' in data:
+                    kwargs['data'] = {**data, 'YII_CSRF_TOKEN': self.token}
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and idempotent and attempt < self.max_retries:
+                logging.debug(f'{method} {url} failed with status code {response.status_code}')
+                response.close()
+                self.backoff(attempt)
+                attempt += 1
+                continue
+
+            return response
+
+    @property
+    def cache_file(self) -> str | None:
+        if self.cache_dir is None:
+            return None
+        name = hashlib.sha256(self.username.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{name}.json')
+
+    # Restore the cached session if it is still valid, otherwise login and
+    # cache the new session
+    def resume(self) -> bool:
+        if self.restore() and self.validate():
+            logging.debug('Resumed cached session')
+            self.logged_in = True
+            return True
+        self.cookies.clear()
+        self.token = None
+        self.login()
+        self.save()
+        return self.logged_in
+
+    def save(self):
+        if self.cache_file is None or not self.logged_in:
+            return
+        state = {'username': self.username,
+                 'token': self.token,
+                 'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                              'expires': c.expires, 'secure': c.secure} for c in self.cookies]}
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        # Only the current user may read the session
+        fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+
+    def restore(self) -> bool:
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file) as f:
+                state = json.load(f)
+            if state.get('username') != self.username:
+                return False
+            for c in state['cookies']:
+                self.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'],
+                                 expires=c['expires'], secure=c['secure'])
+            self.token = state['token']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Ignoring invalid session cache {self.cache_file}: {e}')
+            return False
+        return True
+
+    def clear_cache(self):
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            os.remove(self.cache_file)
+
+    # Check the restored session is still logged in. The login page redirects
+    # users that are already logged in, and shows the form to everyone else.
+    def validate(self) -> bool:
+        try:
+            r = super().get(LOGIN_URL, headers=BASE_HEADERS, allow_redirects=False)
+        except requests.exceptions.RequestException as e:
+            logging.debug(f'Unable to validate cached session: {e}')
+            return False
+        return r.status_code == HTTPStatus.FOUND
 
     def login(self) -> bool:
+        with self._raw_requests(), self.metrics.time('login'):
+            logged_in = self._login()
+        self.login_count += 1
+        return logged_in
+
+    def _login(self) -> bool:
 
         # Ignore SSL certificate errors
         ctx = ssl.create_default_context()
@@ -66,8 +299,8 @@ class UserSession(requests.Session):
                   'UserLogin[username]': self.username, 'UserLogin[password]': self.password}
         try:
             logged_in_page = super().post(
-                url=LOGIN_URL, data=params, headers=BASE_HEADERS.update({'Referer': LOGIN_URL, 'Host': 'gates.eldesalarms.com',
-                                                                         'Origin': 'https://gates.eldesalarms.com'}))
+                url=LOGIN_URL, data=params, headers={**BASE_HEADERS, 'Referer': LOGIN_URL, 'Host': 'gates.eldesalarms.com',
+                                                     'Origin': 'https://gates.eldesalarms.com'})
             logging.debug(
                 f'Session Id (Post-Login): {self.cookies.get("PHPSESSID")}')
 
@@ -89,8 +322,10 @@ class UserSession(requests.Session):
     def logout(self):
         if (self.logged_in):
             try:
-                super().get(LOGOUT_URL, headers=BASE_HEADERS)
+                with self._raw_requests():
+                    super().get(LOGOUT_URL, headers=BASE_HEADERS)
                 self.logged_in = False
+                self.clear_cache()
             except requests.exceptions.RequestException as e:
                 logging.error(f'Error occurred while logging out: {e}')
                 raise ValueError('Error occurred while logging out.')
@@ -0,0 +1,124 @@
+from dataclasses import dataclass, replace
+from operator import attrgetter
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from .models import User
+from .parsers import UserPage
+
+
+DEFAULT_USER_SNAPSHOT_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'eldesalarms', 'users.sqlite3')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_pages (
+    device_id INTEGER NOT NULL,
+    page_no INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    max_pages INTEGER,
+    users TEXT NOT NULL,
+    PRIMARY KEY (device_id, page_no)
+);
+'''
+
+# The fields a user row is compared on
+user_key = attrgetter('name', 'phone', 'output', 'app_access', 'number')
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def copy_page(page: UserPage) -> UserPage:
+    # Users are mutable, and the lists are consumed by UserIterator, so the
+    # snapshot never hands out or keeps the lists it is given
+    return UserPage([replace(user) for user in page.users], page.max_pages)
+
+
+@dataclass
+class UserRefresh:
+    users: list[User]
+    # Rows that are new, or differ from the snapshot
+    changed: list[User]
+    # Rows in the snapshot that are no longer on the device
+    removed: list[User]
+
+    @classmethod
+    def compare(cls, previous: [User], users: [User]) -> 'UserRefresh':
+        previous_keys = set(map(user_key, previous))
+        keys = set(map(user_key, users))
+        return cls(users, [user for user in users if user_key(user) not in previous_keys],
+                   [user for user in previous if user_key(user) not in keys])
+
+
+# The parsed user grid pages of a device, with a hash of the content each was
+# parsed from, so a page whose content has not changed is not parsed again.
+# Kept in memory, and also in a database at path so it lasts between runs.
+class UserSnapshot:
+
+    def __init__(self, path: str | None, device_id: int):
+        self.path = path
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        # page_no: (hash, page)
+        self.pages: dict[int, tuple[str, UserPage]] = {}
+        self.connection = None
+        if path is not None:
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+            rows = self.connection.execute(
+                'SELECT page_no, hash, max_pages, users FROM user_pages WHERE device_id = ?',
+                (device_id,))
+            for page_no, digest, max_pages, users in rows:
+                self.pages[page_no] = (digest, UserPage([User(*row) for row in json.loads(users)], max_pages))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    # The snapshot of the page, if it was taken from content with this hash
+    def page(self, page_no: int, digest: str) -> UserPage | None:
+        with self.lock:
+            stored = self.pages.get(page_no)
+        if stored is None or stored[0] != digest:
+            return None
+        return copy_page(stored[1])
+
+    def put(self, page_no: int, digest: str, page: UserPage):
+        page = copy_page(page)
+        with self.lock:
+            self.pages[page_no] = (digest, page)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO user_pages (device_id, page_no, hash, max_pages, users) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (self.device_id, page_no, digest, page.max_pages,
+                         json.dumps([user_key(user) for user in page.users])))
+
+    # Forget the pages after max_pages, which are no longer on the device
+    def truncate(self, max_pages: int):
+        with self.lock:
+            for page_no in [page_no for page_no in self.pages if page_no > max_pages]:
+                del self.pages[page_no]
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute(
+                        'DELETE FROM user_pages WHERE device_id = ? AND page_no > ?',
+                        (self.device_id, max_pages))
+
+    # Every user in the snapshot, in page order
+    def users(self) -> [User]:
+        with self.lock:
+            pages = [page for _, (_, page) in sorted(self.pages.items())]
+        return [replace(user) for page in pages for user in page.users]
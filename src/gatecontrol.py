@@ -1,13 +1,26 @@
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
-from eldesalarms.session import UserSession
-from eldesalarms.api import DeviceApi, User
+from eldesalarms.session import UserSession, DEFAULT_SESSION_CACHE_DIR, DEFAULT_POOL_MAXSIZE, DEFAULT_TIMEOUT
+from eldesalarms.api import DeviceApi, SyncHandle, User, LOG_CHUNKS, SYNC_TIMEOUT_SECONDS
+from eldesalarms.bulk import upload_users, DEFAULT_UPLOAD_WORKERS
+from eldesalarms.reconcile import plan_reconcile, apply_plan
+from eldesalarms.logstore import LogStore, DEFAULT_LOG_STORE_PATH
+from eldesalarms.usersnapshot import UserSnapshot, DEFAULT_USER_SNAPSHOT_PATH
+from eldesalarms.metrics import Metrics
+from eldesalarms.follow import LogFollower, DEFAULT_FOLLOW_STATE_DIR, DEFAULT_FOLLOW_INTERVAL
+from eldesalarms.models import LogEntry
+from eldesalarms.export import (write_records, export_format, has_pyarrow, EXPORT_FORMATS, TEXT_FORMATS,
+                                ARROW_FORMATS, EXPORT_BUFFER_SIZE)
 import logging
 import argparse
 import sys
 import os
 import csv
-from dataclasses import asdict
+import json
+import time
+
+# Number of devices worked on concurrently by default
+DEFAULT_PARALLEL_DEVICES = 4
 
 
 def setup_logging(verbosity):
@@ -37,14 +50,15 @@ class UploadAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         nosync = getattr(namespace, 'nosync', False)
         if nosync is not False and not values:
-            parser.error("--nosync can only be used with --upload")
+            parser.error("--nosync can only be used with --upload or --remove")
         setattr(namespace, self.dest, values)
 
 
 class Stream():
-    def __init__(self, file_name: str, write: bool = False):
+    def __init__(self, file_name: str, write: bool = False, buffering: int = -1):
         self.file_name = file_name
         self.mode = 'w' if write else 'r'
+        self.buffering = buffering
         self.file = None
 
     def __enter__(self):
@@ -65,7 +79,7 @@ class Stream():
                 return None
         elif self.mode == 'w' and not os.path.exists(self.file_name):
             try:
-                self.file = open(self.file_name, mode=self.mode)
+                self.file = open(self.file_name, mode=self.mode, buffering=self.buffering)
             except (IOError, PermissionError) as e:
                 logging.error(f"Error opening file {self.file_name}: {e}")
                 return None
@@ -81,6 +95,210 @@ class Stream():
             self.file.close()
 
 
+# Device IDs from the command line, each either an ID or a file of IDs (one per
+# line, blank lines and lines starting with # are ignored)
+def read_devices(values: str | list[str]) -> [int]:
+    if isinstance(values, (str, int)):
+        values = [values]
+    devices = []
+    for value in map(str, values):
+        if value.isdigit():
+            devices.append(int(value))
+        elif os.path.isfile(value):
+            with open(value) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        if not line.isdigit():
+                            raise ValueError(f'Invalid device ID {line} in {value}')
+                        devices.append(int(line))
+        else:
+            raise ValueError(f'{value} is not a device ID or a file of device IDs')
+    # Keep the order, but only work on each device once
+    return list(dict.fromkeys(devices))
+
+
+# The file to write a device's output to. When there is more than one device
+# {device} in the file name is replaced by the device ID, or the ID is added
+# before the extension.
+def device_file(file_name: str, device: int, devices: [int]) -> str:
+    if len(devices) == 1 or file_name == '-':
+        return file_name
+    if '{device}' in file_name:
+        return file_name.replace('{device}', str(device))
+    root, ext = os.path.splitext(file_name)
+    return f'{root}-{device}{ext}'
+
+
+# Write the records (User or LogEntry) to file_name in the given format, or
+# the one for its extension. Text formats go through Stream, so "-" is stdout;
+# the others are written to the path, which must not already exist.
+def write_output(records, record_type, file_name: str, format: str | None, table: str) -> int:
+    format = export_format(file_name, format)
+    if format in TEXT_FORMATS:
+        with Stream(file_name, True, EXPORT_BUFFER_SIZE) as stream:
+            return write_records(records, record_type, stream, format)
+    if file_name == '-':
+        raise ValueError(f'The {format} format can not be written to stdout')
+    if os.path.exists(file_name):
+        raise ValueError(f'File {file_name} already exists')
+    return write_records(records, record_type, file_name, format, table)
+
+
+# Run func for each device, at most `parallel` at a time, returning the
+# result or the exception raised for each device, in order
+def run_devices(devices: [int], func, parallel: int = DEFAULT_PARALLEL_DEVICES):
+    def run(device):
+        try:
+            return func(device)
+        except Exception as e:
+            logging.error(f'Error occurred on device {device}: {e}')
+            return e
+
+    if len(devices) == 1 or parallel <= 1:
+        return [(device, run(device)) for device in devices]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(zip(devices, executor.map(run, devices)))
+
+
+# Wait for the synchronizations started in the background on each device,
+# all within one timeout, returning the exception raised for each device
+# whose synchronization failed. Those that time out are cancelled, so they
+# stop checking on the device.
+def wait_for_syncs(syncs: [(int, SyncHandle)], timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    errors = {}
+    for device, handle in syncs:
+        try:
+            handle.wait(max(0, deadline - time.monotonic()))
+        except Exception as e:
+            logging.error(f'Error occurred synchronizing device {device}: {e}')
+            errors[device] = e
+            if isinstance(e, TimeoutError):
+                handle.cancel()
+    return errors
+
+
+def run_device(session: UserSession, device: int, devices: [int], args, users: [User],
+               start: datetime | None, end: datetime | None, syncs: list | None = None) -> str:
+    api = DeviceApi(session, device)
+
+    # With several devices, synchronize them all in the background instead of
+    # waiting for each in turn
+    def synchronize():
+        if syncs is None:
+            api.synchronize(timeout=args.sync_timeout)
+        else:
+            syncs.append((device, api.start_synchronize()))
+
+    if args.user_snapshot:
+        api.user_snapshot = UserSnapshot(args.user_snapshot, device)
+
+    if args.download:
+        print(f"Downloading Users from device {device}")
+        if args.changed:
+            refresh = api.refresh_users(prefetch=args.prefetch)
+            count = write_output(refresh.changed, User,
+                                 device_file(args.download, device, devices), args.format, 'users')
+            return f'Downloaded {count} changed of {len(refresh.users)} Users, {len(refresh.removed)} removed'
+        count = write_output(api.iter_users(prefetch=args.prefetch), User,
+                             device_file(args.download, device, devices), args.format, 'users')
+        return f'Downloaded {count} Users'
+
+    if args.upload:
+        print(f"Uploading Users to device {device}")
+        message = ''
+        if args.reconcile:
+            plan = plan_reconcile(api.iter_users(prefetch=args.prefetch), users)
+            for line in plan.describe():
+                print(line)
+            if args.dry_run:
+                return plan.describe()[-1]
+            results, removed = apply_plan(api, plan, remove=args.remove_missing,
+                                          workers=args.workers, rate_limit=args.rate_limit)
+            if args.remove_missing:
+                message = f', removed {len(removed)} of {len(plan.to_remove)} Users'
+        else:
+            results = upload_users(api, users, workers=args.workers,
+                                   rate_limit=args.rate_limit)
+        failed = [result for result in results if not result.added]
+        for result in failed:
+            print(
+                f'Unable to add {result.user.name} ({result.status.value}): {result.reason}')
+
+        if failed and args.failed:
+            with Stream(device_file(args.failed, device, devices), True) as stream:
+                csv_writer = csv.writer(stream)
+                csv_writer.writerow(['name', 'phone', 'output', 'app_access'])
+                for result in failed:
+                    user = result.user
+                    csv_writer.writerow(
+                        [user.name, user.phone, user.output, user.app_access])
+
+        if not args.nosync:
+            synchronize()
+        return f'Uploaded {len(results) - len(failed)} of {len(results)} Users{message}'
+
+    if args.remove:
+        print(f"Removing Users from device {device}")
+        removed = api.remove_users(users, workers=args.workers)
+        if not args.nosync:
+            synchronize()
+        return f'Removed {len(removed)} of {len(users)} Users'
+
+    if (args.logs or args.stats) and args.log_store:
+        api.log_store = LogStore(args.log_store, device)
+
+    if args.logs:
+        file = args.logs[0][0]
+        count = write_output(api.iter_logs(start, end, args.chunk, args.workers), LogEntry,
+                             device_file(file, device, devices), args.format, 'log_entries')
+        return f'Downloaded {count} log entries'
+
+    if args.stats:
+        # NumPy is only needed for --stats
+        from eldesalarms.analytics import LogColumns
+
+        file = args.stats[0][0]
+        columns = LogColumns(api.get_log_batch(start, end, args.chunk, args.workers))
+        phones = []
+        if args.inactive_since:
+            phones = [user.phone for user in api.iter_users(prefetch=args.prefetch)]
+        summary = columns.summary(args.inactive_since, phones)
+        with Stream(device_file(file, device, devices), True) as stream:
+            json.dump(summary, stream, indent=2)
+        return f'Summarized {len(columns)} log entries'
+
+    if args.follow:
+        follower = LogFollower(api, args.follow_state, args.follow_interval)
+        count = 0
+        try:
+            for entry in follower.follow():
+                write_records([entry], LogEntry, sys.stdout, 'ndjson')
+                sys.stdout.flush()
+                count += 1
+        except KeyboardInterrupt:
+            pass
+        return f'Followed {count} log entries'
+
+    if args.sync:
+        synchronize()
+        return 'Synchronized'
+
+    return 'Nothing to do'
+
+
+# Log out, unless the session is cached for the next run
+def close_session(session: UserSession, session_cache: str | None):
+    logging.info(f'Connections: {session.connection_stats()}')
+    if session_cache:
+        session.save()
+    else:
+        session.logout()
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="gates.eldesalarms.com data management utility.",
@@ -89,21 +307,74 @@ def main():
                         help='username of the account used to login into gates.eldesalarms.com.')
     parser.add_argument("password", type=str,
                         help='password for account used to login into gates.eldesalarms.com.')
-    parser.add_argument("device", type=int,
-                        help='ID of device to perform the operations on.')
+    parser.add_argument("device", nargs='+',
+                        help='IDs of the devices to perform the operations on, or files listing one device ID per line.')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--download", metavar='FILE',
                        help='Download all users details to FILE. Use "-" for stdout')
     group.add_argument("--upload", action=UploadAction,
                        help='Upload users details from FILE. Use "-" for stdin', metavar='FILE')
+    group.add_argument("--remove", action=UploadAction,
+                       help='Remove the users in FILE (matched by phone) from the device. Use "-" for stdin', metavar='FILE')
 
     group.add_argument("--logs", nargs=3, action="append",
-                       help='Download Log entries between START and END (inclusive) to FILE. Use "-" for stdout. Dates must be in YYYY-MM-DD',
+                       help='Download Log entries between START and END (inclusive) to FILE. Use "-" for stdout. Dates must be in YYYYMMDD',
                        metavar=('FILE', 'START', 'END'))
+    group.add_argument("--stats", nargs=3, action="append",
+                       help='Write counts per day, apartment, hour and weekday, and when each phone was first and last seen, for the log entries between START and END (inclusive) to FILE as JSON. Use "-" for stdout. Dates must be in YYYYMMDD',
+                       metavar=('FILE', 'START', 'END'))
+    group.add_argument("--follow", action="store_true",
+                       help='Write new Log entries to stdout as NDJSON as they appear, until interrupted. '
+                            'The last entry written is remembered, so the next run carries on from it.')
     group.add_argument("--sync", action="store_true",
                        help='Synchronize data to device.')
 
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default=None,
+                        help='Format to write --download and --logs output in. By default it is chosen from the extension of FILE, or csv. '
+                             f'{" and ".join(ARROW_FORMATS)} need pyarrow to be installed.')
+    parser.add_argument("--nosync", action="store_true",
+                        help='Do not synchronize the device after uploading users.')
+    parser.add_argument("--reconcile", action="store_true",
+                        help='Only upload the users in FILE that are not already on the device (matched by phone).')
+    parser.add_argument("--remove-missing", action="store_true",
+                        help='With --reconcile, also remove users on the device that are not in FILE.')
+    parser.add_argument("--dry-run", action="store_true",
+                        help='With --reconcile, print the changes without making them.')
+    parser.add_argument("--workers", type=int, default=DEFAULT_UPLOAD_WORKERS,
+                        help='Number of users to remove, or log chunks to download, concurrently. Users are added to a device one at a time, whatever this is.')
+    parser.add_argument("--rate-limit", type=float, default=None, metavar='USERS_PER_SECOND',
+                        help='Maximum number of users to upload per second.')
+    parser.add_argument("--failed", metavar='FILE', default=None,
+                        help='Write the users that could not be uploaded to FILE, in the upload format.')
+    parser.add_argument("--log-store", nargs='?', const=DEFAULT_LOG_STORE_PATH, default=None, metavar='PATH',
+                        help=f'With --logs, keep downloaded logs in a local database at PATH ({DEFAULT_LOG_STORE_PATH} if omitted) and only download the days it is missing.')
+    parser.add_argument("--user-snapshot", nargs='?', const=DEFAULT_USER_SNAPSHOT_PATH, default=None, metavar='PATH',
+                        help=f'Keep the users downloaded in a local database at PATH ({DEFAULT_USER_SNAPSHOT_PATH} if omitted) and only parse the user pages that changed since.')
+    parser.add_argument("--changed", action="store_true",
+                        help='With --download and --user-snapshot, only write the users added or changed since the snapshot.')
+    parser.add_argument("--chunk", choices=LOG_CHUNKS, default=None,
+                        help='With --logs, download the range in chunks of this size, --workers at a time.')
+    parser.add_argument("--inactive-since", type=lambda value: datetime.strptime(value, "%Y%m%d"), default=None, metavar='DATE',
+                        help='With --stats, also list the phones, including users on the device, not seen since DATE (YYYYMMDD).')
+    parser.add_argument("--follow-interval", type=float, default=DEFAULT_FOLLOW_INTERVAL, metavar='SECONDS',
+                        help='With --follow, seconds between checks for new Log entries.')
+    parser.add_argument("--follow-state", default=DEFAULT_FOLLOW_STATE_DIR, metavar='DIR',
+                        help='With --follow, directory the last Log entry written for each device is kept in.')
+    parser.add_argument("--session-cache", nargs='?', const=DEFAULT_SESSION_CACHE_DIR, default=None, metavar='DIR',
+                        help=f'Keep the logged in session in DIR ({DEFAULT_SESSION_CACHE_DIR} if omitted) and reuse it on the next run instead of logging in again.')
+    parser.add_argument("--timeout", type=float, default=None, metavar='SECONDS',
+                        help='Seconds to wait for the portal to respond before giving up on a request. '
+                             f'By default {DEFAULT_TIMEOUT[0]} seconds to connect and {DEFAULT_TIMEOUT[1]} to read.')
+    parser.add_argument("--sync-timeout", type=float, default=SYNC_TIMEOUT_SECONDS, metavar='SECONDS',
+                        help='Seconds to wait for a synchronization to complete.')
+    parser.add_argument("--metrics", metavar='FILE', default=None,
+                        help='Record request and phase timings and write them to FILE at the end of the run, in the Prometheus text format if FILE ends in .prom, otherwise as JSON. Use "-" for stdout.')
+    parser.add_argument("--parallel", type=int, default=DEFAULT_PARALLEL_DEVICES,
+                        help='Number of devices to work on concurrently.')
+    parser.add_argument("--prefetch", type=int, default=0, metavar='PAGES',
+                        help='Number of user pages to fetch ahead of the one being downloaded.')
+
     # Add the verbose argument
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase verbosity. Can be specified multiple times.')
@@ -114,9 +385,9 @@ def main():
 
     setup_logging(args.verbose)
 
-    if args.logs:
+    if args.logs or args.stats:
         date_format = "%Y%m%d"
-        file, arg_start, arg_end = args.logs[0]
+        file, arg_start, arg_end = (args.logs or args.stats)[0]
         start = None
         end = None
 
@@ -133,30 +404,33 @@ def main():
                 "Unable to parse end date. Format should be YYYYMMDD.")
             exit(1)
 
-    session = UserSession(args.username, args.password)
-    if (session.login()):
-        api = DeviceApi(session, args.device)
-    else:
+    try:
+        devices = read_devices(args.device)
+    except ValueError as e:
+        parser.error(str(e))
+    output = args.download or ((args.logs or args.stats) and file)
+    if len(devices) > 1 and (output == '-' or args.follow):
+        parser.error('Output to stdout is only supported for a single device.')
+    if (args.download or args.logs) and export_format(output, args.format) in ARROW_FORMATS and not has_pyarrow():
+        parser.error(f'The {export_format(output, args.format)} format needs pyarrow to be installed.')
+    if args.changed and not args.user_snapshot:
+        parser.error('--changed needs --user-snapshot.')
+
+    # Keep a pooled connection for every concurrent request
+    metrics = Metrics() if args.metrics else None
+    session = UserSession(args.username, args.password,
+                          cache_dir=args.session_cache,
+                          timeout=args.timeout if args.timeout is not None else DEFAULT_TIMEOUT,
+                          pool_maxsize=max(DEFAULT_POOL_MAXSIZE, args.workers * args.parallel, args.prefetch),
+                          metrics=metrics)
+    if not (session.resume() if args.session_cache else session.login()):
         logging.error(
             f'Unable to login to Eldes Alarms with username {args.username}. Please check your credentials')
         exit(1)
 
-    if args.download:
-        print("Downloading Users")
-        with Stream(args.download, True) as stream:
-            csv_writer = csv.writer(stream)
-            header = User.__annotations__.keys()
-            csv_writer.writerow(header)
-            count = 0
-            for user in api.users:
-                count += 1
-                row = asdict(user)
-                csv_writer.writerow(row.values())
-            print(f'Downloaded {count} Users')
-
+    # The input is read once, and used for every device
+    users: list[User] = []
     if args.upload:
-        print("Uploading Users")
-        added_users: list[User] = []
         with Stream(args.upload) as stream:
             # Using DictReader to read rows into dictionaries
             reader = csv.DictReader(stream)
@@ -164,21 +438,39 @@ def main():
                 # Convert app_access string boolean to actual boolean
                 row['app_access'] = row['app_access'].lower() == 'true'
                 # Initialize User instance with the row data
-                user = User(**row)
-                if api.add_user(user):
-                    added_users.append(user)
-            if not args.nosync:
-                api.synchronize()
-
-    if args.logs:
-        with Stream(file, True) as stream:
-            for entry in api.get_logs(start, end):
-                stream.write(str(entry))
-
-    if args.sync:
-        api.synchronize()
-
-    session.logout()
+                users.append(User(**row))
+    if args.remove:
+        with Stream(args.remove) as stream:
+            users = [User(name=row.get('name', ''), phone=row['phone'])
+                     for row in csv.DictReader(stream)]
+
+    syncs = [] if len(devices) > 1 else None
+
+    def run(device: int) -> str:
+        return run_device(session, device, devices, args, users,
+                          start if args.logs or args.stats else None,
+                          end if args.logs or args.stats else None, syncs)
+
+    results = run_devices(devices, run, args.parallel)
+    if syncs:
+        sync_errors = wait_for_syncs(syncs, args.sync_timeout)
+        results = [(device, sync_errors.get(device, result)) for device, result in results]
+
+    failures = 0
+    for device, result in results:
+        if isinstance(result, Exception):
+            failures += 1
+            print(f'Device {device}: failed - {result}')
+        else:
+            print(f'Device {device}: ok - {result}')
+    if len(devices) > 1:
+        print(f'{len(devices) - failures} of {len(devices)} devices succeeded')
+
+    close_session(session, args.session_cache)
+    if metrics is not None:
+        metrics.write(args.metrics)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
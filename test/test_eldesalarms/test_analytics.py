@@ -0,0 +1,63 @@
+import unittest
+from datetime import date, datetime
+import numpy as np
+from eldesalarms.analytics import LogColumns, PhoneActivity
+from eldesalarms.models import LogBatch, LogEntry
+
+
+class TestLogColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = LogColumns.from_entries([
+            # A Saturday
+            LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 23, 20, 30), '18TVPerson2', '0871234560', 18),
+            LogEntry(datetime(2023, 9, 23, 9, 0), 'Cleaner', '0871234568', None),
+            LogEntry(datetime(2023, 9, 24, 8, 15), '18TVPerson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 24, 20, 0), '3TVPerson3', '0871234569', 3),
+        ])
+
+    def test_counts_per_day(self):
+        self.assertEqual(self.columns.counts_per_day(),
+                         [(date(2023, 9, 23), 3), (date(2023, 9, 24), 2)])
+
+    def test_counts_per_apartment_per_day(self):
+        self.assertEqual(self.columns.counts_per_apartment_per_day(), [
+            (date(2023, 9, 23), None, 1),
+            (date(2023, 9, 23), 18, 2),
+            (date(2023, 9, 24), 3, 1),
+            (date(2023, 9, 24), 18, 1),
+        ])
+
+    def test_histograms(self):
+        hours = self.columns.hour_histogram()
+        self.assertEqual(len(hours), 24)
+        self.assertEqual(hours[20], 3)
+        self.assertEqual(hours.sum(), 5)
+        self.assertEqual(self.columns.weekday_histogram().tolist(), [0, 0, 0, 0, 0, 3, 2])
+
+    def test_phone_activity(self):
+        activity = self.columns.phone_activity()
+        self.assertEqual(activity['0871234567'], PhoneActivity(
+            '0871234567', datetime(2023, 9, 23, 20, 8, 56), datetime(2023, 9, 24, 8, 15), 2))
+        self.assertEqual(len(activity), 4)
+
+    def test_inactive_phones(self):
+        self.assertEqual(self.columns.inactive_phones(date(2023, 9, 24), ['0871234567', '0870000000']),
+                         ['0870000000', '0871234560', '0871234568'])
+
+    def test_empty(self):
+        columns = LogColumns(LogBatch())
+        self.assertEqual(columns.counts_per_apartment_per_day(), [])
+        self.assertEqual(columns.phone_activity(), {})
+        self.assertEqual(columns.summary()['per_hour'], [0] * 24)
+
+    def test_entries_before_epoch(self):
+        columns = LogColumns.from_entries(
+            [LogEntry(datetime(1969, 12, 31, 23, 30), 'who', '0871234567', 1)])
+        self.assertEqual(columns.counts_per_day(), [(date(1969, 12, 31), 1)])
+        self.assertEqual(np.flatnonzero(columns.hour_histogram()).tolist(), [23])
+
+
+if __name__ == '__main__':
+    unittest.main()
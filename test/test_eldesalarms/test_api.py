@@ -1,10 +1,13 @@
+import os
 import re
+import threading
+import time
 import unittest
 from unittest import mock
 from unittest.mock import PropertyMock, patch, Mock, call
-from eldesalarms.session import UserSession
-from eldesalarms.api import DeviceApi, LogEntry, User
-from datetime import datetime, date
+from eldesalarms.session import UserSession, BASE_HEADERS
+from eldesalarms.api import DeviceApi, LogEntry, User, SyncPoller, SyncStatus, SyncStep, sync_steps, split_date_range, SYNC_MIN_SLEEP_DURATION_SECONDS
+from datetime import datetime, date, timedelta
 
 users_page_html_str = (
     "<html>"
@@ -104,6 +107,101 @@ class TestDeviceApi(unittest.TestCase):
         self.assertEqual(users[0].phone, 'Phone1')
         self.assertEqual(users[0].output, 'output')
 
+    @patch.object(UserSession, 'get')
+    def test_users_prefetch(self, mock_get):
+        # Three pages, each page's users named after the page they came from
+        first_page = users_page_html_str.replace(
+            'configDeviceUsersdatabase_page/1.html', 'configDeviceUsersdatabase_page/3.html')
+
+        def get_page(url, headers=None):
+            match = re.search(r'GatesconfigDeviceUsersdatabase_page/(\d+)\.html', url)
+            page_no = match.group(1) if match else '1'
+            mock_response = Mock()
+            mock_response.content = first_page.replace(
+                '>User', f'>P{page_no}User').encode('utf-8')
+            return mock_response
+
+        mock_get.side_effect = get_page
+
+        users = list(self.device_api.iter_users(prefetch=2, workers=2))
+        self.assertEqual(len(users), 30)
+        self.assertEqual([u.name for u in users[::10]],
+                         ['P1User1', 'P2User1', 'P3User1'])
+        self.assertEqual(users[-1].name, 'P3User10')
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch.object(UserSession, 'get')
+    def test_users_prefetch_closed(self, mock_get):
+        first_page = users_page_html_str.replace(
+            'configDeviceUsersdatabase_page/1.html', 'configDeviceUsersdatabase_page/5.html')
+
+        def get_page(url, headers=None):
+            if 'page/3.html' in url:
+                raise ValueError('Page 3 failed')
+            return Mock(content=first_page.encode('utf-8'))
+
+        mock_get.side_effect = get_page
+
+        # A page that fails stops the prefetching
+        users = self.device_api.iter_users(prefetch=2, workers=2)
+        with self.assertRaises(ValueError):
+            list(users)
+        self.assertIsNone(users.executor)
+        self.assertEqual(len(users.pending), 0)
+
+        # So does leaving a with block part way through
+        with self.device_api.iter_users(prefetch=2, workers=2) as users:
+            executor = users.executor
+            next(users)
+        self.assertIsNone(users.executor)
+        self.assertTrue(executor._shutdown)
+
+    @patch.object(UserSession, 'get')
+    @patch.object(UserSession, 'post')
+    def test_remove_users(self, mock_post, mock_get):
+        # Give each row a delete button linking to its number on the device
+        page = users_page_html_str
+        for i in range(10, 0, -1):
+            page = page.replace(
+                '<td>output</td></tr>', f'<td>output</td><td><a href="/usersdelete/ajax/1/device_id/1/number/{300 + i}/tab/1.html">x</a></td></tr>', 1)
+        mock_get_response = Mock()
+        mock_get_response.content = page.encode('utf-8')
+        mock_get.return_value = mock_get_response
+
+        mock_post_response = Mock()
+        mock_post_response.status_code = 200
+        mock_post.return_value = mock_post_response
+
+        users = [User('User2', 'Phone2'), User('User5', 'Phone5'), User('Nobody', 'Phone99')]
+        removed = self.device_api.remove_users(users, workers=2)
+
+        # The numbers are resolved from a single pass over the user grid
+        mock_get.assert_called_once()
+        self.assertEqual([user.name for user in removed], ['User2', 'User5'])
+        self.assertEqual([user.number for user in removed], [309, 306])
+        urls = sorted(c.kwargs['url'] for c in mock_post.call_args_list)
+        self.assertEqual(urls, [
+            'https://gates.eldesalarms.com/en/gatesconfig/settings/usersdelete/ajax/1/device_id/1/number/306/tab/1.html?ajax=gatesconfig-device-usersdatabase-grid',  # noqa: E501
+            'https://gates.eldesalarms.com/en/gatesconfig/settings/usersdelete/ajax/1/device_id/1/number/309/tab/1.html?ajax=gatesconfig-device-usersdatabase-grid'])  # noqa: E501
+        self.assertEqual(mock_post.call_args.kwargs['data'], {'YII_CSRF_TOKEN': 'test_token'})
+        # Each removal sends its own copy of the headers, leaving the shared ones as they were
+        for c in mock_post.call_args_list:
+            self.assertEqual(c.kwargs['headers']['X-Requested-With'], 'XMLHttpRequest')
+            self.assertEqual(c.kwargs['headers']['Referer'],
+                             'https://gates.eldesalarms.com/gatesconfig/settings/configuration/device_id/1')
+        self.assertNotIn('X-Requested-With', BASE_HEADERS)
+        self.assertNotIn('Referer', BASE_HEADERS)
+
+    @patch.object(UserSession, 'post')
+    def test_remove_user_failure(self, mock_post):
+        mock_post_response = Mock()
+        mock_post_response.status_code = 500
+        mock_post.return_value = mock_post_response
+
+        user = User('User1', 'Phone1', number=301)
+        self.assertFalse(self.device_api.remove_user(user))
+        mock_post.assert_called_once()
+
     def test_parse_log_line(self):
         # Test the parse_log_line method with a sample log line
         line = '2023.09.23 20:08:56 Opened by user:18TVName(callR:1):0871234567'
@@ -114,6 +212,26 @@ class TestDeviceApi(unittest.TestCase):
         self.assertEqual(log_entry.phone, '0871234567')
         self.assertEqual(log_entry.apt_no, 18)
 
+    def test_parse_log_line_without_user(self):
+        # Entries without a user used to fail with an unbound apt_no
+        log_entry = DeviceApi.parse_log_line('2023.09.23 20:08:56 Opened by phone(callR:1):0871234567')
+        self.assertEqual(log_entry, LogEntry(when=datetime(2023, 9, 23, 20, 8, 56),
+                                             who=None, phone='0871234567', apt_no=None))
+
+        log_entry = DeviceApi.parse_log_line('2023.09.23 20:08:56 Opened by user:Cleaner(callR:1):0871234567')
+        self.assertEqual(log_entry.who, 'Cleaner')
+        self.assertIsNone(log_entry.apt_no)
+
+        with self.assertRaises(ValueError):
+            DeviceApi.parse_log_line('Opened by user:18TVName(callR:1):0871234567')
+
+    def test_parse_log_lines(self):
+        lines = ['2023.09.23 20:08:56 Opened by user:18TVName(callR:1):0871234567',
+                 '2023.12.31 23:59:59 Opened by user:97TV Person3(callR:1):0870000003']
+        entries = list(DeviceApi.parse_log_lines(lines))
+        self.assertEqual(entries[1], LogEntry(when=datetime(2023, 12, 31, 23, 59, 59),
+                                              who='97TV Person3', phone='0870000003', apt_no=97))
+
     @patch.object(UserSession, 'get')
     @patch.object(UserSession, 'post')
     def test_add_user_successful(self, mock_post, mock_get):
@@ -132,6 +250,71 @@ class TestDeviceApi(unittest.TestCase):
         self.device_api.add_user(user)
         mock_post.assert_called_once()
 
+    @patch.object(UserSession, 'get')
+    @patch.object(UserSession, 'post')
+    def test_add_user_form_cached(self, mock_post, mock_get):
+        mock_get_response = Mock()
+        mock_get_response.content = add_user_form.encode('utf-8')
+        mock_get.return_value = mock_get_response
+
+        mock_post_response = Mock()
+        mock_post_response.status_code = 200
+        mock_post.return_value = mock_post_response
+
+        users = [User(name=f'TestUser{i}', phone=f'123456789{i}', output='TestOutput')
+                 for i in range(3)]
+        self.assertEqual(self.device_api.add_users(users), users)
+
+        # The form is fetched for every user, but its outputs are only parsed once
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(self.device_api.form_cache_misses, 1)
+        self.assertEqual(self.device_api.form_cache_hits, 2)
+        self.assertEqual(mock_post.call_args.kwargs['url'],
+                         'https://gates.eldesalarms.com/action_url')
+        self.assertEqual(
+            mock_post.call_args.kwargs['data']['GatesconfigDeviceUsersdatabase[output]'], '1')
+
+    @patch.object(UserSession, 'get')
+    @patch.object(UserSession, 'post')
+    def test_add_users_to_different_slots(self, mock_post, mock_get):
+        # The form posts to the slot that is free when it is served
+        forms = []
+        for number in (372, 373):
+            response = Mock()
+            response.content = add_user_form.replace(
+                '/action_url', f'/en/gatesconfig/settings/users/ajax/1/device_id/50550/number/{number}.html').encode('utf-8')
+            forms.append(response)
+        mock_get.side_effect = forms
+        mock_post.return_value = Mock(status_code=200)
+
+        users = [User(name=f'TestUser{i}', phone=f'123456789{i}', output='TestOutput')
+                 for i in range(2)]
+        self.assertEqual(self.device_api.add_users(users), users)
+        self.assertEqual([c.kwargs['url'] for c in mock_post.call_args_list],
+                         ['https://gates.eldesalarms.com/en/gatesconfig/settings/users/ajax/1/device_id/50550/number/372.html',
+                          'https://gates.eldesalarms.com/en/gatesconfig/settings/users/ajax/1/device_id/50550/number/373.html'])
+
+    @patch.object(UserSession, 'get')
+    @patch.object(UserSession, 'post')
+    def test_add_user_stale_form_refreshed(self, mock_post, mock_get):
+        mock_get_response = Mock()
+        mock_get_response.content = add_user_form.encode('utf-8')
+        mock_get.return_value = mock_get_response
+
+        # The first post is rejected because of a stale CSRF token
+        stale_response = Mock()
+        stale_response.status_code = 400
+        ok_response = Mock()
+        ok_response.status_code = 200
+        mock_post.side_effect = [stale_response, ok_response]
+
+        user = User(name='TestUser', phone='1234567890', output='TestOutput')
+        self.assertTrue(self.device_api.add_user(user))
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(self.device_api.form_cache_misses, 2)
+
     @patch.object(UserSession, 'get')
     def test_get_logs(self, mock_get):
         # Set up the mock responses
@@ -144,6 +327,9 @@ class TestDeviceApi(unittest.TestCase):
         mock_response2 = Mock()
         mock_response2.text = '2023.09.23 20:08:56 Opened by user:18TVperson1(call\nR:1):0871234567\n' \
                               '2023.09.23 20:09:56 Opened by user:18TVperson2(call\nR:1):0871234568\n'
+        mock_response2.iter_lines.return_value = iter(
+            mock_response2.text.encode('utf-8').splitlines())
+        mock_response2.encoding = None
         mock_response2.status_code = 200
 
         # Set the side effect of the mock_get to iterate over the mock responses
@@ -170,6 +356,10 @@ class TestDeviceApi(unittest.TestCase):
         # Assert the log entries returned by get_logs match the expected entries
         self.assertEqual(log_entries, expected_entries)
 
+        # The log file is streamed, and closed once read
+        self.assertTrue(mock_get.call_args_list[1].kwargs['stream'])
+        mock_response2.close.assert_called_once()
+
         # Assert the mock_get method was called with the correct arguments
         first_get = mock_get.call_args_list[0]
         url_called = first_get.args[0]
@@ -177,6 +367,199 @@ class TestDeviceApi(unittest.TestCase):
         self.assertTrue(re.match(expected_url_regex, url_called),
                         f"Expected call to match {expected_url_regex}, but got {url_called}")
 
+    def test_join_log_lines(self):
+        with open(os.path.join(os.path.dirname(__file__), '..', 'gate_access_log.txt')) as f:
+            lines = f.read().splitlines()
+
+        entries = list(DeviceApi.join_log_lines(iter(lines + [''])))
+        self.assertEqual(len(entries), len(lines) // 2)
+        self.assertEqual(entries[0], LogEntry(when=datetime(2023, 9, 23, 20, 8, 56),
+                                              who='18TVPerson1', phone='0870000001', apt_no=18))
+
+    def test_join_log_lines_since(self):
+        with open(os.path.join(os.path.dirname(__file__), '..', 'gate_access_log.txt')) as f:
+            lines = f.read().splitlines()
+        entries = list(DeviceApi.join_log_lines(iter(lines)))
+        since = entries[len(entries) // 2].when
+
+        with mock.patch.object(DeviceApi, 'parse_log_line', wraps=DeviceApi.parse_log_line) as parse:
+            newer = list(DeviceApi.join_log_lines(iter(lines), since))
+        self.assertEqual(newer, [entry for entry in entries if entry.when >= since])
+        # Records before since are never parsed
+        self.assertEqual(parse.call_count, len(newer))
+
+    def test_split_date_range(self):
+        self.assertEqual(split_date_range(date(2023, 1, 30), date(2023, 3, 2), 'month'),
+                         [(date(2023, 1, 30), date(2023, 1, 31)),
+                          (date(2023, 2, 1), date(2023, 2, 28)),
+                          (date(2023, 3, 1), date(2023, 3, 2))])
+        self.assertEqual(split_date_range(datetime(2023, 1, 1), datetime(2023, 1, 10), 'week'),
+                         [(date(2023, 1, 1), date(2023, 1, 7)), (date(2023, 1, 8), date(2023, 1, 10))])
+        self.assertEqual(len(split_date_range(date(2023, 1, 1), date(2023, 1, 10), 'day')), 10)
+        with self.assertRaises(ValueError):
+            split_date_range(date(2023, 1, 1), date(2023, 1, 10), 'year')
+
+    def test_get_logs_chunked(self):
+        def download_logs(start, end):
+            # The portal includes the first entry of the next day in each chunk
+            entries = []
+            day = start
+            while day <= end + timedelta(days=1):
+                entries.append(LogEntry(datetime(day.year, day.month, day.day, 9), '18TV', '0871234567', 18))
+                entries.append(LogEntry(datetime(day.year, day.month, day.day, 8), '18TV', '0871234567', 18))
+                day += timedelta(days=1)
+            return iter(entries)
+
+        self.device_api.download_logs = Mock(side_effect=download_logs)
+        entries = self.device_api.get_logs(date(2023, 9, 1), date(2023, 9, 10), chunk='week', workers=2)
+
+        self.assertEqual(self.device_api.download_logs.call_count, 2)
+        self.assertEqual(len(entries), 20)
+        self.assertEqual([entry.when for entry in entries],
+                         sorted(entry.when for entry in entries))
+        self.assertEqual(entries[-1].when, datetime(2023, 9, 10, 9))
+
+    def test_sync_poller(self):
+        poller = SyncPoller(min_interval=1, max_interval=10)
+        self.assertEqual(poller.next_interval(0, now=0), 1)
+        # 10% a second, so 8s to go, check again in 4s
+        self.assertEqual(poller.next_interval(20, now=2), 4)
+        # Nearly done, but never checked more often than min_interval
+        self.assertEqual(poller.next_interval(90, now=9), 1)
+        # No progress reported, back off
+        self.assertEqual(poller.next_interval(None), 2)
+        self.assertEqual(poller.next_interval(None), 4)
+
+        # A slow sync is still checked at least every max_interval seconds
+        poller = SyncPoller(min_interval=1, max_interval=10)
+        poller.next_interval(0, now=0)
+        self.assertEqual(poller.next_interval(1, now=10), 10)
+
+    def test_sync_steps(self):
+        steps = sync_steps(1, SyncPoller(1, 1))
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        # The last sync is complete, so a new one is started
+        self.assertEqual(steps.send(100), (SyncStep.START, None))
+        self.assertEqual(next(steps), (SyncStep.RUNNING, 0))
+        self.assertEqual(next(steps), (SyncStep.WAIT, 1))
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        self.assertEqual(steps.send(None), (SyncStep.WAIT, 1))
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        self.assertEqual(steps.send(40), (SyncStep.PROGRESS, 40))
+        self.assertEqual(next(steps), (SyncStep.WAIT, 1))
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        self.assertEqual(steps.send(100), (SyncStep.PROGRESS, 100))
+        with self.assertRaises(StopIteration) as stopped:
+            next(steps)
+        self.assertTrue(stopped.exception.value)
+
+        # A sync that is already running is attached to
+        steps = sync_steps(1)
+        next(steps)
+        self.assertEqual(steps.send(30), (SyncStep.RUNNING, 30))
+
+    def test_sync_steps_stale_completion(self):
+        steps = sync_steps(1, SyncPoller(1, 1))
+        next(steps)
+        self.assertEqual(steps.send(100), (SyncStep.START, None))
+        next(steps)
+        next(steps)
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        # Straight after starting, 100% is still the last sync
+        self.assertEqual(steps.send(100), (SyncStep.WAIT, 1))
+        self.assertEqual(next(steps), (SyncStep.CHECK, None))
+        self.assertEqual(steps.send(10), (SyncStep.PROGRESS, 10))
+        next(steps)
+        next(steps)
+        self.assertEqual(steps.send(100), (SyncStep.PROGRESS, 100))
+
+        # Once the grace period is over, 100% means the new sync is complete
+        steps = sync_steps(1, SyncPoller(1, 1), start_grace=0)
+        next(steps)
+        steps.send(100)
+        next(steps)
+        next(steps)
+        next(steps)
+        self.assertEqual(steps.send(100), (SyncStep.PROGRESS, 100))
+
+    @patch('progress.bar.Bar')
+    def test_sync_synchronize(self, mock_bar):
+        self.device_api.start_sync = Mock()
+        self.device_api.sync_progress = Mock(side_effect=[100, 50, 100])
+        stop = Mock(**{'wait.return_value': False})
+        progress = []
+
+        self.assertTrue(self.device_api.sync_synchronize(on_progress=progress.append, stop=stop))
+        self.device_api.start_sync.assert_called_once()
+        self.assertEqual(progress, [50, 100])
+        # The first check is after SYNC_MIN_SLEEP_DURATION_SECONDS, not 10s
+        self.assertEqual(stop.wait.call_args_list[0].args[0], SYNC_MIN_SLEEP_DURATION_SECONDS)
+
+    @patch('progress.bar.Bar')
+    def test_sync_synchronize_already_running(self, mock_bar):
+        self.device_api.start_sync = Mock()
+        self.device_api.sync_progress = Mock(side_effect=[30, 100])
+        stop = Mock(**{'wait.return_value': False})
+
+        self.assertTrue(self.device_api.sync_synchronize(stop=stop))
+        self.device_api.start_sync.assert_not_called()
+
+    def test_start_synchronize(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def sync_synchronize(on_progress, progress_bar, stop):
+            on_progress(50)
+            started.set()
+            finish.wait(5)
+            return True
+        self.device_api.sync_synchronize = Mock(side_effect=sync_synchronize)
+
+        # Returns straight away, with the sync running in the background
+        handle = self.device_api.start_synchronize()
+        started.wait(5)
+        self.assertEqual(handle.status(), SyncStatus.RUNNING)
+        self.assertEqual(handle.percentage, 50)
+        with self.assertRaises(TimeoutError):
+            handle.wait(0.01)
+
+        finish.set()
+        self.assertTrue(handle.wait(5))
+        self.assertEqual(handle.status(), SyncStatus.COMPLETED)
+
+    def test_start_synchronize_cancel(self):
+        self.device_api.start_sync = Mock()
+        self.device_api.sync_progress = Mock(return_value=10)
+
+        handle = self.device_api.start_synchronize()
+        handle.cancel()
+        self.assertEqual(handle.status(), SyncStatus.CANCELLED)
+        self.assertFalse(handle.wait(5))
+
+    def test_start_synchronize_cancel_before_started(self):
+        self.device_api.sync_synchronize = Mock(return_value=True)
+
+        # The handle is cancelled before its thread gets to run
+        with patch.object(threading.Thread, 'start'):
+            handle = self.device_api.start_synchronize()
+        handle.cancel()
+        self.assertFalse(handle.wait(5))
+        self.assertEqual(handle.status(), SyncStatus.CANCELLED)
+        self.device_api.sync_synchronize.assert_not_called()
+
+    def test_start_synchronize_cancel_after_completed(self):
+        self.device_api.sync_synchronize = Mock(return_value=True)
+
+        handle = self.device_api.start_synchronize()
+        self.assertTrue(handle.wait(5))
+        handle.cancel()
+        self.assertEqual(handle.status(), SyncStatus.COMPLETED)
+
+    def test_synchronize_timeout(self):
+        self.device_api.sync_synchronize = Mock(side_effect=lambda *args, **kwargs: time.sleep(1))
+        with self.assertRaises(TimeoutError):
+            self.device_api.synchronize(timeout=0.01)
+
 # Add more test methods to cover other methods and branches in the DeviceApi class
 
     @patch.object(UserSession, 'get')
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import Mock, patch
+import requests
+from eldesalarms.bulk import AddUserStatus, RateLimiter, upload_users
+from eldesalarms.models import User
+
+
+class TestUploadUsers(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [User(name=f'User{i}', phone=f'087000000{i}', output='All')
+                      for i in range(6)]
+
+    @staticmethod
+    def add_user(user):
+        # User1 is rejected by the portal, User2 fails with a transport error
+        if user.name == 'User1':
+            raise ValueError('Output All is not a valid output parameter.')
+        if user.name == 'User2':
+            try:
+                raise requests.exceptions.ConnectionError('Connection reset')
+            except requests.exceptions.RequestException as e:
+                raise ValueError('Error occurred while adding user.') from e
+        return True
+
+    def test_results_per_user(self):
+        api = Mock()
+        api.add_user.side_effect = self.add_user
+
+        results = upload_users(api, self.users, workers=3)
+
+        self.assertEqual([result.user for result in results], self.users)
+        self.assertEqual([result.status for result in results],
+                         [AddUserStatus.ADDED, AddUserStatus.REJECTED, AddUserStatus.ERROR,
+                          AddUserStatus.ADDED, AddUserStatus.ADDED, AddUserStatus.ADDED])
+        self.assertEqual(results[2].reason, 'Connection reset')
+        self.assertEqual(api.add_user.call_count, 6)
+
+    def test_serial_upload(self):
+        api = Mock()
+        api.add_user.side_effect = self.add_user
+
+        results = upload_users(api, self.users, workers=1)
+        self.assertEqual(sum(result.added for result in results), 4)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    @patch('eldesalarms.bulk.time')
+    def test_acquire_spaces_calls(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        limiter = RateLimiter(2)
+
+        for _ in range(3):
+            limiter.acquire()
+
+        # The first call goes straight through, the others wait 0.5s per slot
+        self.assertEqual([c.args[0] for c in mock_time.sleep.call_args_list], [0.5, 1.0])
+
+    @patch('eldesalarms.bulk.time')
+    def test_no_limit(self, mock_time):
+        limiter = RateLimiter(None)
+        limiter.acquire()
+        mock_time.sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
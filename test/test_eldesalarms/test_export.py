@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from eldesalarms.export import export_format, has_pyarrow, write_records
+from eldesalarms.models import LogEntry, User
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.entries = [
+            LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 23, 20, 9, 56), 'Cleaner', '0871234568', None),
+            LogEntry(datetime(2023, 9, 24, 8, 0), '3TVPerson2', '0871234569', 3),
+        ]
+        self.directory = tempfile.mkdtemp()
+
+    def path(self, name: str) -> str:
+        path = os.path.join(self.directory, name)
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        return path
+
+    def test_export_format(self):
+        self.assertEqual(export_format('logs.jsonl'), 'ndjson')
+        self.assertEqual(export_format('logs.PARQUET'), 'parquet')
+        self.assertEqual(export_format('-'), 'csv')
+        self.assertEqual(export_format('logs.txt', 'sqlite'), 'sqlite')
+        with self.assertRaises(ValueError):
+            export_format('logs.txt', 'xml')
+
+    def test_csv(self):
+        stream = io.StringIO()
+        users = [User('Person1', '0871234567', 'Gate'), User('Person2', '0871234568')]
+        self.assertEqual(write_records(iter(users), User, stream, 'csv', batch_size=1), 2)
+        self.assertEqual(stream.getvalue().splitlines(), [
+            'name,phone,output,app_access,password,number',
+            'Person1,0871234567,Gate,True,,',
+            'Person2,0871234568,,True,,',
+        ])
+
+    def test_ndjson(self):
+        stream = io.StringIO()
+        self.assertEqual(write_records(iter(self.entries), LogEntry, stream, 'ndjson', batch_size=2), 3)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(rows[1], {'when': '2023-09-23T20:09:56', 'who': 'Cleaner',
+                                   'phone': '0871234568', 'apt_no': None})
+        self.assertEqual(len(rows), 3)
+
+    def test_sqlite(self):
+        path = self.path('logs.sqlite')
+        self.assertEqual(write_records(iter(self.entries), LogEntry, path, 'sqlite', 'log_entries', 2), 3)
+        with sqlite3.connect(path) as connection:
+            rows = connection.execute('SELECT "when", who, phone, apt_no FROM log_entries').fetchall()
+        connection.close()
+        self.assertEqual(rows[0], ('2023-09-23 20:08:56', '18TVPerson1', '0871234567', 18))
+        self.assertEqual(len(rows), 3)
+
+    @unittest.skipUnless(has_pyarrow(), 'pyarrow is not installed')
+    def test_arrow_formats(self):
+        import pyarrow.ipc
+        import pyarrow.parquet
+        path = self.path('logs.parquet')
+        self.assertEqual(write_records(iter(self.entries), LogEntry, path, 'parquet', batch_size=2), 3)
+        self.assertEqual(pyarrow.parquet.read_table(path).to_pylist()[1],
+                         {'when': datetime(2023, 9, 23, 20, 9, 56), 'who': 'Cleaner',
+                          'phone': '0871234568', 'apt_no': None})
+
+        path = self.path('logs.arrow')
+        self.assertEqual(write_records(iter(self.entries), LogEntry, path, 'arrow', batch_size=2), 3)
+        with pyarrow.ipc.open_file(path) as reader:
+            self.assertEqual(reader.num_record_batches, 2)
+            self.assertEqual(reader.read_all().column('apt_no').to_pylist(), [18, None, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date, datetime
+from unittest.mock import Mock
+from eldesalarms.follow import HighWaterMark, LogFollower
+from eldesalarms.models import LogEntry
+
+
+first = LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0870000001', 18)
+second = LogEntry(datetime(2023, 9, 23, 20, 9, 10), '76TVPerson2', '0870000002', 76)
+# Seen in the same second as second
+third = LogEntry(datetime(2023, 9, 23, 20, 9, 10), '97TVPerson3', '0870000003', 97)
+fourth = LogEntry(datetime(2023, 9, 24, 7, 0), '18TVPerson1', '0870000001', 18)
+
+
+class TestHighWaterMark(unittest.TestCase):
+
+    def test_is_new(self):
+        mark = HighWaterMark()
+        self.assertTrue(mark.is_new(first))
+        mark.advance([first, second])
+        self.assertFalse(mark.is_new(first))
+        self.assertFalse(mark.is_new(second))
+        self.assertTrue(mark.is_new(third))
+        self.assertTrue(mark.is_new(fourth))
+
+    def test_advance(self):
+        mark = HighWaterMark()
+        mark.advance([first, second, third])
+        self.assertEqual(mark.when, second.when)
+        self.assertEqual(mark.keys, {(second.phone, second.who), (third.phone, third.who)})
+        mark.advance([fourth])
+        self.assertEqual(mark.keys, {(fourth.phone, fourth.who)})
+
+    def test_as_dict(self):
+        mark = HighWaterMark()
+        mark.advance([second, third])
+        restored = HighWaterMark.from_dict(json.loads(json.dumps(mark.as_dict())))
+        self.assertEqual(restored.when, mark.when)
+        self.assertEqual(restored.keys, mark.keys)
+        self.assertIsNone(HighWaterMark.from_dict({}).when)
+
+
+class TestLogFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.api = Mock(device_id=1)
+
+    def test_poll(self):
+        follower = LogFollower(self.api, self.state_dir)
+        self.api.download_logs.return_value = [second, first]
+        self.assertEqual(follower.poll(date(2023, 9, 23)), [first, second])
+        self.api.download_logs.assert_called_once_with(date(2023, 9, 23), date(2023, 9, 23), since=None)
+        follower.commit()
+
+        # Entries already seen are left out, even in the same second
+        self.api.download_logs.return_value = [first, second, third]
+        self.assertEqual(follower.poll(date(2023, 9, 23)), [third])
+        self.api.download_logs.assert_called_with(date(2023, 9, 23), date(2023, 9, 23), since=second.when)
+        follower.commit()
+
+        # Polls start from the day of the mark
+        self.api.download_logs.return_value = [third, fourth]
+        self.assertEqual(follower.poll(date(2023, 9, 24)), [fourth])
+        self.api.download_logs.assert_called_with(date(2023, 9, 23), date(2023, 9, 24), since=third.when)
+
+    def test_commit(self):
+        follower = LogFollower(self.api, self.state_dir)
+        self.api.download_logs.return_value = [first, second]
+        follower.poll(date(2023, 9, 23))
+        # Until committed, the same entries are returned again
+        self.assertFalse(os.path.exists(follower.state_file))
+        self.assertEqual(follower.poll(date(2023, 9, 23)), [first, second])
+
+        follower.commit()
+        restarted = LogFollower(self.api, self.state_dir)
+        self.assertEqual(restarted.mark.when, second.when)
+        self.api.download_logs.return_value = [first, second, third]
+        self.assertEqual(restarted.poll(date(2023, 9, 23)), [third])
+
+        # Each device has its own mark
+        self.assertIsNone(LogFollower(Mock(device_id=2), self.state_dir).mark.when)
+
+    def test_invalid_state(self):
+        with open(os.path.join(self.state_dir, '1.json'), 'w') as f:
+            f.write('not json')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(LogFollower(self.api, self.state_dir).mark.when)
+
+    def test_run(self):
+        stop = threading.Event()
+        polls = [[first], ValueError('Unable to get log link'), [first, second]]
+
+        def download_logs(start, end, since=None):
+            result = polls.pop(0)
+            if not polls:
+                stop.set()
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.api.download_logs.side_effect = download_logs
+        entries = []
+        with self.assertLogs(level='WARNING'):
+            LogFollower(self.api, self.state_dir, interval=0).run(entries.append, stop)
+        self.assertEqual(entries, [first, second])
+        self.assertEqual(LogFollower(self.api, self.state_dir).mark.when, second.when)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from datetime import date, datetime
+from eldesalarms.api import DeviceApi
+from eldesalarms.logstore import LogStore
+from eldesalarms.models import LogEntry
+from eldesalarms.session import UserSession
+
+
+def entry(when: datetime, phone: str = '0870000001') -> LogEntry:
+    return LogEntry(when=when, who='18TVPerson1', phone=phone, apt_no=18)
+
+
+class TestLogStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LogStore(':memory:', 9999)
+        self.today = date(2023, 9, 25)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_missing_ranges(self):
+        self.assertEqual(self.store.missing_ranges(date(2023, 9, 1), date(2023, 9, 3), self.today),
+                         [(date(2023, 9, 1), date(2023, 9, 3))])
+
+        self.store.replace(date(2023, 9, 2), date(2023, 9, 2), [], self.today)
+        self.assertEqual(self.store.missing_ranges(date(2023, 9, 1), date(2023, 9, 3), self.today),
+                         [(date(2023, 9, 1), date(2023, 9, 1)), (date(2023, 9, 3), date(2023, 9, 3))])
+
+    def test_open_days_are_always_missing(self):
+        self.store.replace(date(2023, 9, 23), date(2023, 9, 26), [], self.today)
+        self.assertEqual(self.store.missing_ranges(date(2023, 9, 23), date(2023, 9, 26), self.today),
+                         [(date(2023, 9, 25), date(2023, 9, 26))])
+
+    def test_replace_and_query(self):
+        self.store.replace(date(2023, 9, 23), date(2023, 9, 24),
+                           [entry(datetime(2023, 9, 24, 8, 0)), entry(datetime(2023, 9, 23, 20, 8, 56))],
+                           self.today)
+        # Downloading a day again replaces its entries rather than duplicating them
+        self.store.replace(date(2023, 9, 24), date(2023, 9, 24),
+                           [entry(datetime(2023, 9, 24, 8, 0)), entry(datetime(2023, 9, 24, 9, 0), '0870000002')],
+                           self.today)
+
+        entries = list(self.store.query(datetime(2023, 9, 23), datetime(2023, 9, 24)))
+        self.assertEqual(entries, [entry(datetime(2023, 9, 23, 20, 8, 56)),
+                                   entry(datetime(2023, 9, 24, 8, 0)),
+                                   entry(datetime(2023, 9, 24, 9, 0), '0870000002')])
+        self.assertEqual(list(self.store.query(date(2023, 9, 24), date(2023, 9, 24)))[0].when,
+                         datetime(2023, 9, 24, 8, 0))
+
+    def test_replace_does_not_lock_the_file_while_downloading(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'logs.sqlite3')
+        first, second = LogStore(path, 1), LogStore(path, 2)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        # Another device's store writes to the same file while the first is downloading
+        def download():
+            yield entry(datetime(2023, 9, 23, 8, 0))
+            second.replace(date(2023, 9, 23), date(2023, 9, 23), [entry(datetime(2023, 9, 23, 9, 0))], self.today)
+            yield entry(datetime(2023, 9, 23, 10, 0))
+
+        self.assertEqual(first.replace(date(2023, 9, 23), date(2023, 9, 23), download(), self.today), 2)
+        self.assertEqual(len(list(first.query(date(2023, 9, 23), date(2023, 9, 23)))), 2)
+        self.assertEqual(len(list(second.query(date(2023, 9, 23), date(2023, 9, 23)))), 1)
+
+    def test_replace_drops_entries_outside_the_range(self):
+        self.store.replace(date(2023, 9, 10), date(2023, 9, 10), [entry(datetime(2023, 9, 10, 8, 0))], self.today)
+        # The download of the 9th also returns the first entry of the 10th
+        self.assertEqual(self.store.replace(date(2023, 9, 9), date(2023, 9, 9),
+                                            [entry(datetime(2023, 9, 9, 8, 0)), entry(datetime(2023, 9, 10, 8, 0))],
+                                            self.today), 1)
+        self.assertEqual(list(self.store.query(date(2023, 9, 9), date(2023, 9, 10))),
+                         [entry(datetime(2023, 9, 9, 8, 0)), entry(datetime(2023, 9, 10, 8, 0))])
+
+    def test_failed_download_changes_nothing(self):
+        self.store.replace(date(2023, 9, 23), date(2023, 9, 23), [entry(datetime(2023, 9, 23, 8, 0))], self.today)
+
+        def download():
+            yield entry(datetime(2023, 9, 23, 9, 0))
+            raise ValueError('Download failed')
+
+        with self.assertRaises(ValueError):
+            self.store.replace(date(2023, 9, 23), date(2023, 9, 24), download(), self.today)
+        self.assertEqual(list(self.store.query(date(2023, 9, 23), date(2023, 9, 24))),
+                         [entry(datetime(2023, 9, 23, 8, 0))])
+        self.assertEqual(self.store.missing_ranges(date(2023, 9, 23), date(2023, 9, 24), self.today),
+                         [(date(2023, 9, 24), date(2023, 9, 24))])
+
+
+class TestDeviceApiLogStore(unittest.TestCase):
+
+    @patch.object(UserSession, 'login')
+    def setUp(self, mock_login):
+        mock_login.return_value = True
+        self.store = LogStore(':memory:', 1)
+        self.device_api = DeviceApi(user_session=UserSession('user', 'pass'), device_id=1,
+                                    log_store=self.store)
+
+    def tearDown(self):
+        self.store.close()
+
+    @patch('eldesalarms.logstore.date')
+    def test_only_missing_days_downloaded(self, mock_date):
+        mock_date.today.return_value = date(2023, 9, 25)
+        self.store.replace(date(2023, 9, 23), date(2023, 9, 23),
+                           [entry(datetime(2023, 9, 23, 20, 8, 56))], date(2023, 9, 25))
+
+        self.device_api.download_logs = Mock(return_value=iter([entry(datetime(2023, 9, 24, 8, 0))]))
+        entries = list(self.device_api.iter_logs(date(2023, 9, 23), date(2023, 9, 24)))
+
+        self.device_api.download_logs.assert_called_once_with(date(2023, 9, 24), date(2023, 9, 24))
+        self.assertEqual(entries, [entry(datetime(2023, 9, 23, 20, 8, 56)),
+                                   entry(datetime(2023, 9, 24, 8, 0))])
+
+
+if __name__ == "__main__":
+    unittest.main()
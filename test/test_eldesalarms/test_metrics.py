@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import unittest
+from eldesalarms.api import INITIAL_URL, USER_DATA_URL, SYNC_PROGRESS_URL
+from eldesalarms.metrics import Histogram, Metrics, NULL_TIMER, endpoint_name
+from eldesalarms.session import LOGIN_URL
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_endpoint_name(self):
+        self.assertEqual(endpoint_name(LOGIN_URL), 'login')
+        self.assertEqual(endpoint_name(INITIAL_URL.format(1)), 'users')
+        self.assertEqual(endpoint_name(USER_DATA_URL.format(1, 2)), 'user_page')
+        self.assertEqual(endpoint_name(SYNC_PROGRESS_URL.format(1)), 'sync_progress')
+        self.assertEqual(endpoint_name('https://gates.eldesalarms.com/download/log.txt'), 'log_file')
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_disabled(self):
+        metrics = Metrics(enabled=False)
+        self.assertIs(metrics.time('parse'), NULL_TIMER)
+        metrics.observe_request(LOGIN_URL, 0.1, 100)
+        metrics.increment('retries')
+        self.assertEqual(metrics.as_dict(), {'requests': {}, 'phases': {}, 'counters': {}})
+
+    def test_record(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.observe_request(USER_DATA_URL.format(1, 2), 0.05, 100)
+        metrics.observe_request(USER_DATA_URL.format(1, 3), 0.5, 200, error=True)
+        with metrics.time('parse_user_page_lxml'):
+            pass
+        metrics.increment('users_parsed', 10)
+
+        data = metrics.as_dict()
+        self.assertEqual(data['requests']['user_page'],
+                         {'count': 2, 'sum': 0.55, 'buckets': {'0.1': 1, '1': 1, '+Inf': 0},
+                          'bytes': 300, 'errors': 1})
+        self.assertEqual(data['phases']['parse_user_page_lxml']['count'], 1)
+        self.assertEqual(data['counters'], {'users_parsed': 10})
+
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE eldesalarms_request_seconds histogram', text)
+        self.assertIn('eldesalarms_request_seconds_bucket{endpoint="user_page",le="1"} 2', text)
+        self.assertIn('eldesalarms_request_seconds_bucket{endpoint="user_page",le="+Inf"} 2', text)
+        self.assertIn('eldesalarms_request_bytes_total{endpoint="user_page"} 300', text)
+        self.assertIn('eldesalarms_users_parsed_total 10', text)
+
+    def test_write(self):
+        metrics = Metrics()
+        metrics.increment('relogins')
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'metrics.json')
+        self.addCleanup(os.remove, path)
+        metrics.write(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)['counters'], {'relogins': 1})
+        self.assertEqual(os.listdir(directory), ['metrics.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
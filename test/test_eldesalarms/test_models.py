@@ -0,0 +1,73 @@
+import dataclasses
+import tracemalloc
+import unittest
+from datetime import datetime, timedelta
+
+from eldesalarms.models import LogBatch, LogEntry, User
+
+
+class TestModels(unittest.TestCase):
+
+    def test_log_entry_is_frozen(self):
+        entry = LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVperson1', '0871234567', 18)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            entry.who = 'someone else'
+        self.assertFalse(hasattr(entry, '__dict__'))
+
+    def test_user_is_slotted(self):
+        user = User('Person', '0871234567')
+        user.number = 5
+        self.assertFalse(hasattr(user, '__dict__'))
+        self.assertEqual(dataclasses.asdict(user)['number'], 5)
+
+
+class TestLogBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.entries = [
+            LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVperson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 23, 20, 9, 56, 500), 'Cleaner', '0871234568', None),
+            LogEntry(datetime(1969, 12, 31, 23, 59, 59), '18TVperson1', '0871234567', 18),
+        ]
+
+    def test_round_trip(self):
+        batch = LogBatch(self.entries)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch), self.entries)
+        self.assertEqual(batch[1], self.entries[1])
+        self.assertEqual(batch[-1], self.entries[-1])
+
+    def test_strings_are_interned(self):
+        batch = LogBatch(self.entries)
+        self.assertEqual(batch.strings, ['18TVperson1', '0871234567', 'Cleaner', '0871234568'])
+        self.assertIs(batch[0].who, batch[2].who)
+
+    def test_negative_apt_no(self):
+        with self.assertRaises(ValueError):
+            LogBatch([LogEntry(datetime(2023, 9, 23), 'who', '0871234567', -1)])
+
+    def test_memory(self):
+        start = datetime(2023, 1, 1)
+
+        def entries():
+            for i in range(20000):
+                yield LogEntry(start + timedelta(seconds=i), f'{i % 50}TVperson',
+                               f'08712{i % 50:05}', i % 50)
+
+        tracemalloc.start()
+        try:
+            as_list = list(entries())
+            list_size = tracemalloc.get_traced_memory()[0]
+            del as_list
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            batch = LogBatch(entries())
+            batch_size = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(batch), 20000)
+        self.assertLess(batch_size * 4, list_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
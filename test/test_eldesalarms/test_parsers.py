@@ -0,0 +1,51 @@
+import os
+import unittest
+import unittest.mock
+from eldesalarms.parsers import LxmlUserPageParser, SoupUserPageParser, get_user_page_parser
+from test_eldesalarms.test_api import users_page_html_str
+
+FIXTURES_DIR = os.path.dirname(__file__)
+
+
+class TestUserPageParsers(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(FIXTURES_DIR, 'users.html'), 'rb') as f:
+            users_html = f.read()
+        self.pages = [users_page_html_str.encode('utf-8'), users_html]
+
+    def test_lxml_matches_html5lib(self):
+        for content in self.pages:
+            expected = SoupUserPageParser().parse(content)
+            actual = LxmlUserPageParser().parse(content)
+            self.assertEqual(actual, expected)
+            self.assertEqual(len(actual.users), 10)
+
+    def test_max_pages(self):
+        page = LxmlUserPageParser().parse(self.pages[0])
+        self.assertEqual(page.max_pages, 1)
+
+        # The users.html pager link has no page number
+        page = LxmlUserPageParser().parse(self.pages[1])
+        self.assertIsNone(page.max_pages)
+
+    def test_nested_cell_markup(self):
+        content = (b'<html><body><table class="items table table-striped table-condensed"><tbody>'
+                   b'<tr><td><b>User1</b> </td><td><span>Phone1</span></td><td>output</td></tr>'
+                   b'</tbody></table></body></html>')
+        self.assertEqual(LxmlUserPageParser().parse(content),
+                         SoupUserPageParser().parse(content))
+        self.assertEqual(LxmlUserPageParser().parse(content).users[0].name, 'User1')
+
+    def test_fallback_when_table_missing(self):
+        fallback = unittest.mock.Mock()
+        LxmlUserPageParser(fallback=fallback).parse(b'<html><body></body></html>')
+        fallback.parse.assert_called_once()
+
+    def test_unknown_parser(self):
+        with self.assertRaises(ValueError):
+            get_user_page_parser('regex')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import Mock
+from eldesalarms.models import User
+from eldesalarms.reconcile import apply_plan, plan_reconcile
+
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.current = [User('1A Alice', '0870000001', 'All'),
+                        User('2B Bob', '0870000002', 'All'),
+                        User('3C Carol', '0870000003', 'All')]
+        self.desired = [User('1A Alice', '0870000001', 'All'),
+                        User('2B Robert', '0870000002', 'All'),
+                        User('4D Dave', '0870000004', 'All'),
+                        User('4D Dave Again', '0870000004', 'All')]
+
+    def test_plan(self):
+        plan = plan_reconcile(iter(self.current), self.desired)
+        self.assertEqual(plan.to_add, [self.desired[2]])
+        self.assertEqual(plan.to_remove, [self.current[2]])
+        self.assertEqual(plan.changed, [(self.current[1], self.desired[1])])
+        self.assertEqual(plan.unchanged, 1)
+        self.assertEqual(plan.describe()[-1],
+                         '1 to add, 1 to remove, 1 changed, 1 unchanged')
+
+    def test_apply_plan(self):
+        api = Mock()
+        api.add_user.return_value = True
+        api.remove_users.side_effect = lambda users, workers: users
+        plan = plan_reconcile(self.current, self.desired)
+
+        results, removed = apply_plan(api, plan, workers=1)
+        api.add_user.assert_called_once_with(self.desired[2])
+        api.remove_users.assert_not_called()
+        self.assertTrue(results[0].added)
+        self.assertEqual(removed, [])
+
+        results, removed = apply_plan(api, plan, remove=True, workers=1)
+        api.remove_users.assert_called_once_with([self.current[2]], 1)
+        self.assertEqual(removed, [self.current[2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,13 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import stat
+import tempfile
+import threading
 import unittest
 from unittest import mock
 from unittest.mock import PropertyMock, patch, Mock
 import requests
-from eldesalarms.session import UserSession
+from eldesalarms.session import UserSession, DEFAULT_MAX_RETRIES
 
 
 class TestUserSession(unittest.TestCase):
@@ -89,5 +94,164 @@ class TestUserSession(unittest.TestCase):
             user_session.login()
 
 
+class TestUserSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def logged_in_session(self) -> UserSession:
+        user_session = UserSession(username="test_user", password="test_pass",
+                                   cache_dir=self.cache_dir.name)
+        user_session.cookies.set('PHPSESSID', 'PHPSESSID_postlogin',
+                                 domain='gates.eldesalarms.com', path='/')
+        user_session.token = 'test_token'
+        user_session.logged_in = True
+        return user_session
+
+    def test_save_and_restore(self):
+        self.logged_in_session().save()
+        self.assertEqual(stat.S_IMODE(os.stat(self.logged_in_session().cache_file).st_mode), 0o600)
+
+        user_session = UserSession(username="test_user", password="test_pass",
+                                   cache_dir=self.cache_dir.name)
+        self.assertTrue(user_session.restore())
+        self.assertEqual(user_session.token, 'test_token')
+        self.assertEqual(user_session.cookies.get('PHPSESSID'), 'PHPSESSID_postlogin')
+
+        # Sessions are cached per username
+        other_session = UserSession(username="other_user", password="test_pass",
+                                    cache_dir=self.cache_dir.name)
+        self.assertFalse(other_session.restore())
+
+    @patch.object(UserSession, 'login')
+    @patch.object(requests.Session, 'get')
+    def test_resume_valid_session(self, mock_get, mock_login):
+        self.logged_in_session().save()
+        mock_get.return_value = Mock(status_code=302)
+
+        user_session = UserSession(username="test_user", password="test_pass",
+                                   cache_dir=self.cache_dir.name)
+        self.assertTrue(user_session.resume())
+        self.assertTrue(user_session.logged_in)
+        mock_login.assert_not_called()
+        self.assertFalse(mock_get.call_args.kwargs['allow_redirects'])
+
+    @patch.object(UserSession, 'login')
+    @patch.object(requests.Session, 'get')
+    def test_resume_expired_session(self, mock_get, mock_login):
+        self.logged_in_session().save()
+        # The login form is shown, so the cached session has expired
+        mock_get.return_value = Mock(status_code=200)
+
+        def login():
+            user_session.logged_in = True
+            return True
+        user_session = UserSession(username="test_user", password="test_pass",
+                                   cache_dir=self.cache_dir.name)
+        mock_login.side_effect = login
+
+        self.assertTrue(user_session.resume())
+        mock_login.assert_called_once()
+        self.assertIsNone(user_session.cookies.get('PHPSESSID'))
+
+
+class TestUserSessionRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.user_session = UserSession(username="test_user", password="test_pass")
+        self.user_session.logged_in = True
+        self.user_session.token = 'old_token'
+
+    @staticmethod
+    def response(status_code: int, url: str = 'https://gates.eldesalarms.com/en/page.html') -> Mock:
+        return Mock(status_code=status_code, url=url, is_redirect=False, headers={})
+
+    @patch('eldesalarms.session.time.sleep')
+    @patch.object(requests.Session, 'request')
+    def test_retry_transient_errors(self, mock_request, mock_sleep):
+        mock_request.side_effect = [requests.exceptions.ConnectionError('reset'),
+                                    self.response(503), self.response(200)]
+
+        response = self.user_session.get('https://gates.eldesalarms.com/en/page.html')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(self.user_session.retries, 2)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('eldesalarms.session.time.sleep')
+    @patch.object(requests.Session, 'request')
+    def test_post_not_retried(self, mock_request, mock_sleep):
+        mock_request.return_value = self.response(503)
+
+        response = self.user_session.post('https://gates.eldesalarms.com/en/page.html', data={})
+        self.assertEqual(response.status_code, 503)
+        mock_request.assert_called_once()
+
+        mock_request.reset_mock()
+        self.user_session.post('https://gates.eldesalarms.com/en/page.html', data={}, idempotent=True)
+        self.assertEqual(mock_request.call_count, DEFAULT_MAX_RETRIES + 1)
+
+    @patch.object(UserSession, '_login')
+    @patch.object(requests.Session, 'request')
+    def test_relogin_when_session_expired(self, mock_request, mock_login):
+        def login():
+            self.user_session.token = 'new_token'
+            return True
+        mock_login.side_effect = login
+        mock_request.side_effect = [self.response(200, 'https://gates.eldesalarms.com/en/user/login.html'),
+                                    self.response(200)]
+
+        response = self.user_session.post('https://gates.eldesalarms.com/en/page.html',
+                                          data={'YII_CSRF_TOKEN': 'old_token', 'name': 'value'})
+
+        self.assertEqual(response.status_code, 200)
+        mock_login.assert_called_once()
+        self.assertEqual(self.user_session.relogins, 1)
+        # The post is sent again with the token of the new session
+        self.assertEqual(mock_request.call_args.kwargs['data'],
+                         {'YII_CSRF_TOKEN': 'new_token', 'name': 'value'})
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestUserSessionPool(unittest.TestCase):
+
+    @patch.object(requests.Session, 'request')
+    def test_default_timeout(self, mock_request):
+        user_session = UserSession(username="test_user", password="test_pass", timeout=5)
+        user_session.get('https://gates.eldesalarms.com/en/page.html')
+        self.assertEqual(mock_request.call_args.kwargs['timeout'], 5)
+
+        user_session.get('https://gates.eldesalarms.com/en/page.html', timeout=1)
+        self.assertEqual(mock_request.call_args.kwargs['timeout'], 1)
+
+    def test_connections_reused(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), OkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        user_session = UserSession(username="test_user", password="test_pass", pool_maxsize=2)
+        self.addCleanup(user_session.close)
+        for _ in range(5):
+            user_session.get(f'http://127.0.0.1:{server.server_port}/')
+
+        self.assertEqual(user_session.connection_stats(),
+                         {'connections_opened': 1, 'requests': 5})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from eldesalarms.models import User
+from eldesalarms.parsers import UserPage
+from eldesalarms.usersnapshot import UserRefresh, UserSnapshot, content_hash
+
+
+class TestUserSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.page = UserPage([User('Person1', '0870000001', 'Gate', True, 1),
+                              User('Person2', '0870000002', 'Barrier', True, 2)], 2)
+
+    def test_page(self):
+        snapshot = UserSnapshot(None, 1)
+        digest = content_hash(b'<html>page 1</html>')
+        self.assertIsNone(snapshot.page(1, digest))
+        snapshot.put(1, digest, self.page)
+        self.assertEqual(snapshot.page(1, digest), self.page)
+        self.assertIsNone(snapshot.page(1, content_hash(b'<html>page 1 changed</html>')))
+
+        # The snapshot keeps its own copy of the users
+        page = snapshot.page(1, digest)
+        page.users.pop()
+        page.users[0].number = 5
+        self.assertEqual(snapshot.page(1, digest).users[0].number, 1)
+        self.assertEqual(len(snapshot.users()), 2)
+
+    def test_truncate(self):
+        snapshot = UserSnapshot(None, 1)
+        snapshot.put(1, 'a', self.page)
+        snapshot.put(2, 'b', UserPage([User('Person3', '0870000003', 'Gate', True, 3)]))
+        self.assertEqual([user.number for user in snapshot.users()], [1, 2, 3])
+        snapshot.truncate(1)
+        self.assertEqual([user.number for user in snapshot.users()], [1, 2])
+
+    def test_persisted(self):
+        path = os.path.join(tempfile.mkdtemp(), 'users.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with UserSnapshot(path, 1) as snapshot:
+            snapshot.put(1, 'a', self.page)
+            snapshot.put(2, 'b', UserPage([User('Person3', '0870000003', 'Gate', True, 3)]))
+            snapshot.truncate(1)
+        with UserSnapshot(path, 1) as snapshot:
+            self.assertEqual(snapshot.page(1, 'a'), self.page)
+            self.assertEqual(snapshot.page(1, 'a').max_pages, 2)
+            self.assertEqual([user.number for user in snapshot.users()], [1, 2])
+        # Each device has its own snapshot
+        with UserSnapshot(path, 2) as snapshot:
+            self.assertEqual(snapshot.users(), [])
+
+
+class TestUserRefresh(unittest.TestCase):
+
+    def test_compare(self):
+        previous = [User('Person1', '0870000001', 'Gate', True, 1),
+                    User('Person2', '0870000002', 'Gate', True, 2),
+                    User('Person3', '0870000003', 'Gate', True, 3)]
+        users = [User('Person1', '0870000001', 'Gate', True, 1),
+                 User('Person2', '0870000002', 'Barrier', True, 2),
+                 User('Person4', '0870000004', 'Gate', True, 4)]
+        refresh = UserRefresh.compare(previous, users)
+        self.assertEqual(refresh.users, users)
+        self.assertEqual(refresh.changed, users[1:])
+        self.assertEqual(refresh.removed, previous[1:])
@@ -1,12 +1,18 @@
 import argparse
+from datetime import datetime
+import io
+import json
 from unittest import TestCase, mock
 import logging
+import os
 import sys
+import tempfile
 
 import pytest
 sys.path.append("src")
-from gatecontrol import Stream, setup_logging, main  # noqa:
+from gatecontrol import Stream, setup_logging, main, read_devices, device_file, run_devices, wait_for_syncs, write_output  # noqa:
 from eldesalarms.api import User  # noqa:
+from eldesalarms.models import LogBatch, LogEntry  # noqa:
 
 
 class TestSetLoggingLevel(TestCase):
@@ -68,6 +74,60 @@ class TestStream(TestCase):
             self.assertEqual(file, sys.stdout)
 
 
+class TestDevices(TestCase):
+
+    def test_read_devices(self):
+        self.assertEqual(read_devices('1'), [1])
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('# Building A\n2\n\n3\n1\n')
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(read_devices(['1', f.name]), [1, 2, 3])
+        with self.assertRaises(ValueError):
+            read_devices(['not_a_device'])
+
+    def test_device_file(self):
+        self.assertEqual(device_file('users.csv', 1, [1]), 'users.csv')
+        self.assertEqual(device_file('users.csv', 1, [1, 2]), 'users-1.csv')
+        self.assertEqual(device_file('out/{device}/users.csv', 2, [1, 2]), 'out/2/users.csv')
+        self.assertEqual(device_file('-', 2, [1, 2]), '-')
+
+    def test_write_output(self):
+        entries = [LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0871234567', 18)]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'logs.ndjson')
+        self.addCleanup(os.remove, path)
+        self.assertEqual(write_output(entries, LogEntry, path, None, 'log_entries'), 1)
+        with open(path) as f:
+            self.assertEqual(json.loads(f.read())['who'], '18TVPerson1')
+        with self.assertRaises(ValueError):
+            write_output(entries, LogEntry, '-', 'sqlite', 'log_entries')
+        with self.assertRaises(ValueError):
+            write_output(entries, LogEntry, path, 'sqlite', 'log_entries')
+
+    def test_run_devices(self):
+        def run(device):
+            if device == 2:
+                raise ValueError('Unable to connect')
+            return f'done {device}'
+
+        results = run_devices([1, 2, 3], run, parallel=2)
+        self.assertEqual([device for device, _ in results], [1, 2, 3])
+        self.assertEqual(results[0][1], 'done 1')
+        self.assertIsInstance(results[1][1], ValueError)
+
+    def test_wait_for_syncs(self):
+        done = mock.Mock(**{'wait.return_value': True})
+        timed_out = mock.Mock(**{'wait.side_effect': TimeoutError('Unable to complete synchronization')})
+        failed = mock.Mock(**{'wait.side_effect': ValueError('Sync failed')})
+
+        errors = wait_for_syncs([(1, done), (2, timed_out), (3, failed)], 1)
+        self.assertEqual(sorted(errors), [2, 3])
+        # Only the sync that is still running is cancelled
+        timed_out.cancel.assert_called_once()
+        done.cancel.assert_not_called()
+        failed.cancel.assert_not_called()
+
+
 class TestMainFunction(TestCase):
     @mock.patch('sys.argv', return_value=['gatecontrol.py', '--username', 'user', '--password', 'pass', '--device',
                 '1', '--upload', 'file.txt', '--nosync'])
@@ -85,11 +145,27 @@ class TestMainFunction(TestCase):
             password='pass',
             device='1',
             upload='file.txt',
+            remove=None,
             nosync=True,
             verbose=0,
             logs=None,
+            stats=None,
+            metrics=None,
+            follow=False,
+            user_snapshot=None, changed=False,
             download=None,
             sync=None,
+            workers=1,
+            rate_limit=None,
+            failed=None,
+            reconcile=False,
+            remove_missing=False,
+            dry_run=False,
+            session_cache=None,
+            timeout=60,
+            prefetch=0,
+            parallel=1,
+            sync_timeout=180,
         )
         mock_parse_args.return_value = args
 
@@ -134,11 +210,27 @@ class TestMainFunction(TestCase):
             password='pass',
             device='1',
             upload='file.txt',
+            remove=None,
             nosync=False,
             verbose=0,
             logs=None,
+            stats=None,
+            metrics=None,
+            follow=False,
+            user_snapshot=None, changed=False,
             download=None,
             sync=None,
+            workers=1,
+            rate_limit=None,
+            failed=None,
+            reconcile=False,
+            remove_missing=False,
+            dry_run=False,
+            session_cache=None,
+            timeout=60,
+            prefetch=0,
+            parallel=1,
+            sync_timeout=180,
         )
         mock_parse_args.return_value = args
 
@@ -166,3 +258,111 @@ class TestMainFunction(TestCase):
 
         # Verifying that synchronize was not called
         mock_device_api_instance.synchronize.assert_called_once()
+
+    @mock.patch('sys.exit')
+    @mock.patch('gatecontrol.UserSession', autospec=True)
+    @mock.patch('gatecontrol.DeviceApi', autospec=True)
+    @mock.patch('argparse.ArgumentParser.parse_args')
+    def test_main_sync_multiple_devices(self, mock_parse_args, mock_device_api, mock_user_session, mock_exit):
+        args = argparse.Namespace(
+            username='user', password='pass', device=['1', '2', '3'], upload=None, remove=None,
+            nosync=False, verbose=0, logs=None, stats=None, metrics=None, follow=False, user_snapshot=None, changed=False, download=None, sync=True, workers=1, rate_limit=None,
+            failed=None, reconcile=False, remove_missing=False, dry_run=False, session_cache=None,
+            timeout=60, prefetch=0, parallel=2, sync_timeout=180,
+        )
+        mock_parse_args.return_value = args
+        mock_user_session.return_value.login.return_value = True
+        handles = [mock.Mock(**{'wait.return_value': True}),
+                   mock.Mock(**{'wait.side_effect': ValueError('Sync failed')}),
+                   mock.Mock(**{'wait.return_value': True})]
+        mock_device_api.return_value.start_synchronize.side_effect = handles
+
+        main()
+
+        # One session is shared by all devices
+        mock_user_session.assert_called_once()
+        self.assertEqual(sorted(c.args[1] for c in mock_device_api.call_args_list), [1, 2, 3])
+        # The devices are synchronized in the background, then waited for together
+        mock_device_api.return_value.synchronize.assert_not_called()
+        self.assertEqual(mock_device_api.return_value.start_synchronize.call_count, 3)
+        for handle in handles:
+            handle.wait.assert_called_once()
+        mock_exit.assert_called_once_with(1)
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    @mock.patch('gatecontrol.UserSession', autospec=True)
+    def test_main_changed_without_user_snapshot(self, mock_user_session, mock_stderr):
+        argv = ['gatecontrol.py', 'user', 'pass', '1', '--download', '-', '--changed']
+        with mock.patch('sys.argv', argv), self.assertRaises(SystemExit):
+            main()
+        self.assertIn('--changed needs --user-snapshot', mock_stderr.getvalue())
+        mock_user_session.assert_not_called()
+
+    @mock.patch('sys.exit')
+    @mock.patch('gatecontrol.UserSession', autospec=True)
+    @mock.patch('gatecontrol.DeviceApi', autospec=True)
+    @mock.patch('argparse.ArgumentParser.parse_args')
+    def test_main_stats(self, mock_parse_args, mock_device_api, mock_user_session, mock_exit):
+        output = os.path.join(tempfile.mkdtemp(), 'stats.json')
+        self.addCleanup(os.remove, output)
+        args = argparse.Namespace(
+            username='user', password='pass', device='1', upload=None, remove=None,
+            nosync=False, verbose=0, logs=None, stats=[[output, '20230923', '20230924']], metrics=None, follow=False, user_snapshot=None, changed=False,
+            download=None, sync=False, workers=1, rate_limit=None, failed=None, reconcile=False,
+            remove_missing=False, dry_run=False, session_cache=None, timeout=60, prefetch=0,
+            parallel=1, sync_timeout=180, log_store=None, chunk=None,
+            inactive_since=datetime(2023, 9, 24),
+        )
+        mock_parse_args.return_value = args
+        mock_user_session.return_value.login.return_value = True
+        mock_device_api.return_value.get_log_batch.return_value = LogBatch([
+            LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 24, 8, 0), '18TVPerson1', '0871234567', 18),
+            LogEntry(datetime(2023, 9, 23, 9, 0), 'Cleaner', '0871234568', None),
+        ])
+        mock_device_api.return_value.iter_users.return_value = iter(
+            [User('Person1', '0871234567'), User('Person2', '0871234569')])
+
+        main()
+
+        mock_device_api.return_value.get_log_batch.assert_called_once_with(
+            datetime(2023, 9, 23), datetime(2023, 9, 24), None, 1)
+        with open(output) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['per_day'], [{'day': '2023-09-23', 'count': 2},
+                                            {'day': '2023-09-24', 'count': 1}])
+        self.assertEqual(stats['inactive_phones'], ['0871234568', '0871234569'])
+        mock_exit.assert_not_called()
+
+    @mock.patch('sys.exit')
+    @mock.patch('gatecontrol.LogFollower', autospec=True)
+    @mock.patch('gatecontrol.UserSession', autospec=True)
+    @mock.patch('gatecontrol.DeviceApi', autospec=True)
+    @mock.patch('argparse.ArgumentParser.parse_args')
+    def test_main_follow(self, mock_parse_args, mock_device_api, mock_user_session, mock_follower, mock_exit):
+        args = argparse.Namespace(
+            username='user', password='pass', device='1', upload=None, remove=None,
+            nosync=False, verbose=0, logs=None, stats=None, metrics=None, follow=True, user_snapshot=None, changed=False,
+            follow_state='state', follow_interval=5, download=None, sync=False, workers=1,
+            rate_limit=None, failed=None, reconcile=False, remove_missing=False, dry_run=False,
+            session_cache=None, timeout=None, prefetch=0, parallel=1, sync_timeout=180,
+        )
+        mock_parse_args.return_value = args
+        mock_user_session.return_value.login.return_value = True
+
+        def follow():
+            yield LogEntry(datetime(2023, 9, 23, 20, 8, 56), '18TVPerson1', '0871234567', 18)
+            raise KeyboardInterrupt
+
+        mock_follower.return_value.follow.side_effect = follow
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            main()
+
+        # Without --timeout the session keeps its (connect, read) default
+        self.assertEqual(mock_user_session.call_args.kwargs['timeout'], (10, 60))
+        mock_follower.assert_called_once_with(mock_device_api.return_value, 'state', 5)
+        self.assertIn('{"when":"2023-09-23T20:08:56","who":"18TVPerson1","phone":"0871234567","apt_no":18}\n',
+                      stdout.getvalue())
+        self.assertIn('Device 1: ok - Followed 1 log entries', stdout.getvalue())
+        mock_exit.assert_not_called()
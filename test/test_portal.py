@@ -0,0 +1,144 @@
+from datetime import date
+import re
+from unittest import TestCase, mock
+import sys
+
+sys.path.append("src")
+sys.path.append("bench")
+from eldesalarms.api import DeviceApi, ADDUSER_PAGE_URL, BASE_URL  # noqa:
+from eldesalarms.bulk import upload_users  # noqa:
+from eldesalarms.metrics import Metrics  # noqa:
+from eldesalarms.models import User  # noqa:
+from eldesalarms.session import UserSession  # noqa:
+from portal import FakePortal, PortalConfig  # noqa:
+
+
+class TestFakePortal(TestCase):
+
+    def setUp(self):
+        self.portal = FakePortal(PortalConfig(users=25, page_size=10, entries_per_day=4)).start()
+        self.addCleanup(self.portal.stop)
+        self.session = UserSession('user', 'pass')
+        self.portal.connect(self.session)
+
+    def test_login(self):
+        self.assertTrue(self.session.login())
+        with self.assertRaises(ValueError):
+            session = UserSession('user', 'wrong')
+            self.portal.connect(session)
+            session.login()
+
+    def test_users(self):
+        self.session.login()
+        api = DeviceApi(self.session, 1)
+        users = list(api.iter_users(prefetch=2))
+        self.assertEqual(len(users), 25)
+        self.assertEqual(users[0].number, 1)
+
+        self.assertTrue(api.add_user(User('New', '0861234567', 'Barrier')))
+        self.assertEqual(api.remove_users([User('', users[3].phone)]), [
+            User('', users[3].phone, number=users[3].number)])
+        phones = [user.phone for user in api.users]
+        self.assertIn('0861234567', phones)
+        self.assertNotIn(users[3].phone, phones)
+
+    def test_add_user_slots(self):
+        self.session.login()
+        form_url = ADDUSER_PAGE_URL.format(1, 0)
+        # Forms served before either is posted point at the same free slot
+        first = self.session.get(form_url).text
+        second = self.session.get(form_url).text
+        action = re.search(r'action="([^"]+)"', first).group(1)
+        self.assertIn('/number/26.html', action)
+        self.assertIn(action, second)
+
+        data = {'YII_CSRF_TOKEN': self.session.token,
+                'GatesconfigDeviceUsersdatabase[user_name]': 'New',
+                'GatesconfigDeviceUsersdatabase[phone]': '0861234567',
+                'GatesconfigDeviceUsersdatabase[output]': '1'}
+        self.session.post(BASE_URL + action, data=data)
+        self.assertIn('/number/27.html', self.session.get(form_url).text)
+        # Posting the stale form replaces the user just added
+        self.session.post(BASE_URL + action, data={**data, 'GatesconfigDeviceUsersdatabase[phone]': '0861234568'})
+        device = self.portal.device(1)
+        self.assertEqual(len(device.users), 26)
+        self.assertEqual(device.overwrites, 1)
+
+    def test_add_users(self):
+        self.session.login()
+        api = DeviceApi(self.session, 1)
+        users = [User('New1', '0861234567', 'Gate'), User('New2', '0861234568', 'Barrier')]
+        self.assertEqual(api.add_users(users), users)
+        device = self.portal.device(1)
+        self.assertEqual(device.overwrites, 0)
+        self.assertEqual(device.users[26], ('New1', '0861234567', 'Gate'))
+        self.assertEqual(device.users[27], ('New2', '0861234568', 'Barrier'))
+
+    def test_upload_users_parallel(self):
+        self.session.login()
+        api = DeviceApi(self.session, 1)
+        users = [User(f'New{i}', f'08612345{i:02d}', 'Gate') for i in range(10)]
+        results = upload_users(api, users, workers=4)
+        self.assertTrue(all(result.added for result in results))
+        device = self.portal.device(1)
+        self.assertEqual(device.overwrites, 0)
+        self.assertEqual(len(device.users), 35)
+
+    def test_refresh_users(self):
+        metrics = Metrics()
+        session = UserSession('user', 'pass', metrics=metrics)
+        self.portal.connect(session)
+        session.login()
+        api = DeviceApi(session, 1)
+        # Without a snapshot, plain iteration neither hashes nor keeps the pages
+        with mock.patch('eldesalarms.api.content_hash') as content_hash:
+            self.assertEqual(len(list(api.users)), 25)
+        content_hash.assert_not_called()
+        self.assertIsNone(api.user_snapshot)
+        metrics.counters.clear()
+
+        refresh = api.refresh_users()
+        self.assertEqual(len(refresh.users), 25)
+        self.assertEqual(refresh.changed, refresh.users)
+        self.assertEqual(metrics.counters['users_parsed'], 25)
+
+        # Only the last page changes
+        self.assertTrue(api.add_user(User('New', '0861234567', 'Barrier')))
+        refresh = api.refresh_users(prefetch=2)
+        self.assertEqual(len(refresh.users), 26)
+        self.assertEqual([user.phone for user in refresh.changed], ['0861234567'])
+        self.assertEqual(refresh.removed, [])
+        self.assertEqual(metrics.counters['users_parsed'], 25 + 6)
+        self.assertEqual(metrics.counters['user_pages_unchanged'], 2)
+
+    def test_logs(self):
+        self.session.login()
+        entries = DeviceApi(self.session, 1).get_logs(date(2023, 9, 1), date(2023, 9, 3))
+        self.assertEqual(len(entries), 12)
+        self.assertEqual(entries[-1].when.date(), date(2023, 9, 3))
+
+    def test_expired_session(self):
+        self.session.login()
+        api = DeviceApi(self.session, 1)
+        self.portal.sessions.clear()
+        self.assertEqual(len(list(api.users)), 25)
+        self.assertEqual(self.session.relogins, 1)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        session = UserSession('user', 'pass', metrics=metrics)
+        self.portal.connect(session)
+        session.login()
+        api = DeviceApi(session, 1)
+        self.assertEqual(len(list(api.users)), 25)
+        api.get_logs(date(2023, 9, 1), date(2023, 9, 1))
+
+        data = metrics.as_dict()
+        self.assertEqual(data['requests']['login']['count'], 2)
+        self.assertEqual(data['requests']['users']['count'], 1)
+        self.assertEqual(data['requests']['user_page']['count'], 2)
+        self.assertGreater(data['requests']['user_page']['bytes'], 0)
+        self.assertEqual(data['requests']['log_file']['count'], 1)
+        self.assertEqual(data['phases']['parse_user_page_lxml']['count'], 3)
+        self.assertEqual(data['phases']['login']['count'], 1)
+        self.assertEqual(data['counters'], {'users_parsed': 25, 'log_entries': 4})